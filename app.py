@@ -1,27 +1,27 @@
 # app.py（ローカルHTTP/本番HTTPS 切替対応・完全版）
 import os
+import math
+import hashlib
+import json
 import time
-import logging
+import secrets
+import threading
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import (
-    Flask, redirect, request, session, url_for,
-    render_template, jsonify
+    Flask, redirect, request, session, url_for, g,
+    render_template, jsonify, Response, stream_with_context, send_from_directory
 )
 from dotenv import load_dotenv
 import spotipy
-from spotipy.oauth2 import SpotifyOAuth
-from spotipy.cache_handler import CacheHandler
+from spotipy.oauth2 import SpotifyOAuth, SpotifyClientCredentials
+from spotipy.cache_handler import CacheHandler, MemoryCacheHandler
 
 # タイムアウト・リトライ
-import requests
 from requests import Session
 from requests.exceptions import ReadTimeout, ConnectionError
 from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-
-# URL解析（ログ用）
-from urllib.parse import urlparse, parse_qs
 
 # ==============================
 # 設定・初期化
@@ -51,19 +51,17 @@ else:
         SESSION_COOKIE_SAMESITE="Lax",
     )
 
-# ログ
-logging.basicConfig(
-    filename='error.log',
-    level=logging.INFO,
-    format='[%(asctime)s] %(levelname)s: %(message)s'
-)
-app.logger.addHandler(logging.StreamHandler())
-app.logger.setLevel(logging.INFO)
+# ログ（キュー経由で別スレッドが書く。JSON 1行・サイズでローテート。設定は log_pipeline を参照）
+from log_pipeline import setup_logging, log_stats
+setup_logging()
 
 # Spotify/OAuth 設定
 CLIENT_ID = os.getenv("SPOTIPY_CLIENT_ID")
 CLIENT_SECRET = os.getenv("SPOTIPY_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("SPOTIPY_REDIRECT_URI", "http://127.0.0.1:5000/callback")
+# 負荷試験などでローカルの代替サーバへ向けるとき用（通常は未設定）
+SPOTIFY_API_BASE = os.getenv("SPOTIFY_API_BASE")            # 例: http://127.0.0.1:9001/v1/
+SPOTIFY_ACCOUNTS_BASE = os.getenv("SPOTIFY_ACCOUNTS_BASE")  # 例: http://127.0.0.1:9001
 SCOPE = (
     "user-read-playback-state "
     "user-modify-playback-state "
@@ -74,54 +72,150 @@ SCOPE = (
 app.logger.info(f"[ENV] APP_ENV={APP_ENV}")
 app.logger.info(f"[OAuth] REDIRECT_URI={REDIRECT_URI}")
 
+# 計測（/metrics）
+from metrics import (
+    REGISTRY, HTTP_SECONDS, SERVER_TIMING, begin_request, server_timing_header,
+    track, timed,
+)
+
 # ==============================
-# OpenAI（行ごと翻訳）
+# OpenAI（行ごと翻訳。クライアントは translation_service が初回利用時に1つだけ作る）
 # ==============================
-from openai import OpenAI
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+from translation_service import (
+    translate_lines, iter_translate_lines, translation_memo_stats, translation_scheduler_stats,
+    openai_configured, get_openai_client,
+)
 
 # ==============================
-# Spotipy: セッションキャッシュ（Flask session保存）
+# ユーザー識別（サーバ側キャッシュ・トークンストアのキー）
 # ==============================
-class FlaskSessionCache(CacheHandler):
+def _user_key() -> str:
+    """セッションごとの不透明なID。無ければ発行する。"""
+    sid = session.get("sid")
+    if not sid:
+        sid = secrets.token_urlsafe(16)
+        session["sid"] = sid
+    return sid
+
+# ==============================
+# Spotipy: トークンキャッシュ（サーバ側トークンストア保存。Cookie には sid のみ）
+# ==============================
+from token_store import make_token_store
+TOKENS = make_token_store()
+app.logger.info(f"[TOKEN_STORE] {TOKENS.name}")
+
+class TokenStoreCache(CacheHandler):
+    def __init__(self, sid: str):
+        self.sid = sid
     def get_cached_token(self):
-        return session.get("token_info")
+        return TOKENS.get(self.sid)
     def save_token_to_cache(self, token_info):
-        session["token_info"] = token_info
+        TOKENS.set(self.sid, token_info)
         return True
 
-def get_sp_oauth(show_dialog: bool = True) -> SpotifyOAuth:
+def get_sp_oauth(show_dialog: bool = True, sid: Optional[str] = None) -> SpotifyOAuth:
     # ローカルHTTPならOAuthlibのHTTPS強制を一時解除
     if REDIRECT_URI.startswith("http://"):
         os.environ.setdefault("OAUTHLIB_INSECURE_TRANSPORT", "1")
 
-    return SpotifyOAuth(
+    sp_oauth = SpotifyOAuth(
         client_id=CLIENT_ID,
         client_secret=CLIENT_SECRET,
         redirect_uri=REDIRECT_URI,     # ダッシュボードと完全一致必須
         scope=SCOPE,
-        cache_handler=FlaskSessionCache(),
+        cache_handler=TokenStoreCache(sid or _user_key()),
         show_dialog=show_dialog,
         requests_timeout=15,
     )
+    if SPOTIFY_ACCOUNTS_BASE:
+        sp_oauth.OAUTH_AUTHORIZE_URL = f"{SPOTIFY_ACCOUNTS_BASE}/authorize"
+        sp_oauth.OAUTH_TOKEN_URL = f"{SPOTIFY_ACCOUNTS_BASE}/api/token"
+    return sp_oauth
 
 # ==============================
-# Spotipy セッション（タイムアウト & リトライ）
+# Spotipy セッション（プロセス共有の接続プール・タイムアウト & レート制御）
 # ==============================
-def make_spotify_client(token: str) -> spotipy.Spotify:
-    session_s: Session = requests.Session()
-    retry = Retry(
-        total=3, connect=3, read=3,
-        backoff_factor=0.6,
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"]),
-        raise_on_status=False,
+# sync ワーカーは1リクエストずつだが、翻訳・先読みのスレッドからも使うので少し余裕を持たせる
+# （gunicorn.conf.py で起動したときはスレッド数 / worker_connections に合わせた値が入る）
+SPOTIFY_POOL_MAXSIZE = int(os.getenv("SPOTIFY_POOL_MAXSIZE", "10"))
+
+from spotify_limiter import (
+    SpotifyLimiter, RateLimitedSession, spotify_priority, INTERACTIVE, POLL, BACKGROUND,
+)
+# 再試行・Retry-After 待ち・ペース配分はここで一括（urllib3 側の再試行は使わない）
+SPOTIFY_LIMITER = SpotifyLimiter(redis_url=os.getenv("REDIS_URL"))
+app.logger.info(f"[SPOTIFY_LIMITER] shared={SPOTIFY_LIMITER.shared}")
+
+class _SharedSession(RateLimitedSession):
+    """spotipy.Spotify.__del__ が close() するので、共有セッションでは無視する。"""
+    def close(self):
+        pass
+
+def _build_spotify_session() -> Session:
+    session_s = _SharedSession(SPOTIFY_LIMITER)
+    adapter = HTTPAdapter(
+        max_retries=0,
+        pool_connections=4,                # ホスト数（api.spotify.com / accounts.spotify.com）
+        pool_maxsize=SPOTIFY_POOL_MAXSIZE,  # 1ホストあたりの keep-alive 接続数
     )
-    adapter = HTTPAdapter(max_retries=retry)
     session_s.mount("https://", adapter)
     session_s.mount("http://", adapter)
-    return spotipy.Spotify(auth=token, requests_session=session_s, requests_timeout=(10, 20))
+    return session_s
+
+_spotify_session = _build_spotify_session()
+
+class _TimedSpotify(spotipy.Spotify):
+    """アプリで使う呼び出しの所要時間を metrics に記録し、優先度をレート制御に伝える。"""
+    priority = INTERACTIVE
+
+    def _internal_call(self, method, url, payload, params):
+        with spotify_priority(self.priority):
+            return super()._internal_call(method, url, payload, params)
+
+for _name in ("current_user_playing_track", "current_playback", "current_user", "search",
+              "devices", "transfer_playback", "start_playback", "add_to_queue", "queue"):
+    setattr(_TimedSpotify, _name, timed("spotify", _name)(getattr(spotipy.Spotify, _name)))
+
+def make_spotify_client(token: str, priority: str = INTERACTIVE) -> spotipy.Spotify:
+    """
+    TLS/keep-alive 接続は共有し、ユーザーのトークンは呼び出しごとのヘッダで渡る。
+    priority: 再生操作は INTERACTIVE、再生状態の取得は POLL、先読みは BACKGROUND。
+    """
+    sp = _TimedSpotify(auth=token, requests_session=_spotify_session, requests_timeout=(10, 20))
+    sp.priority = priority
+    if SPOTIFY_API_BASE:
+        sp.prefix = SPOTIFY_API_BASE
+    return sp
+
+def make_app_spotify_client(priority: str = BACKGROUND) -> spotipy.Spotify:
+    """ユーザーではなくアプリの資格情報（Client Credentials）で呼ぶクライアント。公開プレイリスト・曲情報用。"""
+    auth = SpotifyClientCredentials(client_id=CLIENT_ID, client_secret=CLIENT_SECRET,
+                                    cache_handler=MemoryCacheHandler(),   # .cache ファイルに書かない
+                                    requests_session=_spotify_session, requests_timeout=15)
+    if SPOTIFY_ACCOUNTS_BASE:
+        auth.OAUTH_TOKEN_URL = f"{SPOTIFY_ACCOUNTS_BASE}/api/token"
+    sp = _TimedSpotify(client_credentials_manager=auth, requests_session=_spotify_session, requests_timeout=(10, 20))
+    sp.priority = priority
+    if SPOTIFY_API_BASE:
+        sp.prefix = SPOTIFY_API_BASE
+    return sp
+
+def spotify_pool_stats() -> dict:
+    """新規接続（= TCP/TLSハンドシェイク）数とリクエスト数。差分が再利用で省けたハンドシェイク。"""
+    connections = requests_served = 0
+    for adapter in set(_spotify_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            requests_served += pool.num_requests
+    return {
+        "connections_opened": connections,
+        "requests": requests_served,
+        "handshakes_saved": max(0, requests_served - connections),
+    }
 
 # ==============================
 # トークン有効化ユーティリティ
@@ -134,35 +228,167 @@ def _token_valid(token_info: Optional[dict]) -> bool:
     exp = int(token_info.get("expires_at", 0))
     return exp - _SKEW > int(time.time())
 
+_PROACTIVE_WINDOW = 5 * 60  # 秒（期限までこれを切ったら裏で更新を始める）
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="token-refresh")
+
+def _refresh_token(sid: str, blocking: bool = True) -> Optional[dict]:
+    """
+    refresh_token で更新して保存。同じセッションの更新はロックで1本にまとめ、
+    ロック待ちの間に他が更新済みならそれを使う。
+    """
+    with TOKENS.lock(sid, blocking=blocking) as locked:
+        token_info = TOKENS.get(sid)
+        if not locked:
+            return token_info  # 誰かが更新中（非ブロッキング時）
+        if not token_info or not token_info.get("refresh_token"):
+            return None
+        if _token_valid(token_info) and int(token_info["expires_at"]) - _PROACTIVE_WINDOW > int(time.time()):
+            return token_info  # 待っている間に更新済み
+
+        sp_oauth = get_sp_oauth(show_dialog=False, sid=sid)
+        with track("spotify", "refresh_access_token"):
+            new_info = sp_oauth.refresh_access_token(token_info["refresh_token"])
+        now = int(time.time())
+        new_info["expires_at"] = new_info.get("expires_at") or (now + int(new_info.get("expires_in", 3600)))
+        if "refresh_token" not in new_info:
+            new_info["refresh_token"] = token_info["refresh_token"]
+        TOKENS.set(sid, new_info)
+        return new_info
+
+def _refresh_in_background(sid: str):
+    try:
+        _refresh_token(sid, blocking=False)
+    except Exception:
+        app.logger.exception("background refresh_access_token failed")
+
 def ensure_token() -> Optional[str]:
-    """有効なアクセストークンを返す。必要ならリフレッシュ。"""
-    token_info = session.get("token_info")
+    """有効なアクセストークンを返す。必要ならリフレッシュ（期限が近ければ裏で先回り更新）。"""
+    sid = _user_key()
+    if "token_info" in session:
+        # 旧形式（Cookie に token_info を持つ）からの移行
+        legacy = session.pop("token_info")
+        if legacy:
+            TOKENS.set(sid, legacy)
+
+    token_info = TOKENS.get(sid)
     if _token_valid(token_info):
+        if int(token_info["expires_at"]) - _PROACTIVE_WINDOW <= int(time.time()):
+            _refresh_executor.submit(_refresh_in_background, sid)
         return token_info["access_token"]
 
     if token_info and token_info.get("refresh_token"):
         try:
-            sp_oauth = get_sp_oauth(show_dialog=False)
-            new_info = sp_oauth.refresh_access_token(token_info["refresh_token"])
-            now = int(time.time())
-            new_info["expires_at"] = new_info.get("expires_at") or (now + int(new_info.get("expires_in", 3600)))
-            if "refresh_token" not in new_info:
-                new_info["refresh_token"] = token_info["refresh_token"]
-            session["token_info"] = new_info
-            return new_info["access_token"]
+            new_info = _refresh_token(sid)
+            if _token_valid(new_info):
+                return new_info["access_token"]
+            raise RuntimeError("refreshed token is not valid")
         except Exception:
             app.logger.exception("refresh_access_token failed")
+            TOKENS.delete(sid)
             session.clear()
             return None
     return None
 
+def invalidate_access_token():
+    """Spotify が 401 を返したとき用。refresh_token は残し、次の ensure_token() で更新させる。"""
+    sid = _user_key()
+    token_info = TOKENS.get(sid)
+    if token_info:
+        token_info["expires_at"] = 0
+        TOKENS.set(sid, token_info)
+
+# ==============================
+# 再生中スナップショット（3つの再生系APIで共有）
+# ==============================
+from playback_state import (
+    NowPlayingCache, DeviceRegistry, next_poll_delay, playback_event, wait_for_device,
+)
+NOW_PLAYING = NowPlayingCache()
+DEVICES = DeviceRegistry()
+
+def current_playback(token: str) -> Optional[dict]:
+    """current_user_playing_track() を短TTLで共有。同時リクエストは1回の呼び出しに相乗り。"""
+    return NOW_PLAYING.get(_user_key(), lambda: make_spotify_client(token, POLL).current_user_playing_track())
+
 # ==============================
-# キャッシュ系ヘッダ
+# キャッシュ系ヘッダ（ルートごとの方針）
 # ==============================
+# - 静的ファイル: ?v=<内容ハッシュ> 付きなら1年 immutable、無ければ毎回 ETag で再検証
+# - 歌詞（/api/lyrics, /api/lyrics_timed）: ETag を付けて毎回再検証（同じなら 304）
+# - それ以外（トークン・再生状態・HTML など）: 保存させない
+import mimetypes
+from static_assets import asset_version, pick_variant
+
+STATIC_MAX_AGE = 365 * 24 * 3600
+
 @app.after_request
-def add_no_store_headers(resp):
-    resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
-    resp.headers["Pragma"] = "no-cache"
+def apply_cache_policy(resp):
+    if "Cache-Control" not in resp.headers:   # ルート側で決めていなければ保存させない
+        resp.headers["Cache-Control"] = "no-store, max-age=0"
+        resp.headers["Pragma"] = "no-cache"
+    return resp
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    """url_for('static', filename=...) に内容ハッシュを付ける（更新されると URL が変わる）。"""
+    if endpoint == "static" and "v" not in values:
+        v = asset_version(app.static_folder, values.get("filename") or "")
+        if v:
+            values["v"] = v
+
+def serve_static(filename):
+    """事前圧縮版（.br/.gz）があればそれを返す。"""
+    variant = pick_variant(app.static_folder, filename, request.headers.get("Accept-Encoding", ""))
+    if variant:
+        resp = send_from_directory(app.static_folder, variant[0],
+                                   mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+        resp.headers["Content-Encoding"] = variant[1]
+    else:
+        resp = app.send_static_file(filename)
+    resp.headers["Vary"] = "Accept-Encoding"
+    v = request.args.get("v")
+    if v and v == asset_version(app.static_folder, filename):
+        resp.headers["Cache-Control"] = f"public, max-age={STATIC_MAX_AGE}, immutable"
+    else:
+        resp.headers["Cache-Control"] = "public, no-cache"
+    return resp
+
+app.view_functions["static"] = serve_static
+
+def conditional_json(payload: dict, track_id: Optional[str]):
+    """曲IDと内容のハッシュを ETag にして返す。If-None-Match が一致すれば 304。"""
+    resp = jsonify(payload)
+    digest = hashlib.sha1(resp.get_data()).hexdigest()[:16]
+    resp.set_etag(f"{track_id or 'none'}-{digest}")
+    # 再生中の曲で中身が変わる URL なので、保存はしても使う前に毎回確認させる
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp.make_conditional(request)
+
+# ==============================
+# ルートの計測（＋任意で Server-Timing ヘッダ）
+# ==============================
+# これより遅かったリクエストは上流ごとの内訳つきでログに残す（0 で無効）
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "3"))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    begin_request()
+
+@app.after_request
+def record_request_timing(resp):
+    started = g.get("request_started")
+    if started is None:
+        return resp
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    HTTP_SECONDS.observe(elapsed, method=request.method, route=route, status=resp.status_code)
+    if SLOW_REQUEST_SECONDS and elapsed >= SLOW_REQUEST_SECONDS:
+        app.logger.warning("slow request", extra={
+            "status": resp.status_code, "duration_ms": round(elapsed * 1000, 1), "log_key": f"slow:{route}",
+        })
+    if SERVER_TIMING:
+        resp.headers["Server-Timing"] = server_timing_header(elapsed)
     return resp
 
 # ==============================
@@ -195,9 +421,8 @@ def mypage():
 def login():
     sp_oauth = get_sp_oauth(show_dialog=True)
     auth_url = sp_oauth.get_authorize_url()
-    q = parse_qs(urlparse(auth_url).query)
-    app.logger.info(f"[AUTH_URL] {auth_url}")
-    app.logger.info(f"[AUTH_URL] redirect_uri={q.get('redirect_uri',[None])[0]}")
+    # redirect_uri は起動時に1回出している。URL（state 入り）はデバッグ時だけ
+    app.logger.debug("[AUTH_URL] %s", auth_url)
     return redirect(auth_url)
 
 @app.route('/callback')
@@ -207,9 +432,18 @@ def callback():
         error = request.args.get('error')
         return (f"Spotify認証が拒否されました: {error}" if error else "認証コードが見つかりませんでした。"), 400
 
+    # ログインのたびにセッションIDを振り直す（サーバ側トークンの鍵になるため）。古い ID のトークンは消す
+    old_sid = session.get("sid")
+    session["sid"] = secrets.token_urlsafe(16)
+    if old_sid:
+        try:
+            TOKENS.delete(old_sid)
+        except Exception as e:
+            app.logger.warning(f"古いセッションのトークン削除に失敗: {e}")
     sp_oauth = get_sp_oauth(show_dialog=False)
     try:
-        sp_oauth.get_access_token(code, as_dict=False)
+        with track("spotify", "get_access_token"):
+            sp_oauth.get_access_token(code, as_dict=False)
         token_info = sp_oauth.get_cached_token()
         if not token_info or 'access_token' not in token_info:
             app.logger.error(f"get_cached_token 空/不正: {token_info}")
@@ -220,7 +454,7 @@ def callback():
             token_info['expires_at'] = now + int(token_info["expires_in"])
 
         session.permanent = True
-        session["token_info"] = token_info
+        TOKENS.set(_user_key(), token_info)
 
         return redirect(url_for('player'))
     except Exception as e:
@@ -230,6 +464,7 @@ def callback():
 
 @app.route('/get_access_token')
 def get_access_token_for_frontend():
+    # キャッシュ方針は既定の no-store のまま（トークンをブラウザやプロキシに残さない）
     token = ensure_token()
     if token:
         return {'access_token': token}
@@ -249,15 +484,18 @@ def transfer_playback():
     try:
         sp = make_spotify_client(token)
         sp.transfer_playback(device_id=device_id, force_play=False)
+        DEVICES.remember(_user_key(), device_id, ready=True)
+        NOW_PLAYING.invalidate(_user_key())
         return {'message': '再生デバイスを切り替えました'}, 200
     except spotipy.SpotifyException as e:
         if getattr(e, "http_status", None) == 401:
-            session["token_info"] = None
+            invalidate_access_token()
             retry = ensure_token()
             if retry:
                 try:
                     sp = make_spotify_client(retry)
                     sp.transfer_playback(device_id=device_id, force_play=False)
+                    DEVICES.remember(_user_key(), device_id, ready=True)
                     return {'message': '再生デバイスを切り替えました(リトライ)'}, 200
                 except Exception as ee:
                     app.logger.error(f"デバイス切替リトライ失敗: {ee}", exc_info=True)
@@ -280,27 +518,27 @@ def play_track():
         return jsonify({'error': 'track_uri が必要です'}), 400
 
     sp = make_spotify_client(token)
-
-    def pick_device():
-        """優先: 引数→active→先頭"""
-        if preferred_device:
-            return preferred_device
-        devs = sp.devices().get("devices", [])
-        if not devs:
-            return None
-        active = next((x for x in devs if x.get("is_active")), None)
-        return (active or devs[0]).get("id")
+    user_key = _user_key()
 
     try:
-        device_id = pick_device()
+        device_id = pick_device(sp, user_key, preferred_device)
+        if device_id and DEVICES.is_ready(user_key, device_id):
+            # 直前にアクティブを確認済みなら転送を省いて即再生
+            try:
+                sp.start_playback(device_id=device_id, uris=[track_uri])
+                NOW_PLAYING.invalidate(user_key)
+                return jsonify({'ok': True, 'device_id': device_id})
+            except spotipy.SpotifyException as e:
+                if getattr(e, "http_status", None) != 404:
+                    raise
+        if device_id:
+            # 再生を奪わずに転送し、アクティブになったのを確認してから再生（消えていたデバイスは選び直す）
+            device_id = activate_device(sp, user_key, device_id, preferred_device)
         if not device_id:
             return jsonify({'error': 'NO_ACTIVE_DEVICE',
                             'hint': 'Spotifyアプリを起動するか /player を開いてデバイス接続してください。'}), 409
-
-        # 再生を奪わずに転送してから再生
-        sp.transfer_playback(device_id=device_id, force_play=False)
-        time.sleep(0.3)
         sp.start_playback(device_id=device_id, uris=[track_uri])
+        NOW_PLAYING.invalidate(user_key)
         return jsonify({'ok': True, 'device_id': device_id})
     except spotipy.SpotifyException as e:
         app.logger.exception("play_track failed")
@@ -309,6 +547,67 @@ def play_track():
         app.logger.exception("play_track failed (generic)")
         return jsonify({'error': str(e)}), 500
 
+def pick_device(sp: spotipy.Spotify, user_key: str, preferred_device: Optional[str],
+                exclude: Optional[str] = None) -> Optional[str]:
+    """優先: 引数→登録済み→active→先頭（devices() は登録が無いときだけ呼ぶ）。exclude は選ばない"""
+    if preferred_device:
+        DEVICES.remember(user_key, preferred_device)
+        return preferred_device
+    known = DEVICES.get(user_key)
+    if known and known != exclude:
+        return known
+    devs = [x for x in sp.devices().get("devices", []) if x.get("id") and x["id"] != exclude]
+    if not devs:
+        return None
+    active = next((x for x in devs if x.get("is_active")), None)
+    device_id = (active or devs[0]).get("id")
+    if device_id:
+        DEVICES.remember(user_key, device_id, ready=bool(active))
+    return device_id
+
+def activate_device(sp: spotipy.Spotify, user_key: str, device_id: str,
+                    preferred_device: Optional[str] = None) -> Optional[str]:
+    """
+    転送して準備完了を待ち（固定 sleep ではなく期限付きポーリング）、使ったデバイスを返す。
+    覚えていたデバイスが 404（閉じたタブ等）なら、同じリクエストの中で devices() から選び直して1回だけ転送し直す
+    （選べるデバイスが無ければ None）。クライアントが指定したデバイスの 404 はそのまま送出する。
+    """
+    try:
+        sp.transfer_playback(device_id=device_id, force_play=False)
+    except spotipy.SpotifyException as e:
+        if getattr(e, "http_status", None) != 404:
+            raise
+        DEVICES.forget(user_key)
+        if device_id == preferred_device:
+            raise
+        stale, device_id = device_id, pick_device(sp, user_key, None, exclude=device_id)
+        if not device_id:
+            return None
+        app.logger.info(f"device {stale} is gone, switching to {device_id}")
+        sp.transfer_playback(device_id=device_id, force_play=False)
+    ready = wait_for_device(sp, device_id)
+    if not ready:
+        app.logger.warning(f"device {device_id} not confirmed active within timeout")
+    DEVICES.remember(user_key, device_id, ready=ready)
+    return device_id
+
+
+def _spotify_unavailable(e: spotipy.SpotifyException, where: str):
+    """
+    Spotify のサーキットが開いている（503）か、レート制限で送れなかった（429）とき。
+    障害扱いの 500 にはせず、Retry-After 付きで返す（フロントはその秒数後に取り直す）。
+    """
+    try:
+        retry_after = max(1, math.ceil(float((e.headers or {}).get("Retry-After"))))
+    except (TypeError, ValueError):
+        retry_after = 5
+    app.logger.warning(f"{where}: spotify unavailable ({e.http_status}), retry in {retry_after}s")
+    body = {"ok": False, "note": "spotify unavailable", "retry_after": retry_after}
+    return body, e.http_status, {"Retry-After": str(retry_after)}
+
+def _is_spotify_unavailable(e: Exception) -> bool:
+    return isinstance(e, spotipy.SpotifyException) and e.http_status in (429, 503)
+
 
 @app.get("/api/current-track")
 def api_current_track():
@@ -316,8 +615,7 @@ def api_current_track():
     if not token:
         return {"ok": False, "note": "unauthorized or expired"}, 401
     try:
-        sp = make_spotify_client(token)
-        curr = sp.current_user_playing_track()
+        curr = current_playback(token)
         if not curr or not curr.get("item"):
             return {"ok": False, "note": "no current track"}, 200
 
@@ -337,12 +635,29 @@ def api_current_track():
     except (ReadTimeout, ConnectionError) as e:
         app.logger.warning(f"current-track timeout/network: {e}")
         return {"ok": False, "note": "timeout"}, 200
+    except spotipy.SpotifyException as e:
+        if _is_spotify_unavailable(e):
+            return _spotify_unavailable(e, "current-track")
+        app.logger.error(f"現在再生取得エラー: {e}", exc_info=True)
+        return {"ok": False, "error": str(e)}, 500
     except Exception as e:
         app.logger.error(f"現在再生取得エラー: {e}", exc_info=True)
         return {"ok": False, "error": str(e)}, 500
 
 # 歌詞取得（例：lrclib）
-from lyrics_service import get_lyrics_by_title_artist
+from lyrics_service import get_lyrics_entry, get_timed_lyrics, lyrics_cache_stats, LyricsUnavailable
+from circuit_breaker import breaker_stats
+
+def _unavailable(e: LyricsUnavailable, **extra) -> dict:
+    """LRCLIB に問い合わせられず、キャッシュも無いとき。フロントは retry_after 秒後に取り直す。"""
+    return {"ok": False, "note": "lyrics unavailable", "retry_after": math.ceil(e.retry_after) or 5, **extra}
+
+# 再生キューの先読み（次の数曲の歌詞・訳）
+from prefetch import QueuePrefetcher
+PREFETCHER = QueuePrefetcher()
+
+def prefetch_upcoming(token: str, track_id: Optional[str], user_key: Optional[str] = None):
+    PREFETCHER.on_track(user_key or _user_key(), track_id, lambda: make_spotify_client(token, BACKGROUND), get_openai_client)
 
 @app.get("/api/lyrics")
 def api_lyrics():
@@ -350,8 +665,7 @@ def api_lyrics():
     if not token:
         return {"ok": False, "note": "unauthorized or expired"}, 401
     try:
-        sp = make_spotify_client(token)
-        curr = sp.current_user_playing_track()
+        curr = current_playback(token)
         if not curr or not curr.get("item"):
             return {"ok": False, "note": "no current track"}, 200
         item = curr["item"]
@@ -361,17 +675,79 @@ def api_lyrics():
         if not title:
             return {"ok": False, "note": "no title"}, 200
 
-        lyrics = get_lyrics_by_title_artist(title, artist)
+        prefetch_upcoming(token, item.get("id"))
+        lyrics, stale = get_lyrics_entry(
+            title, artist,
+            duration_ms=item.get("duration_ms"),
+            track_id=item.get("id"),
+        )
         if not lyrics:
             return {"ok": False, "note": "lyrics not found", "title": title, "artist": artist}, 200
-        return {"ok": True, "title": title, "artist": artist, "lyrics": lyrics}, 200
+        # stale: 期限切れのキャッシュ（LRCLIB から取り直し中）
+        return conditional_json(
+            {"ok": True, "title": title, "artist": artist, "lyrics": lyrics, "stale": stale}, item.get("id"),
+        )
+    except LyricsUnavailable as e:
+        return _unavailable(e, title=title, artist=artist), 200
     except (ReadTimeout, ConnectionError) as e:
         app.logger.warning(f"lyrics timeout/network: {e}")
         return {"ok": False, "note": "timeout"}, 200
+    except spotipy.SpotifyException as e:
+        if _is_spotify_unavailable(e):
+            return _spotify_unavailable(e, "lyrics")
+        app.logger.error(f"歌詞取得エラー: {e}", exc_info=True)
+        return {"ok": False, "error": str(e)}, 500
     except Exception as e:
         app.logger.error(f"歌詞取得エラー: {e}", exc_info=True)
         return {"ok": False, "error": str(e)}, 500
 
+@app.get("/api/lyrics_timed")
+def api_lyrics_timed():
+    token = ensure_token()
+    if not token:
+        return {"ok": False, "note": "unauthorized or expired"}, 401
+    try:
+        curr = current_playback(token)
+        if not curr or not curr.get("item"):
+            return {"ok": False, "note": "no current track"}, 200
+        item = curr["item"]
+        title = item.get("name") or ""
+        artists = item.get("artists") or []
+        artist = artists[0]["name"] if artists else ""
+        if not title:
+            return {"ok": False, "note": "no title"}, 200
+
+        prefetch_upcoming(token, item.get("id"))
+        res = get_timed_lyrics(
+            title, artist,
+            duration_ms=item.get("duration_ms"),
+            track_id=item.get("id"),
+        )
+        if not res or not res["timed"]:
+            return {"ok": False, "note": "lyrics not found", "title": title, "artist": artist}, 200
+        return conditional_json({
+            "ok": True,
+            "title": title,
+            "artist": artist,
+            "track_id": item.get("id"),
+            "synced": res["synced"],
+            "stale": res["stale"],
+            "timed": res["timed"],
+        }, item.get("id"))
+    except LyricsUnavailable as e:
+        return _unavailable(e, title=title, artist=artist), 200
+    except (ReadTimeout, ConnectionError) as e:
+        app.logger.warning(f"lyrics_timed timeout/network: {e}")
+        return {"ok": False, "note": "timeout"}, 200
+    except spotipy.SpotifyException as e:
+        if _is_spotify_unavailable(e):
+            return _spotify_unavailable(e, "lyrics_timed")
+        app.logger.error(f"歌詞(タイム付き)取得エラー: {e}", exc_info=True)
+        return {"ok": False, "error": str(e)}, 500
+    except Exception as e:
+        app.logger.error(f"歌詞(タイム付き)取得エラー: {e}", exc_info=True)
+        return {"ok": False, "error": str(e)}, 500
+
 @app.get("/api/currently_playing")
 def api_currently_playing():
     token = ensure_token()
@@ -379,16 +755,16 @@ def api_currently_playing():
         return {"is_playing": False, "note": "unauthorized or expired"}, 200
 
     def fetch():
-        sp = make_spotify_client(ensure_token())
-        return sp.current_user_playing_track()
+        return current_playback(ensure_token())
 
     try:
         cur = fetch()
     except spotipy.SpotifyException as e:
         if getattr(e, "http_status", None) == 401:
-            session["token_info"] = None
+            invalidate_access_token()
             if ensure_token():
                 try:
+                    NOW_PLAYING.invalidate(_user_key())
                     cur = fetch()
                 except Exception as ee:
                     app.logger.error(f"現在再生再試行も失敗: {ee}", exc_info=True)
@@ -405,8 +781,12 @@ def api_currently_playing():
         app.logger.error(f"現在再生取得エラー: {e}", exc_info=True)
         return {"is_playing": False, "error": str(e)}, 200
 
+    return _now_playing_payload(cur), 200
+
+def _now_playing_payload(cur: Optional[dict]) -> dict:
     if not cur or not cur.get("is_playing"):
-        return {"is_playing": False}, 200
+        item = (cur or {}).get("item") or {}
+        return {"is_playing": False, "track_id": item.get("id"), "timestamp_ms": int(time.time() * 1000)}
 
     item = cur.get("item") or {}
     artists = item.get("artists") or []
@@ -423,12 +803,101 @@ def api_currently_playing():
         "duration_ms": item.get("duration_ms") or 0,
         "progress_ms": cur.get("progress_ms") or 0,
         "timestamp_ms": int(time.time() * 1000)
-    }, 200
+    }
+
+# 再生状態のプッシュ（SSE）。1接続がリクエストスレッドを最大 EVENTS_MAX_SECONDS 占有するので、
+# ワーカーごとの同時接続数を EVENTS_MAX_STREAMS までに抑える（sync ワーカーでは使わない）。
+# 0 にすると 204 を返しクライアントはポーリングに戻る。
+NOW_PLAYING_EVENTS = os.getenv("NOW_PLAYING_EVENTS", "1") == "1"
+EVENTS_MAX_SECONDS = int(os.getenv("NOW_PLAYING_EVENTS_MAX_SECONDS", "300"))
+EVENTS_ERROR_SLEEP = 5
+
+def _default_max_streams() -> int:
+    """1ワーカーで同時に張っておく SSE 接続の上限。スレッドの大半は通常のリクエスト用に残す。"""
+    mode = os.getenv("SERVE_MODE", "gthread")
+    if mode == "sync":
+        return 0   # 1接続でワーカーが埋まる
+    if mode == "gevent":
+        return int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "500")) // 2
+    return max(1, int(os.getenv("GUNICORN_THREADS", "16")) // 4)
+
+# 上限を超えた接続には 204 を返し、クライアントはポーリングに戻る
+EVENTS_MAX_STREAMS = int(os.getenv("NOW_PLAYING_EVENTS_MAX_STREAMS", str(_default_max_streams())))
+_event_streams = {"open": 0, "rejected": 0}
+_event_streams_lock = threading.Lock()
+
+def _acquire_event_stream() -> bool:
+    with _event_streams_lock:
+        if _event_streams["open"] >= EVENTS_MAX_STREAMS:
+            _event_streams["rejected"] += 1
+            return False
+        _event_streams["open"] += 1
+        return True
+
+def _release_event_stream():
+    with _event_streams_lock:
+        _event_streams["open"] -= 1
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.get("/api/now_playing/events")
+def api_now_playing_events():
+    """
+    曲の切り替わり(track)・再生/停止やシーク(state)をプッシュする。
+    Spotify へは曲の残り時間に合わせて間隔を変えて問い合わせる。
+    接続は EVENTS_MAX_SECONDS で閉じ、ブラウザ側の自動再接続に任せる。
+    """
+    if not NOW_PLAYING_EVENTS:
+        return "", 204
+    if not ensure_token():
+        return {"error": "unauthorized"}, 401
+    if not _acquire_event_stream():
+        return "", 204
+    user_key = _user_key()
+
+    def generate():
+        yield "retry: 2000\n\n"
+        last = None
+        deadline = time.time() + EVENTS_MAX_SECONDS
+        while time.time() < deadline:
+            token = ensure_token()
+            if not token:
+                yield _sse("auth", {"note": "unauthorized or expired"})
+                return
+            try:
+                cur = NOW_PLAYING.get(user_key, lambda: make_spotify_client(token, POLL).current_user_playing_track())
+            except spotipy.SpotifyException as e:
+                if getattr(e, "http_status", None) == 401:
+                    yield _sse("auth", {"note": "unauthorized or expired"})
+                    return
+                app.logger.warning(f"now_playing events: {e}")
+                yield ": error\n\n"
+                time.sleep(EVENTS_ERROR_SLEEP)
+                continue
+            except (ReadTimeout, ConnectionError) as e:
+                app.logger.warning(f"now_playing events timeout/network: {e}")
+                yield ": timeout\n\n"
+                time.sleep(EVENTS_ERROR_SLEEP)
+                continue
+
+            payload = _now_playing_payload(cur)
+            ev = playback_event(last, payload)
+            if ev == "track":
+                prefetch_upcoming(token, payload.get("track_id"), user_key)
+            yield _sse(ev, payload) if ev else ": ping\n\n"
+            last = payload
+            time.sleep(min(next_poll_delay(payload), max(0.0, deadline - time.time())))
+
+    resp = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    resp.headers["X-Accel-Buffering"] = "no"
+    resp.call_on_close(_release_event_stream)   # 切断・タイムアウト・例外のどれでも呼ばれる
+    return resp
 
 @app.post("/api/translate_lines")
 def api_translate_lines():
     try:
-        if openai_client is None:
+        if not openai_configured():
             return {"ok": False, "error": "OPENAI_API_KEY not set"}, 400
 
         data = request.get_json(silent=True) or {}
@@ -436,41 +905,134 @@ def api_translate_lines():
         if not isinstance(lines, list) or not lines:
             return {"ok": False, "error": "lines required"}, 400
 
-        out, chunk = [], []
-
-        def flush():
-            if not chunk:
-                return
-            prompt = (
-                "以下の歌詞行を自然な日本語に、行数を変えず同じ行数で訳してください。\n"
-                "出力は訳文のみ。番号や解説は付けないでください。\n\n"
-                + "\n".join(chunk)
-            )
-            resp = openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are a professional translator."},
-                    {"role": "user", "content": prompt},
-                ],
-                temperature=0.2,
-            )
-            jp = (resp.choices[0].message.content or "").splitlines()
-            if len(jp) < len(chunk):
-                jp += [""] * (len(chunk) - len(jp))
-            out.extend(jp[: len(chunk)])
-            chunk.clear()
-
-        for s in lines:
-            chunk.append(s if str(s).strip() else "(空行)")
-            if len(chunk) >= 8:
-                flush()
-        flush()
-
-        return {"ok": True, "jp": out}, 200
+        report: dict = {}
+        out = translate_lines(get_openai_client(), lines, report=report)
+        # stale: 期限切れの訳を返した行数 / unavailable: OpenAI が使えず訳せなかった行数
+        return {"ok": True, "jp": out, **report}, 200
     except Exception as e:
         app.logger.error(f"/api/translate_lines error: {e}", exc_info=True)
         return {"ok": False, "error": str(e)}, 500
 
+@app.post("/api/translate_lines/stream")
+def api_translate_lines_stream():
+    """
+    /api/translate_lines のストリーミング版（NDJSON）。
+    1行訳せるごとに {"i": 行番号, "jp": 訳} を1行で返し、最後に {"done": true, "stale": n, "unavailable": n}。
+    """
+    if not openai_configured():
+        return {"ok": False, "error": "OPENAI_API_KEY not set"}, 400
+
+    data = request.get_json(silent=True) or {}
+    lines = data.get("lines") or []
+    if not isinstance(lines, list) or not lines:
+        return {"ok": False, "error": "lines required"}, 400
+    try:
+        start_index = max(0, int(data.get("start_index") or 0))
+    except (TypeError, ValueError):
+        start_index = 0
+
+    def generate():
+        report: dict = {}
+        try:
+            for i, jp in iter_translate_lines(get_openai_client(), lines, start_index=start_index, report=report):
+                yield json.dumps({"i": i, "jp": jp}, ensure_ascii=False) + "\n"
+            yield json.dumps({"done": True, **report}) + "\n"
+        except Exception as e:
+            app.logger.error(f"/api/translate_lines/stream error: {e}", exc_info=True)
+            yield json.dumps({"done": True, "error": str(e)}, ensure_ascii=False) + "\n"
+
+    resp = Response(generate(), mimetype="application/x-ndjson")
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+# ==============================
+# 検索（結果キャッシュ＋次ページ先読み）
+# ==============================
+from cache_store import LRUCache, MISS
+
+SEARCH_CACHE = LRUCache(
+    maxsize=int(os.getenv("SEARCH_CACHE_SIZE", "2048")),
+    ttl=float(os.getenv("SEARCH_CACHE_TTL", "600")),
+)
+_search_prefetch = ThreadPoolExecutor(max_workers=2, thread_name_prefix="search-prefetch")
+_search_inflight: set = set()
+_search_inflight_lock = threading.Lock()
+SEARCH_STATS = {"hits": 0, "misses": 0}
+_search_stats_lock = threading.Lock()   # リクエストと先読みの両方のスレッドから数える
+
+def _count_search(field: str):
+    with _search_stats_lock:
+        SEARCH_STATS[field] += 1
+
+def search_stats() -> dict:
+    with _search_stats_lock:
+        return dict(SEARCH_STATS)
+
+def _search_key(q: str, market: Optional[str], limit: int, offset: int) -> str:
+    return f"{' '.join(q.casefold().split())}|{market or ''}|{limit}|{offset}"
+
+def _user_market(sp: spotipy.Spotify) -> Optional[str]:
+    """国コードはセッションに覚えておく（検索のたびに current_user() を呼ばない）。"""
+    if "market" in session:
+        return session["market"]
+    try:
+        market = sp.current_user().get("country") or None
+    except Exception:
+        return None  # 取得失敗は覚えない
+    session["market"] = market
+    return market
+
+def _search_page(sp: spotipy.Spotify, q: str, market: Optional[str], limit: int, offset: int) -> dict:
+    key = _search_key(q, market, limit, offset)
+    cached = SEARCH_CACHE.get(key)
+    if cached is not MISS:
+        _count_search("hits")
+        return cached
+    _count_search("misses")
+
+    resp = sp.search(q=q, type="track", limit=limit, offset=offset, market=market)
+    tracks = resp.get("tracks", {})
+    items = []
+    for t in tracks.get("items", []):
+        artists = ", ".join([a["name"] for a in t.get("artists", [])])
+        album = t.get("album", {})
+        img = album["images"][-1]["url"] if album.get("images") else ""
+        items.append({
+            "id": t.get("id"),
+            "name": t.get("name"),
+            "artists": artists,
+            "album": album.get("name"),
+            "image": img,
+            "uri": t.get("uri"),
+            "duration_ms": t.get("duration_ms"),
+        })
+
+    total = tracks.get("total", 0)
+    next_offset = (offset + limit) if (offset + limit) < total else None
+    page = {"items": items, "next_offset": next_offset}
+    SEARCH_CACHE.set(key, page)
+    return page
+
+def _prefetch_search_page(token: str, q: str, market: Optional[str], limit: int, offset: int):
+    key = _search_key(q, market, limit, offset)
+    if SEARCH_CACHE.get(key) is not MISS:
+        return
+    with _search_inflight_lock:
+        if key in _search_inflight:
+            return
+        _search_inflight.add(key)
+
+    def run():
+        try:
+            _search_page(make_spotify_client(token, BACKGROUND), q, market, limit, offset)
+        except Exception as e:
+            app.logger.warning(f"search prefetch failed: {e}")
+        finally:
+            with _search_inflight_lock:
+                _search_inflight.discard(key)
+
+    _search_prefetch.submit(run)
+
 @app.get("/api/search_tracks")
 def api_search_tracks():
     token = ensure_token()
@@ -485,32 +1047,13 @@ def api_search_tracks():
 
     try:
         sp = make_spotify_client(token)
-        try:
-            me = sp.current_user()
-            market = me.get("country") or None
-        except Exception:
-            market = None
-
-        resp = sp.search(q=q, type="track", limit=limit, offset=offset, market=market)
-        tracks = resp.get("tracks", {})
-        items = []
-        for t in tracks.get("items", []):
-            artists = ", ".join([a["name"] for a in t.get("artists", [])])
-            album = t.get("album", {})
-            img = album["images"][-1]["url"] if album.get("images") else ""
-            items.append({
-                "id": t.get("id"),
-                "name": t.get("name"),
-                "artists": artists,
-                "album": album.get("name"),
-                "image": img,
-                "uri": t.get("uri"),
-                "duration_ms": t.get("duration_ms"),
-            })
-
-        total = tracks.get("total", 0)
-        next_offset = (offset + limit) if (offset + limit) < total else None
-        return jsonify({"items": items, "next_offset": next_offset})
+        market = _user_market(sp)
+        page = _search_page(sp, q, market, limit, offset)
+        # 2ページ目以降を読んだ（スクロールしている）ときだけ次ページを先に取っておく。
+        # 1ページ目は入力のたびに来るので、先読みすると Spotify の検索呼び出しが倍になる
+        if offset > 0 and page["next_offset"] is not None:
+            _prefetch_search_page(token, q, market, limit, page["next_offset"])
+        return jsonify(page)
     except Exception as e:
         app.logger.exception("search error")
         return jsonify({"error": str(e)}), 500
@@ -535,20 +1078,16 @@ def api_queue_track():
     except spotipy.SpotifyException as e:
         if getattr(e, "http_status", None) == 404:
             try:
-                device_id = preferred_device
-                if not device_id:
-                    devs = sp.devices().get("devices", [])
-                    if devs:
-                        active = next((d for d in devs if d.get("is_active")), None)
-                        device_id = (active or devs[0]).get("id")
+                user_key = _user_key()
+                device_id = pick_device(sp, user_key, preferred_device)
+                if device_id:
+                    device_id = activate_device(sp, user_key, device_id, preferred_device)
                 if not device_id:
                     return jsonify({
                         "error": "NO_ACTIVE_DEVICE",
                         "hint": "Spotifyアプリを起動するか、プレイヤーページを開いてデバイス接続してください。"
                     }), 409
 
-                sp.transfer_playback(device_id=device_id, force_play=False)
-                time.sleep(0.4)
                 sp.add_to_queue(uri)
                 return jsonify({"ok": True, "activated_device": device_id})
             except Exception as ee:
@@ -564,6 +1103,174 @@ def api_queue_track():
 def health():
     return "ok", 200
 
+# 内部状態（/api/cache_stats と /metrics）。METRICS_TOKEN を設定したら Authorization: Bearer <token> が必要
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+def _stats_authorized() -> bool:
+    return not METRICS_TOKEN or secrets.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}",
+    )
+
+@app.get("/api/cache_stats")
+def api_cache_stats():
+    if not _stats_authorized():
+        return {"error": "unauthorized"}, 401
+    return {
+        "lyrics": lyrics_cache_stats(),
+        "translations": translation_memo_stats(),
+        "spotify_pool": spotify_pool_stats(),
+        "spotify_limiter": SPOTIFY_LIMITER.snapshot(),
+        "now_playing": dict(NOW_PLAYING.stats),
+        "now_playing_events": dict(_event_streams, max=EVENTS_MAX_STREAMS),
+        "prefetch": dict(PREFETCHER.stats),
+        "search": search_stats(),
+        "translate_scheduler": translation_scheduler_stats(),
+        "circuits": breaker_stats(),
+        "logging": log_stats(),
+    }, 200
+
+# Prometheus 形式（認証は /api/cache_stats と同じ）
+def _collect_app_stats() -> list:
+    """既存の stats 辞書を /metrics 用の系列に変換する。"""
+    lookups, ratios = [], []
+    for name, st in (("lyrics", lyrics_cache_stats()), ("translations", translation_memo_stats())):
+        for field in ("memory_hits", "disk_hits", "negative_hits", "stale_hits", "misses"):
+            lookups.append(({"cache": name, "result": field}, st[field]))
+        ratios.append(({"cache": name}, st["hit_rate"]))
+    for field in ("hits", "shared", "fetches"):
+        lookups.append(({"cache": "now_playing", "result": field}, NOW_PLAYING.stats[field]))
+    search = search_stats()
+    search_total = search["hits"] + search["misses"]
+    for field in ("hits", "misses"):
+        lookups.append(({"cache": "search", "result": field}, search[field]))
+    ratios.append(({"cache": "search"}, round(search["hits"] / search_total, 4) if search_total else 0.0))
+
+    stages = [
+        ({"stage": stage, "result": field}, value)
+        for stage, st in lyrics_cache_stats()["stages"].items()
+        for field, value in st.items() if field not in ("calls", "avg_ms")
+    ]
+    pool = spotify_pool_stats()
+    sched = translation_scheduler_stats()
+    return [
+        ("tune_cache_lookups_total", "counter", "キャッシュ参照数（結果別）", lookups),
+        ("tune_cache_hit_ratio", "gauge", "キャッシュのヒット率", ratios),
+        ("tune_lrclib_stage_total", "counter", "歌詞取得の段階別の結果（local/get/search）", stages),
+        ("tune_prefetch_total", "counter", "キュー先読みの件数",
+         [({"event": k}, v) for k, v in PREFETCHER.stats.items()]),
+        ("tune_spotify_pool_total", "counter", "Spotify 接続プールの新規接続数とリクエスト数", [
+            ({"kind": "connections_opened"}, pool["connections_opened"]),
+            ({"kind": "requests"}, pool["requests"]),
+        ]),
+        ("tune_translate_lines_total", "counter", "翻訳スケジューラに来た行（queued=送信、shared=他の依頼に相乗り）", [
+            ({"kind": "queued"}, sched["lines_queued"]),
+            ({"kind": "shared"}, sched["lines_shared"]),
+        ]),
+        ("tune_translate_batches_total", "counter", "翻訳スケジューラが送った呼び出し数", [({}, sched["batches"])]),
+        ("tune_translate_queue_depth", "gauge", "送信待ちの行数", [({}, sched["queued"])]),
+        ("tune_translate_rate_limited_seconds_total", "counter", "レート制限のために待った秒数",
+         [({}, sched["rate_limited_seconds"])]),
+    ]
+
+REGISTRY.add_collector(_collect_app_stats)
+
+@app.get("/metrics")
+def prometheus_metrics():
+    if not _stats_authorized():
+        return "unauthorized", 401
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+# ==============================
+# CLI: ローカル歌詞インデックス（flask lyrics-index ...）
+# ==============================
+import click
+from flask.cli import AppGroup
+from lyrics_index import get_index
+
+lyrics_index_cli = AppGroup("lyrics-index", help="ローカル歌詞インデックスの管理")
+
+@lyrics_index_cli.command("import")
+@click.argument("dump_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--batch", default=50000, show_default=True, help="1トランザクションあたりのトラック数")
+def lyrics_index_import(dump_path, batch):
+    """LRCLIB のDBダンプ（SQLite）を取り込む。"""
+    index = get_index()
+    if index is None:
+        raise click.ClickException("LYRICS_INDEX_PATH が無効です")
+    n = index.import_lrclib_dump(dump_path, batch=batch, progress=lambda n: click.echo(f"  {n} tracks"))
+    click.echo(f"imported {n} tracks (total {index.count()})")
+
+@lyrics_index_cli.command("stats")
+def lyrics_index_stats():
+    """登録件数を表示する。"""
+    index = get_index()
+    click.echo(f"tracks: {index.count() if index else 'disabled'}")
+
+app.cli.add_command(lyrics_index_cli)
+
+# ==============================
+# CLI: 歌詞・訳の事前キャッシュ（flask warm-cache ...）
+# ==============================
+import warm_cache
+from cache_store import cache_db_path
+
+@app.cli.command("warm-cache")
+@click.argument("playlists", nargs=-1)
+@click.option("--tracks", "tracks_file", type=click.Path(exists=True, dir_okay=False),
+              help="曲ID（URI・URL も可）を1行に1つ書いたファイル")
+@click.option("--concurrency", default=warm_cache.WARM_CONCURRENCY, show_default=True, help="同時に温める曲数")
+@click.option("--lrclib-rate", default=warm_cache.WARM_LRCLIB_RATE, show_default=True,
+              help="LRCLIB へ1秒あたり何曲まで（0 で無制限）")
+@click.option("--progress", "progress_path", default=warm_cache.WARM_PROGRESS_PATH, show_default=True,
+              help="進捗ファイル（済んだ曲は次回飛ばす）")
+@click.option("--restart", is_flag=True, help="進捗ファイルを無視して最初からやり直す")
+@click.option("--no-translate", is_flag=True, help="歌詞だけ取る")
+def warm_cache_command(playlists, tracks_file, concurrency, lrclib_rate, progress_path, restart, no_translate):
+    """プレイリスト（ID・URI・URL）や曲ID一覧の歌詞と訳をキャッシュに入れておく。"""
+    if not playlists and not tracks_file:
+        raise click.UsageError("プレイリストか --tracks のどちらかを指定してください")
+    if not cache_db_path():
+        click.echo("warning: CACHE_DB_PATH が無効なので、温めた結果はこのプロセスが終わると消えます", err=True)
+    playlist_ids = []
+    for p in playlists:
+        pid = warm_cache.spotify_id(p, "playlist")
+        if pid is None:
+            raise click.BadParameter(f"not a playlist id: {p}", param_hint="PLAYLISTS")
+        playlist_ids.append(pid)
+
+    openai_client = None
+    if not no_translate:
+        if openai_configured():
+            openai_client = get_openai_client()
+        else:
+            click.echo("OPENAI_API_KEY が無いので歌詞だけ取ります", err=True)
+
+    sp = make_app_spotify_client(BACKGROUND)
+
+    def tracks():
+        for pid in playlist_ids:
+            yield from warm_cache.playlist_tracks(sp, pid)
+        if tracks_file:
+            yield from warm_cache.fetch_tracks(sp, warm_cache.read_track_ids(tracks_file))
+
+    done = 0
+    def on_result(track, result):
+        nonlocal done
+        done += 1
+        artists = track.get("artists") or []
+        click.echo(f"  [{done}] {result:<11} {track.get('name')} / {artists[0]['name'] if artists else ''}")
+
+    progress = warm_cache.Progress(progress_path or None, restart=restart, translate=openai_client is not None)
+    started = time.time()
+    try:
+        counts = warm_cache.warm_tracks(tracks(), progress, openai_client, concurrency=concurrency,
+                                        lrclib_rate=lrclib_rate, on_result=on_result)
+    except KeyboardInterrupt:
+        raise click.Abort()   # 済んだ分は進捗ファイルに書いてある
+    click.echo(" ".join(f"{k}={v}" for k, v in counts.items()) + f" ({time.time() - started:.0f}s)")
+    if counts["unavailable"] or counts["error"]:
+        click.echo("取れなかった曲があります。同じコマンドをもう一度実行すると、その曲だけやり直します")
+
 # ==============================
 # エントリーポイント
 # ==============================
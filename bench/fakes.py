@@ -0,0 +1,288 @@
+# bench/fakes.py
+# 負荷試験用のローカル代替サーバ（Spotify Web API / LRCLIB / OpenAI chat completions）
+import sys
+import json
+import time
+import random
+import threading
+import hashlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class Fault:
+    """遅延とエラー注入の設定（サービスごと）。"""
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0,
+                 error_rate: float = 0, rate_limit_rate: float = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+
+    def sleep(self):
+        ms = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if ms > 0:
+            time.sleep(ms / 1000)
+
+    def pick_error(self):
+        r = random.random()
+        if r < self.rate_limit_rate:
+            return 429
+        if r < self.rate_limit_rate + self.error_rate:
+            return 503
+        return None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    service = None   # FakeService
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else b""
+
+    def _send(self, status: int, payload=None, headers=None):
+        raw = b"" if payload is None else json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        if payload is not None:
+            self.send_header("Content-Type", "application/json")
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        if raw:
+            self.wfile.write(raw)
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        path = url.path.rstrip("/") or "/"
+        svc = self.service
+        svc.count(method, path)
+        svc.fault.sleep()
+        err = svc.fault.pick_error()
+        if err == 429:
+            return self._send(429, {"error": {"status": 429, "message": "rate limited"}}, {"Retry-After": "1"})
+        if err:
+            return self._send(err, {"error": {"status": err, "message": "injected"}})
+        svc.handle(self, method, path, {k: v[0] for k, v in parse_qs(url.query).items()}, self._body())
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # アプリ停止時の切断などは無視する
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeService:
+    name = "fake"
+
+    def __init__(self, fault: Fault):
+        self.fault = fault
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.server = None
+
+    def count(self, method, path):
+        with self._lock:
+            self.calls[f"{method} {path}"] += 1
+
+    def handle(self, h: _Handler, method, path, query, body):
+        h._send(404, {"error": "not found"})
+
+    def start(self, port: int = 0) -> str:
+        handler = type(f"{self.name}Handler", (_Handler,), {"service": self})
+        self.server = _Server(("127.0.0.1", port), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+
+    def total_calls(self) -> int:
+        with self._lock:
+            return sum(self.calls.values())
+
+
+# ==============================
+# Spotify
+# ==============================
+CATALOG = [
+    {
+        "id": f"bench{i:02d}",
+        "name": f"Bench Song {i:02d}",
+        "uri": f"spotify:track:bench{i:02d}",
+        "duration_ms": 180000 + i * 3000,
+        "artists": [{"name": f"Bench Artist {i % 5}"}],
+        "album": {"name": f"Bench Album {i % 3}", "images": [{"url": "https://example.invalid/a.png"}]},
+        "type": "track",
+    }
+    for i in range(20)
+]
+
+
+class FakeSpotify(FakeService):
+    """
+    ユーザー（アクセストークン）ごとに CATALOG を順に再生している体で返す。
+    1曲は track_seconds 秒（実時間）で次へ進む。
+    """
+    name = "spotify"
+
+    def __init__(self, fault: Fault, track_seconds: float = 30):
+        super().__init__(fault)
+        self.track_seconds = track_seconds
+        self._issued = 0
+
+    def _position(self, token: str):
+        offset = int(hashlib.sha1(token.encode()).hexdigest()[:6], 16)
+        t = time.time() + offset
+        idx = int(t // self.track_seconds) % len(CATALOG)
+        frac = (t % self.track_seconds) / self.track_seconds
+        return idx, frac
+
+    def _now_playing(self, token):
+        idx, frac = self._position(token)
+        item = CATALOG[idx]
+        return {
+            "is_playing": True,
+            "progress_ms": int(item["duration_ms"] * frac),
+            "item": item,
+            "timestamp": int(time.time() * 1000),
+            "device": {"id": "bench-device", "is_active": True},
+        }
+
+    def handle(self, h, method, path, query, body):
+        token = (h.headers.get("Authorization") or "").replace("Bearer ", "")
+        if path == "/api/token":
+            with self._lock:
+                self._issued += 1
+                n = self._issued
+            return h._send(200, {
+                "access_token": f"bench-token-{n}", "token_type": "Bearer",
+                "expires_in": 3600, "refresh_token": f"bench-refresh-{n}", "scope": "",
+            })
+        if path == "/v1/me":
+            return h._send(200, {"id": "bench", "country": "JP", "display_name": "bench", "images": []})
+        if path == "/v1/me/player/currently-playing":
+            return h._send(200, self._now_playing(token))
+        if path == "/v1/me/player" and method == "GET":
+            return h._send(200, self._now_playing(token))
+        if path == "/v1/me/player/devices":
+            return h._send(200, {"devices": [{"id": "bench-device", "is_active": True}]})
+        if path == "/v1/me/player/queue" and method == "GET":
+            idx, _ = self._position(token)
+            q = [CATALOG[(idx + k) % len(CATALOG)] for k in range(1, 6)]
+            return h._send(200, {"currently_playing": CATALOG[idx], "queue": q})
+        if path in ("/v1/me/player", "/v1/me/player/play", "/v1/me/player/queue"):
+            return h._send(204)
+        if path == "/v1/search":
+            limit = int(query.get("limit", 12))
+            offset = int(query.get("offset", 0))
+            items = [CATALOG[(offset + k) % len(CATALOG)] for k in range(limit)]
+            return h._send(200, {"tracks": {"items": items, "total": 200}})
+        if path == "/v1/tracks":
+            ids = (query.get("ids") or "").split(",")
+            return h._send(200, {"tracks": [t for t in CATALOG if t["id"] in ids]})
+        return h._send(404, {"error": {"status": 404, "message": "not found"}})
+
+
+# ==============================
+# LRCLIB
+# ==============================
+def _lyrics_for(track_name: str) -> str:
+    verse = [f"{track_name} verse line {k}" for k in range(8)]
+    chorus = ["Oh we sing along tonight", "Hold on to the melody", "Oh we sing along tonight", ""]
+    lines = verse[:4] + chorus + verse[4:] + chorus + chorus
+    return "\n".join(f"[{(i * 4) // 60:02d}:{(i * 4) % 60:02d}.00] {ln}" for i, ln in enumerate(lines))
+
+
+class FakeLrclib(FakeService):
+    """CATALOG のうち7曲に1曲は歌詞なし（/get 404・/search 空）。"""
+    name = "lrclib"
+
+    def _entry(self, track_name, artist_name):
+        i = next((k for k, t in enumerate(CATALOG) if t["name"] == track_name), None)
+        if i is None or i % 7 == 6:
+            return None
+        t = CATALOG[i]
+        return {
+            "id": 1000 + i, "trackName": t["name"], "artistName": artist_name,
+            "albumName": t["album"]["name"], "duration": t["duration_ms"] / 1000,
+            "instrumental": False, "plainLyrics": None, "syncedLyrics": _lyrics_for(t["name"]),
+        }
+
+    def handle(self, h, method, path, query, body):
+        if path == "/api/get":
+            ent = self._entry(query.get("track_name"), query.get("artist_name"))
+            return h._send(200, ent) if ent else h._send(404, {"message": "not found"})
+        if path == "/api/search":
+            q = query.get("q") or ""
+            hits = [self._entry(t["name"], t["artists"][0]["name"]) for t in CATALOG if t["name"] in q]
+            return h._send(200, [x for x in hits if x])
+        return h._send(404, {"message": "not found"})
+
+
+# ==============================
+# OpenAI chat completions
+# ==============================
+class FakeOpenAI(FakeService):
+    """入力行の本文の先頭に「訳:」を付けて返す。stream=true なら SSE で少しずつ返す。"""
+    name = "openai"
+
+    def __init__(self, fault: Fault, per_line_ms: float = 20):
+        super().__init__(fault)
+        self.per_line_ms = per_line_ms
+
+    def handle(self, h, method, path, query, body):
+        if path != "/v1/chat/completions":
+            return h._send(404, {"error": {"message": "not found"}})
+        req = json.loads(body or b"{}")
+        content = req["messages"][-1]["content"]
+        src = content.split("\n\n", 1)[1] if "\n\n" in content else content
+        # 「番号<TAB>歌詞」→「番号<TAB>訳:歌詞」
+        lines = [ln.replace("\t", "\t訳:", 1) for ln in src.split("\n")]
+        out = "\n".join(lines)
+        usage = {"prompt_tokens": len(content) // 3, "completion_tokens": len(out) // 2}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": req.get("model", "bench")}
+
+        if not req.get("stream"):
+            time.sleep(self.per_line_ms * len(lines) / 1000)
+            return h._send(200, {
+                **base, "object": "chat.completion", "usage": usage,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": out}}],
+            })
+
+        h.send_response(200)
+        h.send_header("Content-Type", "text/event-stream")
+        h.send_header("Connection", "close")
+        h.end_headers()
+        for k, ln in enumerate(lines):
+            time.sleep(self.per_line_ms / 1000)
+            piece = ln + ("\n" if k < len(lines) - 1 else "")
+            chunk = {**base, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            h.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            h.wfile.flush()
+        if (req.get("stream_options") or {}).get("include_usage"):
+            chunk = {**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+            h.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        h.wfile.write(b"data: [DONE]\n\n")
+        h.close_connection = True
@@ -0,0 +1,373 @@
+# bench/run.py
+# 外部サービスをローカルの代替サーバ（bench/fakes.py）に差し替えて負荷をかける
+#
+# 例:
+#   python -m bench.run --users 50 --duration 30
+#   python -m bench.run --server gunicorn --serve-mode gevent --users 200 --sse-ratio 0.5
+#   python -m bench.run --server gunicorn --serve-mode sync --label sync   # 比較用
+#
+# 結果は bench/results/<label>-<日時>.json に保存し、同じ label の前回結果と比べて
+# p95 の悪化・スループットの低下が --threshold（%）を超えたら REGRESSION と表示する。
+import os
+import sys
+import json
+import time
+import glob
+import random
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+
+import requests
+
+from bench.fakes import Fault, FakeSpotify, FakeLrclib, FakeOpenAI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+
+
+def free_port() -> int:
+    import socket
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(sorted_vals, p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(p / 100 * (len(sorted_vals) - 1)))))
+    return sorted_vals[k]
+
+
+# ==============================
+# 計測
+# ==============================
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)   # endpoint -> [ms]
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = defaultdict(int)
+        self.sse_events = 0
+
+    def add(self, name: str, ms: float, status):
+        with self._lock:
+            self.latencies[name].append(ms)
+            self.statuses[name][str(status)] += 1
+
+    def error(self, name: str):
+        with self._lock:
+            self.errors[name] += 1
+
+    def summary(self, elapsed: float, workers: int) -> dict:
+        endpoints = {}
+        total = 0
+        for name, vals in sorted(self.latencies.items()):
+            vals = sorted(vals)
+            total += len(vals)
+            endpoints[name] = {
+                "count": len(vals),
+                "rps": round(len(vals) / elapsed, 2),
+                "p50_ms": round(_percentile(vals, 50), 1),
+                "p95_ms": round(_percentile(vals, 95), 1),
+                "p99_ms": round(_percentile(vals, 99), 1),
+                "statuses": dict(self.statuses[name]),
+                "errors": self.errors.get(name, 0),
+            }
+        return {
+            "requests": total,
+            "rps": round(total / elapsed, 2),
+            "rps_per_worker": round(total / elapsed / max(1, workers), 2),
+            "sse_events": self.sse_events,
+            "endpoints": endpoints,
+        }
+
+
+def _call(rec: Recorder, sess: requests.Session, name: str, method: str, url: str, **kw):
+    t0 = time.perf_counter()
+    try:
+        r = sess.request(method, url, timeout=kw.pop("timeout", 30), **kw)
+    except requests.RequestException:
+        rec.error(name)
+        return None
+    rec.add(name, (time.perf_counter() - t0) * 1000, r.status_code)
+    return r
+
+
+# ==============================
+# 仮想ユーザー
+# ==============================
+def _virtual_user(base: str, args, rec: Recorder, stop: threading.Event, seed: int):
+    rnd = random.Random(seed)
+    sess = requests.Session()
+    r = _call(rec, sess, "GET /callback", "GET", f"{base}/callback?code=bench-{seed}", allow_redirects=False)
+    if r is None or r.status_code != 302:
+        return
+
+    if rnd.random() < args.sse_ratio:
+        threading.Thread(target=_sse_listener, args=(base, sess.cookies.copy(), rec, stop), daemon=True).start()
+
+    last_track = None
+    while not stop.is_set():
+        r = _call(rec, sess, "GET /api/currently_playing", "GET", f"{base}/api/currently_playing")
+        track = (r.json() if r is not None and r.ok else {}).get("track_id")
+
+        if track and track != last_track:
+            last_track = track
+            r = _call(rec, sess, "GET /api/lyrics_timed", "GET", f"{base}/api/lyrics_timed")
+            body = r.json() if r is not None and r.ok else {}
+            if body.get("ok"):
+                lines = [text for _, text in body["timed"]]
+                if args.stream_translate:
+                    _call(rec, sess, "POST /api/translate_lines/stream", "POST",
+                          f"{base}/api/translate_lines/stream", json={"lines": lines})
+                else:
+                    _call(rec, sess, "POST /api/translate_lines", "POST",
+                          f"{base}/api/translate_lines", json={"lines": lines})
+
+        if rnd.random() < args.search_ratio:
+            q = rnd.choice(["bench", "bench song", "artist", "album"])
+            offset = rnd.choice([0, 0, 0, 12, 24])
+            _call(rec, sess, "GET /api/search_tracks", "GET",
+                  f"{base}/api/search_tracks", params={"q": q, "limit": 12, "offset": offset})
+
+        stop.wait(args.think_ms / 1000 * rnd.uniform(0.5, 1.5))
+
+
+def _sse_listener(base: str, cookies, rec: Recorder, stop: threading.Event):
+    """プレイヤーページ相当：SSE をつなぎっぱなしにしてイベント数を数える。"""
+    sess = requests.Session()
+    sess.cookies.update(cookies)
+    while not stop.is_set():
+        try:
+            with sess.get(f"{base}/api/now_playing/events", stream=True, timeout=(5, 60)) as r:
+                if r.status_code != 200:
+                    return
+                for line in r.iter_lines():
+                    if stop.is_set():
+                        return
+                    if line.startswith(b"event:"):
+                        with rec._lock:
+                            rec.sse_events += 1
+        except requests.RequestException:
+            rec.error("GET /api/now_playing/events")
+            stop.wait(1)
+
+
+# ==============================
+# アプリの起動
+# ==============================
+def app_env(port: int, sp_base: str, lr_base: str, oai_base: str, tmp: str) -> dict:
+    """外部サービスを代替サーバに向けたアプリの環境変数。"""
+    return dict(
+        os.environ,
+        APP_ENV="development",
+        FLASK_SECRET_KEY="bench",
+        METRICS_TOKEN="bench",
+        SPOTIPY_CLIENT_ID="bench",
+        SPOTIPY_CLIENT_SECRET="bench",
+        SPOTIPY_REDIRECT_URI=f"http://127.0.0.1:{port}/callback",
+        SPOTIFY_API_BASE=f"{sp_base}/v1/",
+        SPOTIFY_ACCOUNTS_BASE=sp_base,
+        LRCLIB_BASE=f"{lr_base}/api",
+        OPENAI_API_KEY="bench",
+        OPENAI_BASE_URL=f"{oai_base}/v1",
+        CACHE_DB_PATH=os.path.join(tmp, "cache.db"),
+        LYRICS_INDEX_PATH=os.path.join(tmp, "lyrics_index.db"),
+        TOKEN_STORE="sqlite",
+        TOKEN_STORE_PATH=os.path.join(tmp, "tokens.db"),
+        LOG_FILE=os.path.join(tmp, "app.log"),
+    )
+
+
+def spawn_app(args, env: dict, port: int) -> subprocess.Popen:
+    if args.server == "gunicorn":
+        env = dict(env, SERVE_MODE=args.serve_mode, WEB_CONCURRENCY=str(args.workers))
+        cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+               "-b", f"127.0.0.1:{port}", "--log-level", "warning", "app:app"]
+    else:
+        cmd = [sys.executable, "-m", "flask", "--app", "app", "run",
+               "--with-threads", "--port", str(port)]
+    return subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+                            stderr=None if args.verbose else subprocess.DEVNULL)
+
+
+def wait_ready(proc: subprocess.Popen, port: int, timeout: float = 30, interval: float = 0.2):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"app exited with {proc.returncode}")
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/health", timeout=1).ok:
+                return
+        except requests.RequestException:
+            time.sleep(interval)
+    proc.kill()
+    raise RuntimeError("app did not become ready")
+
+
+def _start_app(args, env: dict, port: int) -> subprocess.Popen:
+    proc = spawn_app(args, env, port)
+    wait_ready(proc, port)
+    return proc
+
+
+def stop_app(proc: subprocess.Popen):
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+# ==============================
+# 前回結果との比較
+# ==============================
+def _previous_result(label: str):
+    files = sorted(glob.glob(os.path.join(RESULTS_DIR, f"{label}-*.json")))
+    if not files:
+        return None, None
+    with open(files[-1], encoding="utf-8") as f:
+        return files[-1], json.load(f)
+
+
+def compare(prev: dict, curr: dict, threshold: float) -> list:
+    """悪化した項目の説明を返す（空なら問題なし）。"""
+    problems = []
+    p, c = prev["summary"], curr["summary"]
+    if p["rps"] and c["rps"] < p["rps"] * (1 - threshold / 100):
+        problems.append(f"rps {p['rps']} -> {c['rps']}")
+    for name, ce in c["endpoints"].items():
+        pe = p["endpoints"].get(name)
+        if not pe or not pe["p95_ms"]:
+            continue
+        if ce["p95_ms"] > pe["p95_ms"] * (1 + threshold / 100):
+            problems.append(f"{name} p95 {pe['p95_ms']}ms -> {ce['p95_ms']}ms")
+    for svc, n in curr["upstream_per_request"].items():
+        pn = prev.get("upstream_per_request", {}).get(svc)
+        if pn and n > pn * (1 + threshold / 100):
+            problems.append(f"{svc} calls/request {pn} -> {n}")
+    return problems
+
+
+def _print_report(result: dict):
+    s = result["summary"]
+    print(f"\n== {result['label']} ({result['config']['server']}"
+          f"{'/' + result['config']['serve_mode'] if result['config']['server'] == 'gunicorn' else ''}"
+          f", users={result['config']['users']}, {result['elapsed_s']}s) ==")
+    print(f"requests={s['requests']} rps={s['rps']} rps/worker={s['rps_per_worker']} sse_events={s['sse_events']}")
+    print(f"{'endpoint':40} {'count':>7} {'p50':>8} {'p95':>8} {'p99':>8}  statuses")
+    for name, e in s["endpoints"].items():
+        print(f"{name:40} {e['count']:>7} {e['p50_ms']:>8} {e['p95_ms']:>8} {e['p99_ms']:>8}  "
+              f"{e['statuses']}{' errors=' + str(e['errors']) if e['errors'] else ''}")
+    print("upstream calls:")
+    for svc, calls in result["upstream"].items():
+        print(f"  {svc}: {sum(calls.values())} ({result['upstream_per_request'][svc]}/req)")
+        for k, v in sorted(calls.items(), key=lambda kv: -kv[1]):
+            print(f"    {k}: {v}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="ローカル代替サーバを使った負荷試験")
+    ap.add_argument("--server", choices=["flask", "gunicorn"], default="flask")
+    ap.add_argument("--serve-mode", choices=["sync", "gthread", "gevent"], default="gthread")
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--users", type=int, default=20)
+    ap.add_argument("--duration", type=float, default=20, help="計測時間（秒）")
+    ap.add_argument("--think-ms", type=float, default=1000, help="ユーザー操作の間隔（平均）")
+    ap.add_argument("--search-ratio", type=float, default=0.2)
+    ap.add_argument("--sse-ratio", type=float, default=0.0, help="SSE を張りっぱなしにするユーザーの割合")
+    ap.add_argument("--stream-translate", action="store_true", help="翻訳にストリーミング版を使う")
+    ap.add_argument("--track-seconds", type=float, default=15, help="代替 Spotify で1曲が進む実時間")
+    ap.add_argument("--spotify-latency", type=float, default=80)
+    ap.add_argument("--lrclib-latency", type=float, default=150)
+    ap.add_argument("--openai-latency", type=float, default=400)
+    ap.add_argument("--jitter", type=float, default=0.5, help="遅延に足す揺らぎ（遅延に対する比率）")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="各サービスが 503 を返す確率")
+    ap.add_argument("--rate-limit-rate", type=float, default=0.0, help="Spotify/OpenAI が 429 を返す確率")
+    ap.add_argument("--label", default=None, help="結果ファイル名・比較のキー（既定: server[-serve_mode]）")
+    ap.add_argument("--threshold", type=float, default=20, help="回帰とみなす悪化率（%%）")
+    ap.add_argument("--fail-on-regression", action="store_true")
+    ap.add_argument("--no-save", action="store_true")
+    ap.add_argument("--verbose", action="store_true", help="アプリの stderr を表示する")
+    args = ap.parse_args(argv)
+    label = args.label or (args.server if args.server == "flask" else f"gunicorn-{args.serve_mode}")
+
+    def fault(ms, rl=0.0):
+        return Fault(ms, ms * args.jitter, args.error_rate, rl)
+
+    spotify = FakeSpotify(fault(args.spotify_latency, args.rate_limit_rate), track_seconds=args.track_seconds)
+    lrclib = FakeLrclib(fault(args.lrclib_latency))
+    oai = FakeOpenAI(fault(args.openai_latency, args.rate_limit_rate))
+    sp_base, lr_base, oai_base = spotify.start(), lrclib.start(), oai.start()
+
+    port = free_port()
+    tmp = tempfile.mkdtemp(prefix="bench-")
+    env = app_env(port, sp_base, lr_base, oai_base, tmp)
+
+    proc = _start_app(args, env, port)
+    base = f"http://127.0.0.1:{port}"
+    rec = Recorder()
+    stop = threading.Event()
+    try:
+        users = [threading.Thread(target=_virtual_user, args=(base, args, rec, stop, i), daemon=True)
+                 for i in range(args.users)]
+        t0 = time.time()
+        for t in users:
+            t.start()
+            time.sleep(min(0.02, 1.0 / max(1, args.users)))   # 一斉ログインを少しだけばらす
+        stop.wait(args.duration)
+        stop.set()
+        for t in users:
+            t.join(timeout=30)
+        elapsed = time.time() - t0
+        try:
+            app_stats = requests.get(f"{base}/api/cache_stats", timeout=5, headers={"Authorization": "Bearer bench"}).json()
+        except (requests.RequestException, ValueError):
+            app_stats = None
+    finally:
+        stop_app(proc)
+        for svc in (spotify, lrclib, oai):
+            svc.stop()
+
+    summary = rec.summary(elapsed, args.workers if args.server == "gunicorn" else 1)
+    upstream = {svc.name: dict(svc.calls) for svc in (spotify, lrclib, oai)}
+    result = {
+        "label": label,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(t0)),
+        "elapsed_s": round(elapsed, 1),
+        "config": {k: v for k, v in vars(args).items() if k not in ("no_save", "verbose", "fail_on_regression")},
+        "summary": summary,
+        "upstream": upstream,
+        "upstream_per_request": {
+            name: round(sum(calls.values()) / max(1, summary["requests"]), 3) for name, calls in upstream.items()
+        },
+        "app_stats": app_stats,
+    }
+    _print_report(result)
+
+    prev_path, prev = _previous_result(label)
+    problems = compare(prev, result, args.threshold) if prev else []
+    if prev:
+        print(f"\ncompared with {os.path.relpath(prev_path, ROOT)}:")
+        for p in problems:
+            print(f"  REGRESSION {p}")
+        if not problems:
+            print("  no regression")
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{label}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"saved {os.path.relpath(path, ROOT)}")
+
+    return 1 if problems and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+# bench/startup.py
+# コールドスタートの計測（import 時間・起動から応答可能まで・最初のリクエストの遅さ）
+#
+# 例:
+#   python -m bench.startup
+#   python -m bench.startup --server gunicorn --serve-mode gthread --runs 5
+#
+# 各項目の中央値が予算（--*-budget-ms）を超えたら OVER BUDGET と表示し、終了コード 1 を返す。
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+import requests
+
+from bench.fakes import Fault, FakeSpotify, FakeLrclib, FakeOpenAI
+from bench.run import ROOT, app_env, free_port, spawn_app, stop_app, wait_ready
+
+_IMPORT_SNIPPET = "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"
+
+
+def measure_import(env: dict) -> float:
+    """新しいインタプリタで `import app` にかかる秒数。"""
+    out = subprocess.run([sys.executable, "-c", _IMPORT_SNIPPET], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def _timed(sess: requests.Session, method: str, url: str, **kw) -> float:
+    t0 = time.perf_counter()
+    r = sess.request(method, url, timeout=30, **kw)
+    r.raise_for_status()
+    return time.perf_counter() - t0
+
+
+def measure_boot(args, env: dict, port: int) -> dict:
+    """起動してから /health が返るまでと、その直後の最初のリクエストそれぞれの秒数。"""
+    base = f"http://127.0.0.1:{port}"
+    t0 = time.perf_counter()
+    proc = spawn_app(args, env, port)
+    try:
+        wait_ready(proc, port, interval=0.02)
+        ready = time.perf_counter() - t0
+        sess = requests.Session()
+        first_page = _timed(sess, "GET", f"{base}/")
+        login = _timed(sess, "GET", f"{base}/callback?code=startup", allow_redirects=False)
+        first_lyrics = _timed(sess, "GET", f"{base}/api/lyrics_timed")
+        first_translate = _timed(sess, "POST", f"{base}/api/translate_lines",
+                                 json={"lines": ["hello", "world"]})
+    finally:
+        stop_app(proc)
+    return {"ready": ready, "first_page": first_page, "login": login,
+            "first_lyrics": first_lyrics, "first_translate": first_translate}
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="コールドスタートの計測と予算チェック")
+    ap.add_argument("--server", choices=["flask", "gunicorn"], default="gunicorn")
+    ap.add_argument("--serve-mode", choices=["sync", "gthread", "gevent"], default="gthread")
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--runs", type=int, default=3, help="計測回数（中央値を使う）")
+    ap.add_argument("--import-budget-ms", type=float, default=600)
+    ap.add_argument("--ready-budget-ms", type=float, default=2500, help="起動から /health が返るまで")
+    ap.add_argument("--first-request-budget-ms", type=float, default=1500,
+                    help="起動直後の各リクエスト（ページ・歌詞・翻訳）それぞれ")
+    ap.add_argument("--verbose", action="store_true", help="アプリの stderr を表示する")
+    args = ap.parse_args(argv)
+
+    # 上流の遅延は 0 にして、アプリ自身の起動コストだけを見る
+    spotify, lrclib, oai = FakeSpotify(Fault()), FakeLrclib(Fault()), FakeOpenAI(Fault(), per_line_ms=0)
+    sp_base, lr_base, oai_base = spotify.start(), lrclib.start(), oai.start()
+    samples: dict = {}
+    try:
+        for _ in range(args.runs):
+            port = free_port()
+            env = app_env(port, sp_base, lr_base, oai_base, tempfile.mkdtemp(prefix="startup-"))
+            samples.setdefault("import", []).append(measure_import(env))
+            for k, v in measure_boot(args, env, port).items():
+                samples.setdefault(k, []).append(v)
+    finally:
+        for svc in (spotify, lrclib, oai):
+            svc.stop()
+
+    budgets = {
+        "import": args.import_budget_ms,
+        "ready": args.ready_budget_ms,
+        "first_page": args.first_request_budget_ms,
+        "first_lyrics": args.first_request_budget_ms,
+        "first_translate": args.first_request_budget_ms,
+    }
+    label = args.server if args.server == "flask" else f"gunicorn-{args.serve_mode}"
+    print(f"\n== startup ({label}, runs={args.runs}) ==")
+    print(f"{'phase':<18}{'median':>10}{'max':>10}{'budget':>10}")
+    over = []
+    for k, vals in samples.items():
+        med, mx = statistics.median(vals) * 1000, max(vals) * 1000
+        budget = budgets.get(k)
+        mark = ""
+        if budget is not None and med > budget:
+            mark = "  OVER BUDGET"
+            over.append(k)
+        print(f"{k:<18}{med:>10.0f}{mx:>10.0f}{(f'{budget:.0f}' if budget else '-'):>10}{mark}")
+    return 1 if over else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
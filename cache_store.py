@@ -0,0 +1,281 @@
+# cache_store.py
+# 結果キャッシュ（プロセス内LRU ＋ SQLite ディスク層）
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+# 「キャッシュに無い」を表す番兵（None はネガティブキャッシュとして有効な値）
+MISS = object()
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(__file__), "cache.db")
+# 期限切れ行の掃除間隔（開いたとき＋書き込みのついでにこの間隔で）。0 なら開いたときだけ
+CACHE_PURGE_INTERVAL = float(os.getenv("CACHE_PURGE_INTERVAL", "3600"))
+
+
+def cache_db_path() -> Optional[str]:
+    """CACHE_DB_PATH が空文字ならディスク層を無効化。"""
+    path = os.getenv("CACHE_DB_PATH", DEFAULT_DB_PATH)
+    return path or None
+
+
+# ==============================
+# プロセス内 LRU（TTL付き）
+# ==============================
+class LRUCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (value, stored_at, expires_at)
+        self._lock = threading.Lock()
+
+    def get_entry(self, key: str):
+        """(value, stored_at) を返す。無い/期限切れなら None。"""
+        now = time.time()
+        with self._lock:
+            ent = self._data.get(key)
+            if ent is None:
+                return None
+            value, stored_at, expires_at = ent
+            if expires_at <= now:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value, stored_at
+
+    def get(self, key: str, default: Any = MISS) -> Any:
+        ent = self.get_entry(key)
+        return default if ent is None else ent[0]
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None, stored_at: Optional[float] = None):
+        stored_at = stored_at or time.time()
+        expires_at = stored_at + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, stored_at, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# ==============================
+# SQLite ディスク層（namespace 単位の JSON KV）
+# ==============================
+class SqliteStore:
+    """
+    期限切れの行は読んだときに消すほか、開いたときと set() のついでに purge_interval ごとにまとめて消す
+    （読まれないまま期限が切れた行でファイルが膨らまないように）。
+    """
+    def __init__(self, path: str, namespace: str, purge_interval: float = CACHE_PURGE_INTERVAL):
+        self.path = path
+        self.namespace = namespace
+        self.purge_interval = purge_interval
+        self._local = threading.local()
+        self._purge_lock = threading.Lock()
+        self._next_purge = 0.0
+        self._init_schema()
+        self._maybe_purge()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        # gunicorn の preload で親プロセスが開いた接続は、fork 後のワーカーでは使わない
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_schema(self):
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " ns TEXT NOT NULL, k TEXT NOT NULL, v TEXT,"
+            " stored_at REAL NOT NULL, expires_at REAL NOT NULL,"
+            " PRIMARY KEY (ns, k))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires_at)")
+        conn.commit()
+
+    def get_entry(self, key: str):
+        row = self._conn().execute(
+            "SELECT v, stored_at, expires_at FROM kv WHERE ns=? AND k=?",
+            (self.namespace, key),
+        ).fetchone()
+        if row is None:
+            return None
+        v, stored_at, expires_at = row
+        if expires_at <= time.time():
+            self.delete(key)
+            return None
+        return json.loads(v), stored_at, expires_at
+
+    def set(self, key: str, value: Any, ttl: float, stored_at: Optional[float] = None):
+        stored_at = stored_at or time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO kv (ns, k, v, stored_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+            (self.namespace, key, json.dumps(value, ensure_ascii=False), stored_at, stored_at + ttl),
+        )
+        conn.commit()
+        self._maybe_purge()
+
+    def delete(self, key: str):
+        conn = self._conn()
+        conn.execute("DELETE FROM kv WHERE ns=? AND k=?", (self.namespace, key))
+        conn.commit()
+
+    def purge_expired(self) -> int:
+        conn = self._conn()
+        cur = conn.execute(
+            "DELETE FROM kv WHERE ns=? AND expires_at<=?", (self.namespace, time.time())
+        )
+        conn.commit()
+        return cur.rowcount
+
+    def _maybe_purge(self):
+        now = time.time()
+        if now < self._next_purge or not self._purge_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_purge = now + self.purge_interval if self.purge_interval > 0 else float("inf")
+            self.purge_expired()
+        except sqlite3.Error:
+            pass   # 掃除できなくても読み書きは続ける（次の間隔でまた試す）
+        finally:
+            self._purge_lock.release()
+
+
+# ==============================
+# 2層キャッシュ（LRU → SQLite）＋ ネガティブキャッシュ ＋ 統計
+# ==============================
+class TieredCache:
+    """
+    get() はキャッシュに無ければ MISS を返す。
+    None を set() すると「見つからなかった」結果として negative_ttl だけ保持。
+    stale_ttl を指定すると期限切れ後もその間は消さずに残し、get_entry() で「古い値」として返す
+    （上流が落ちているときや、裏で取り直している間に使う）。get() は新鮮な値だけを返す。
+    """
+    def __init__(
+        self,
+        name: str,
+        maxsize: int = 1024,
+        ttl: float = 7 * 24 * 3600,
+        negative_ttl: float = 6 * 3600,
+        db_path: Optional[str] = None,
+        stale_ttl: float = 0,
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl + stale_ttl)
+        self.disk: Optional[SqliteStore] = None
+        if db_path:
+            try:
+                self.disk = SqliteStore(db_path, namespace=name)
+            except sqlite3.Error:
+                self.disk = None  # ディスクが使えなくてもメモリ層だけで動かす
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "negative_hits": 0, "stale_hits": 0, "misses": 0, "sets": 0}
+
+    def _count(self, field: str):
+        with self._lock:
+            self._stats[field] += 1
+
+    def get(self, key: str) -> Any:
+        return self.get_first([key])
+
+    def get_first(self, keys) -> Any:
+        """複数キーを順に引き、最初に見つかった値を返す（ミスは1回として数える）。"""
+        ent = self.get_first_entry(keys, allow_stale=False)
+        return MISS if ent is None else ent[0]
+
+    def get_entry(self, key: str):
+        """(value, stale) を返す。無ければ None。stale は期限切れ（stale_ttl の猶予内）の値。"""
+        return self.get_first_entry([key])
+
+    def get_first_entry(self, keys, allow_stale: bool = True):
+        """get_entry() の複数キー版。新鮮な値があればそれを、無ければ最初に見つかった古い値を返す。"""
+        stale = MISS
+        for key in keys:
+            ent = self._lookup(key)
+            if ent is None:
+                continue
+            value, is_stale, layer = ent
+            if not is_stale:
+                self._count(f"{layer}_hits" if value is not None else "negative_hits")
+                return value, False
+            if stale is MISS:
+                stale = value
+        if allow_stale and stale is not MISS:
+            self._count("stale_hits")
+            return stale, True
+        self._count("misses")
+        return None
+
+    def _is_stale(self, value: Any, stored_at: float) -> bool:
+        ttl = self.negative_ttl if value is None else self.ttl
+        return stored_at + ttl <= time.time()
+
+    def _lookup(self, key: str):
+        """(value, stale, 層) を返す。無ければ None。"""
+        ent = self.memory.get_entry(key)
+        if ent is not None:
+            return ent[0], self._is_stale(ent[0], ent[1]), "memory"
+
+        if self.disk is not None:
+            try:
+                dent = self.disk.get_entry(key)
+            except sqlite3.Error:
+                dent = None
+            if dent is not None:
+                value, stored_at, expires_at = dent
+                # メモリ層へ昇格（残りTTLを引き継ぐ）
+                self.memory.set(key, value, ttl=expires_at - stored_at, stored_at=stored_at)
+                return value, self._is_stale(value, stored_at), "disk"
+        return None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        ttl += self.stale_ttl   # 期限切れ後も猶予の間は古い値として残す
+        now = time.time()
+        self.memory.set(key, value, ttl=ttl, stored_at=now)
+        if self.disk is not None:
+            try:
+                self.disk.set(key, value, ttl=ttl, stored_at=now)
+            except sqlite3.Error:
+                pass
+        self._count("sets")
+
+    def delete(self, key: str):
+        self.memory.delete(key)
+        if self.disk is not None:
+            try:
+                self.disk.delete(key)
+            except sqlite3.Error:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            s = dict(self._stats)
+        lookups = s["memory_hits"] + s["disk_hits"] + s["negative_hits"] + s["stale_hits"] + s["misses"]
+        s["hit_rate"] = round((lookups - s["misses"]) / lookups, 4) if lookups else 0.0
+        s["memory_size"] = len(self.memory)
+        s["disk_enabled"] = self.disk is not None
+        return s
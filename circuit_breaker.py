@@ -0,0 +1,181 @@
+# circuit_breaker.py
+# 上流（LRCLIB / OpenAI / Spotify）ごとのサーキットブレーカー
+#
+# 直近の呼び出しで失敗・遅延の割合が閾値を超えたら「開」にして、しばらくは呼ばずに即失敗させる。
+# 開いてから OPEN_SECONDS 経ったら「半開」にして少数の試し呼び出しだけ通し、成功すれば元に戻す。
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+from metrics import REGISTRY
+
+WINDOW_SECONDS = float(os.getenv("CIRCUIT_WINDOW_SECONDS", "30"))   # 失敗率を見る期間
+MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "5"))                # これ未満の呼び出し数では判定しない
+FAILURE_RATIO = float(os.getenv("CIRCUIT_FAILURE_RATIO", "0.5"))    # 失敗＋遅延の割合がこれ以上で開く
+OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "20"))       # 開いてから試し呼び出しまで
+HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", "1"))  # 半開で同時に通す数
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+REJECTED = REGISTRY.counter(
+    "tune_circuit_rejected_total", "サーキットが開いていたため送らなかった呼び出し", ("service",),
+)
+TRANSITIONS = REGISTRY.counter(
+    "tune_circuit_transitions_total", "サーキットの状態遷移", ("service", "state"),
+)
+
+
+class CircuitOpenError(Exception):
+    """サーキットが開いている（上流を呼ばずに失敗した）。retry_after 秒後に試し呼び出しが通る。"""
+    def __init__(self, service: str, retry_after: float):
+        super().__init__(f"{service} unavailable (circuit open, retry in {retry_after:.0f}s)")
+        self.service = service
+        self.retry_after = retry_after
+
+
+class _Call:
+    __slots__ = ("failed",)
+
+    def __init__(self):
+        self.failed = False
+
+
+class CircuitBreaker:
+    """
+    guard() で囲んだ呼び出しの成否と所要時間を記録する。
+    例外、または slow_seconds を超えた呼び出しを「失敗」と数える。
+    is_failure で数えない例外（404 や 4xx など上流の不調ではないもの）を除ける。
+    """
+    def __init__(self, service: str, slow_seconds: float,
+                 window: float = WINDOW_SECONDS, min_calls: int = MIN_CALLS,
+                 failure_ratio: float = FAILURE_RATIO, open_seconds: float = OPEN_SECONDS,
+                 half_open_probes: int = HALF_OPEN_PROBES,
+                 is_failure: Optional[Callable[[BaseException], bool]] = None):
+        self.service = service
+        self.slow_seconds = slow_seconds
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.is_failure = is_failure or (lambda e: True)
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._calls: deque = deque()   # (時刻, 失敗したか)
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            self.state = state
+            TRANSITIONS.inc(service=self.service, state=state)
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+
+    def rejecting(self) -> bool:
+        """今呼んでも即失敗になるか（試し呼び出しの枠は消費しない）。"""
+        with self._lock:
+            if self.state == OPEN:
+                return time.monotonic() - self._opened_at < self.open_seconds
+            if self.state == HALF_OPEN:
+                return self._probes >= self.half_open_probes
+            return False
+
+    def _admit(self) -> bool:
+        """呼んでよければ True（半開なら試し呼び出しの枠を1つ取る）。"""
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    return False
+                self._set_state(HALF_OPEN)
+                self._probes = 0
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_probes:
+                    return False
+                self._probes += 1
+            return True
+
+    def _record(self, failed: bool):
+        now = time.monotonic()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+                if failed:
+                    self._opened_at = now
+                    self._set_state(OPEN)
+                else:
+                    self._calls.clear()
+                    self._set_state(CLOSED)
+                return
+            if self.state == OPEN:
+                return   # 開く前に始まっていた呼び出しの結果は使わない
+            self._calls.append((now, failed))
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._calls.popleft()
+            if len(self._calls) < self.min_calls:
+                return
+            failures = sum(1 for _, f in self._calls if f)
+            if failures / len(self._calls) >= self.failure_ratio:
+                self._opened_at = now
+                self._calls.clear()
+                self._set_state(OPEN)
+
+    @contextmanager
+    def guard(self):
+        """
+        開いていれば CircuitOpenError。例外を出さずに失敗を返す呼び出し（5xx レスポンスなど）は
+        `with breaker.guard() as call: ... call.failed = True` で失敗として数える。
+        """
+        if not self._admit():
+            REJECTED.inc(service=self.service)
+            raise CircuitOpenError(self.service, self.retry_after())
+        call = _Call()
+        t0 = time.monotonic()
+        try:
+            yield call
+        except BaseException as e:
+            self._record(failed=self.is_failure(e) or time.monotonic() - t0 > self.slow_seconds)
+            raise
+        self._record(failed=call.failed or time.monotonic() - t0 > self.slow_seconds)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            calls = len(self._calls)
+            failures = sum(1 for _, f in self._calls if f)
+            state = self.state
+        return {"state": state, "recent_calls": calls, "recent_failures": failures,
+                "retry_after": round(self.retry_after(), 1)}
+
+
+# 上流ごとに1つ。遅延の閾値はそれぞれの通常の所要時間に合わせる
+BREAKERS: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(service: str, slow_seconds: float, **kwargs) -> CircuitBreaker:
+    """service ごとに1つだけ作る（2回目以降は既存のものを返す）。"""
+    b = BREAKERS.get(service)
+    if b is None:
+        b = BREAKERS[service] = CircuitBreaker(service, slow_seconds, **kwargs)
+    return b
+
+
+def breaker_stats() -> dict:
+    return {name: b.snapshot() for name, b in BREAKERS.items()}
+
+
+def _collect() -> list:
+    code = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+    return [(
+        "tune_circuit_state", "gauge", "サーキットの状態（0=closed, 1=half_open, 2=open）",
+        [({"service": name}, code[b.state]) for name, b in BREAKERS.items()],
+    )]
+
+
+REGISTRY.add_collector(_collect)
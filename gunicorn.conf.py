@@ -0,0 +1,78 @@
+# gunicorn.conf.py（起動: gunicorn -c gunicorn.conf.py app:app）
+#
+# SERVE_MODE でワーカー方式をデプロイ時に切り替える:
+#   sync    … 1ワーカー1リクエスト（従来の gunicorn app:app 相当）
+#   gthread … 1ワーカーに GUNICORN_THREADS 本のスレッド
+#   gevent  … 協調スレッド。Spotify/LRCLIB/OpenAI 待ちや sleep の間に他のリクエストを処理する
+#             （1ワーカーで数百の同時リクエストを捌ける）
+#
+# 計測（python -m bench.run --server gunicorn --serve-mode <mode>、1ワーカー、代替サーバ）:
+#   users=40, 30秒             rps    currently_playing p95  lyrics_timed p95  translate p95
+#     sync                      9.7    6212ms                 7278ms            6031ms
+#     gthread (16スレッド)      40.2    1904ms                  812ms            1967ms
+#     gevent                   42.9    2031ms                  584ms            1452ms
+#   users=120, SSE 2割, 30秒
+#     gthread                  18.4   10170ms                10686ms            8669ms
+#     gevent                   60.8    3015ms                 1244ms            1479ms
+#   （users=120 では Spotify のレート制御（10/秒）が先に詰まり、poll の一部は 429 で返る）
+# 既定は gthread。gevent は同時接続が多いときに効くが、C 拡張や import 時の副作用に弱いので
+# 本番で切り替えるときはステージングで確かめてから SERVE_MODE=gevent にする。
+#
+# 起動を速くするための設定:
+#   preload_app … アプリの import を親プロセスで1回だけ行い、ワーカーは fork するだけ
+#                 （ワーカーごとに import し直さない。SQLite 接続は fork 後に各ワーカーで開き直す）
+#   when_ready  … preload 時は openai の import（約0.7秒）も親で済ませ、ワーカーは fork で引き継ぐ
+#   post_fork   … 各ワーカーで OpenAI クライアントの生成を裏で済ませ、最初の翻訳リクエストを待たせない
+#                 （preload しないときは import もここで行う）
+import os
+
+SERVE_MODE = os.getenv("SERVE_MODE", "gthread")
+
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "20"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+# ロードバランサ（Render のプロキシ等）の idle timeout より長くして、接続を張り直させない
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "75"))
+# ワーカーの生存確認ファイルをメモリ上に置く（コンテナのディスクが遅いと heartbeat が詰まる）
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+if SERVE_MODE == "gevent":
+    # パッチ後は select.epoll が無くなり、trio は import 時に AttributeError を出す。
+    # httpcore（openai → httpx 経由）は trio の ImportError しか想定していないので、
+    # 入っていても「無い」ことにしておく（でないと最初の翻訳で落ちる）
+    import sys
+    sys.modules.setdefault("trio", None)
+    # アプリ側のロック・スレッドプールより先にパッチを当てる
+    from gevent import monkey
+    monkey.patch_all()
+    worker_class = "gevent"
+    worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "500"))
+    concurrency = worker_connections
+elif SERVE_MODE == "gthread":
+    worker_class = "gthread"
+    threads = int(os.getenv("GUNICORN_THREADS", "16"))
+    concurrency = threads
+elif SERVE_MODE == "sync":
+    worker_class = "sync"
+    concurrency = 1
+else:
+    raise RuntimeError(f"unknown SERVE_MODE: {SERVE_MODE}")
+
+# 上流ごとの keep-alive 接続プールを同時処理数に合わせる（足りないと使い終わった接続を捨てて張り直す）。
+# 先読み・翻訳のスレッドからも使うので少し足す。明示的に設定されていればそちらを使う。
+# LRCLIB は1回の検索で /get と /search を並行に投げる（ヘッジ）ので2倍（問い合わせ用のスレッド数も同じ値）
+os.environ.setdefault("SPOTIFY_POOL_MAXSIZE", str(max(10, min(concurrency, 200) + 4)))
+os.environ.setdefault("LRCLIB_POOL_MAXSIZE", str(max(10, min(concurrency * 2, 400) + 4)))
+
+
+def when_ready(server):
+    # 親プロセスで、ワーカーを fork する前に呼ばれる
+    if preload_app:
+        from translation_service import preload_openai
+        preload_openai()
+
+
+def post_fork(server, worker):
+    from translation_service import warm_up_openai_client
+    warm_up_openai_client()
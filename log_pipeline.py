@@ -0,0 +1,219 @@
+# log_pipeline.py
+# ログの非同期化（リクエストのスレッドはキューに積むだけ。書き込みは専用スレッド）
+#
+#   リクエストのスレッド: 同じ箇所からの繰り返しを間引く → ルート・ユーザー・上流などを付ける → キューへ
+#   書き込みスレッド:     JSON 1行に整形（トレースバックもここで作る） → ファイル（サイズでローテート）と stderr
+#
+# キューが満杯なら待たずに捨てる（ログのせいでリクエストを遅らせない）。捨てた数は /metrics に出す。
+# gunicorn の preload で fork されたワーカーでは、キューと書き込みスレッドを作り直す。
+# 複数ワーカーは同じファイルをそれぞれローテートするので、LOG_FILE に {pid} を入れてワーカーごとに分けられる。
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import hashlib
+import logging
+import threading
+import logging.handlers
+from typing import Optional
+
+from flask import has_request_context, request, session, g
+
+from metrics import REGISTRY, current_upstream, request_timings
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "error.log")                   # 空ならファイルに書かない
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")                    # stderr 側: json / text
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# WARNING 以上は、同じ箇所から LOG_REPEAT_WINDOW 秒に LOG_REPEAT_BURST 件まで
+LOG_REPEAT_BURST = int(os.getenv("LOG_REPEAT_BURST", "5"))
+LOG_REPEAT_WINDOW = float(os.getenv("LOG_REPEAT_WINDOW", "60"))
+
+DROPPED = REGISTRY.counter(
+    "tune_log_dropped_total", "書き出さずに捨てたログ", ("reason",),
+)
+
+# JSON に載せる追加フィールド（extra={...} で渡すか、RequestContextFilter が付ける）
+FIELDS = ("route", "method", "user", "upstream", "status", "duration_ms", "upstream_ms", "suppressed")
+
+TEXT_FORMAT = "[%(asctime)s] %(levelname)s: %(message)s"
+
+
+# ==============================
+# 整形（書き込みスレッド側）
+# ==============================
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for name in FIELDS:
+            v = getattr(record, name, None)
+            if v is not None:
+                out[name] = v
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+# ==============================
+# フィルタ（リクエストのスレッド側。軽い処理だけ）
+# ==============================
+class RepeatFilter(logging.Filter):
+    """
+    WARNING 以上を、呼び出し箇所（ファイルと行）ごとに window 秒あたり burst 件までにする。
+    上流が落ちている間の「timeout/network」などが毎リクエスト出るのを抑える。
+    間引いた件数は、次に通した記録の suppressed に載せる。extra={"log_key": ...} で単位を変えられる。
+    """
+    def __init__(self, burst: int = LOG_REPEAT_BURST, window: float = LOG_REPEAT_WINDOW):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self._seen: dict = {}   # key -> [window の開始, 通した数, 間引いた数]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or self.burst <= 0:
+            return True
+        key = getattr(record, "log_key", None) or (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            ent = self._seen.get(key)
+            if ent is None or now - ent[0] >= self.window:
+                suppressed = ent[2] if ent else 0
+                if len(self._seen) > 1000:
+                    self._seen.clear()
+                self._seen[key] = [now, 1, 0]
+            elif ent[1] < self.burst:
+                ent[1] += 1
+                suppressed, ent[2] = ent[2], 0
+            else:
+                ent[2] += 1
+                DROPPED.inc(reason="repeated")
+                return False
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class RequestContextFilter(logging.Filter):
+    """Flask のリクエスト中なら、ルート・メソッド・ユーザー（sid のハッシュ）・経過時間・上流を付ける。"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        try:
+            self._annotate(record)
+        except Exception:
+            pass   # 付けられなくてもログ自体は出す
+        return True
+
+    @staticmethod
+    def _annotate(record: logging.LogRecord):
+        if getattr(record, "upstream", None) is None:
+            record.upstream = current_upstream()
+        if not has_request_context():
+            return
+        if getattr(record, "route", None) is None:
+            record.route = request.url_rule.rule if request.url_rule else request.path
+        record.method = request.method
+        sid = session.get("sid")
+        if sid and getattr(record, "user", None) is None:
+            record.user = hashlib.sha1(sid.encode()).hexdigest()[:12]
+        started = g.get("request_started")
+        if started is not None and getattr(record, "duration_ms", None) is None:
+            record.duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        timings = request_timings()
+        if timings and getattr(record, "upstream_ms", None) is None:
+            record.upstream_ms = {k: round(v * 1000, 1) for k, v in timings.items()}
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # メッセージは今の値で確定させ、トレースバックの整形（ソース行の読み込み）は書き込みスレッドに任せる
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc(reason="queue_full")
+
+
+# ==============================
+# 組み立て
+# ==============================
+_handler: Optional[_NonBlockingQueueHandler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def _build_outputs() -> list:
+    outputs = []
+    if LOG_FILE:
+        fh = logging.handlers.RotatingFileHandler(
+            LOG_FILE.format(pid=os.getpid()), maxBytes=LOG_MAX_BYTES,
+            backupCount=LOG_BACKUP_COUNT, encoding="utf-8", delay=True,
+        )
+        fh.setFormatter(JsonFormatter())
+        outputs.append(fh)
+    sh = logging.StreamHandler(sys.stderr)
+    sh.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+    outputs.append(sh)
+    return outputs
+
+
+def _start_listener():
+    global _listener
+    _handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(_handler.queue, *_build_outputs(), respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_after_fork():
+    # 親の書き込みスレッドは子には無い（キューのロックも持たれたままかもしれない）ので作り直す
+    if _handler is not None:
+        _start_listener()
+
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()   # キューに残っている分を書き出してから止める
+        _listener = None
+
+
+def setup_logging(level: str = LOG_LEVEL):
+    """ルートロガーをキュー経由の非同期出力にする（2回目以降は何もしない）。"""
+    global _handler
+    if _handler is not None:
+        return
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    _handler = _NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _handler.addFilter(RepeatFilter())
+    _handler.addFilter(RequestContextFilter())
+    root.addHandler(_handler)
+    root.setLevel(level)
+    _start_listener()
+    os.register_at_fork(after_in_child=_restart_after_fork)
+    atexit.register(_stop_listener)
+
+
+def log_stats() -> dict:
+    q = _handler.queue if _handler is not None else None
+    return {
+        "queued": q.qsize() if q is not None else 0,
+        "queue_size": LOG_QUEUE_SIZE,
+        "file": LOG_FILE.format(pid=os.getpid()) if LOG_FILE else None,
+        "dropped_queue_full": DROPPED.value(reason="queue_full"),
+        "suppressed_repeats": DROPPED.value(reason="repeated"),
+    }
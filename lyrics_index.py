@@ -0,0 +1,218 @@
+# lyrics_index.py
+# ローカル歌詞インデックス（SQLite ＋ FTS5）。LRCLIB のDBダンプや過去の検索結果から作る
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from typing import Optional, List
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(__file__), "lyrics_index.db")
+
+
+def normalize_text(s: Optional[str]) -> str:
+    """比較用の正規化（NFKC・大文字小文字無視・記号除去・空白詰め）。"""
+    s = unicodedata.normalize("NFKC", s or "").casefold()
+    s = re.sub(r"[^\w\s]", " ", s)
+    return " ".join(s.split())
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id            INTEGER PRIMARY KEY,
+    lrclib_id     INTEGER UNIQUE,
+    track_name    TEXT NOT NULL,
+    artist_name   TEXT NOT NULL,
+    album_name    TEXT,
+    duration      REAL,
+    isrc          TEXT,
+    name_norm     TEXT NOT NULL,
+    artist_norm   TEXT NOT NULL,
+    album_norm    TEXT,
+    instrumental  INTEGER DEFAULT 0,
+    plain_lyrics  TEXT,
+    synced_lyrics TEXT
+);
+CREATE INDEX IF NOT EXISTS tracks_name_artist ON tracks (name_norm, artist_norm, duration);
+CREATE INDEX IF NOT EXISTS tracks_isrc ON tracks (isrc);
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+    track_name, artist_name, album_name,
+    content='tracks', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN
+    INSERT INTO tracks_fts(rowid, track_name, artist_name, album_name)
+    VALUES (new.id, new.track_name, new.artist_name, new.album_name);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_ad AFTER DELETE ON tracks BEGIN
+    INSERT INTO tracks_fts(tracks_fts, rowid, track_name, artist_name, album_name)
+    VALUES ('delete', old.id, old.track_name, old.artist_name, old.album_name);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE ON tracks BEGIN
+    INSERT INTO tracks_fts(tracks_fts, rowid, track_name, artist_name, album_name)
+    VALUES ('delete', old.id, old.track_name, old.artist_name, old.album_name);
+    INSERT INTO tracks_fts(rowid, track_name, artist_name, album_name)
+    VALUES (new.id, new.track_name, new.artist_name, new.album_name);
+END;
+"""
+
+_COLUMNS = (
+    "lrclib_id, track_name, artist_name, album_name, duration, isrc, "
+    "instrumental, plain_lyrics, synced_lyrics"
+)
+
+
+def _to_candidate(row: sqlite3.Row) -> dict:
+    """LRCLIB API と同じ形（trackName など）で返す。"""
+    return {
+        "id": row["lrclib_id"],
+        "trackName": row["track_name"],
+        "artistName": row["artist_name"],
+        "albumName": row["album_name"],
+        "duration": row["duration"],
+        "isrc": row["isrc"],
+        "instrumental": bool(row["instrumental"]),
+        "plainLyrics": row["plain_lyrics"],
+        "syncedLyrics": row["synced_lyrics"],
+    }
+
+
+def _fts_query(q: str) -> str:
+    # 各語をフレーズ扱いにして FTS の演算子として解釈されないようにする
+    terms = normalize_text(q).split()
+    return " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+
+class LyricsIndex:
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():   # preload 後の fork では開き直す
+            # uri=True: ダンプを読み取り専用で ATTACH するため
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, uri=True)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.create_function("norm", 1, normalize_text, deterministic=True)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    # ---------- 参照 ----------
+    def lookup(self, title: str, artist: str, dur_sec: Optional[int] = None,
+               isrc: Optional[str] = None) -> Optional[dict]:
+        """ISRC → 正規化タイトル/アーティスト（＋秒数±2）の順で完全一致を探す。"""
+        conn = self._conn()
+        lyric_filter = "(synced_lyrics IS NOT NULL OR plain_lyrics IS NOT NULL)"
+        if isrc:
+            row = conn.execute(
+                f"SELECT * FROM tracks WHERE isrc=? AND {lyric_filter} "
+                "ORDER BY synced_lyrics IS NULL LIMIT 1", (isrc,),
+            ).fetchone()
+            if row:
+                return _to_candidate(row)
+        sql = f"SELECT * FROM tracks WHERE name_norm=? AND artist_norm=? AND {lyric_filter}"
+        args: list = [normalize_text(title), normalize_text(artist)]
+        if dur_sec:
+            sql += " AND (duration IS NULL OR ABS(duration - ?) <= 2)"
+            args.append(dur_sec)
+        sql += " ORDER BY synced_lyrics IS NULL LIMIT 1"
+        row = conn.execute(sql, args).fetchone()
+        return _to_candidate(row) if row else None
+
+    def search(self, q: str, limit: int = 20) -> List[dict]:
+        """全文検索（LRCLIB /search の代わり）。"""
+        fq = _fts_query(q)
+        if not fq:
+            return []
+        rows = self._conn().execute(
+            "SELECT t.* FROM tracks_fts f JOIN tracks t ON t.id = f.rowid "
+            "WHERE tracks_fts MATCH ? ORDER BY bm25(tracks_fts) LIMIT ?",
+            (fq, limit),
+        ).fetchall()
+        return [_to_candidate(r) for r in rows]
+
+    def count(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+
+    # ---------- 登録 ----------
+    def record(self, cand: dict, isrc: Optional[str] = None):
+        """LRCLIB API の結果1件を登録（同じ lrclib id は上書き）。"""
+        if not cand or not cand.get("trackName") or not cand.get("artistName"):
+            return
+        conn = self._conn()
+        conn.execute(
+            f"INSERT INTO tracks ({_COLUMNS}, name_norm, artist_norm, album_norm) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, norm(?), norm(?), norm(?)) "
+            "ON CONFLICT(lrclib_id) DO UPDATE SET "
+            " isrc=COALESCE(excluded.isrc, tracks.isrc),"
+            " plain_lyrics=excluded.plain_lyrics, synced_lyrics=excluded.synced_lyrics",
+            (
+                cand.get("id"), cand["trackName"], cand["artistName"], cand.get("albumName"),
+                cand.get("duration"), isrc or cand.get("isrc"), int(bool(cand.get("instrumental"))),
+                cand.get("plainLyrics"), cand.get("syncedLyrics"),
+                cand["trackName"], cand["artistName"], cand.get("albumName"),
+            ),
+        )
+        conn.commit()
+
+    def import_lrclib_dump(self, dump_path: str, batch: int = 50000, progress=None) -> int:
+        """
+        LRCLIB の公開DBダンプ（SQLite: tracks / lyrics テーブル）を取り込む。
+        各トラックの最新歌詞（tracks.last_lyrics_id）だけを入れる。取り込んだ件数を返す。
+        """
+        conn = self._conn()
+        conn.execute("ATTACH DATABASE ? AS dump", (f"file:{dump_path}?mode=ro",))
+        try:
+            total = 0
+            last_id = 0
+            while True:
+                upper = conn.execute(
+                    "SELECT MAX(id) FROM (SELECT id FROM dump.tracks WHERE id > ? ORDER BY id LIMIT ?)",
+                    (last_id, batch),
+                ).fetchone()[0]
+                if upper is None:
+                    break
+                cur = conn.execute(
+                    f"INSERT OR IGNORE INTO tracks ({_COLUMNS}, name_norm, artist_norm, album_norm) "
+                    "SELECT t.id, t.name, t.artist_name, t.album_name, t.duration, NULL, "
+                    "       COALESCE(l.instrumental, 0), l.plain_lyrics, l.synced_lyrics, "
+                    "       norm(t.name), norm(t.artist_name), norm(t.album_name) "
+                    "FROM dump.tracks t JOIN dump.lyrics l ON l.id = t.last_lyrics_id "
+                    "WHERE t.id > ? AND t.id <= ?",
+                    (last_id, upper),
+                )
+                conn.commit()
+                last_id = upper
+                total += cur.rowcount
+                if progress:
+                    progress(total)
+            return total
+        finally:
+            conn.execute("DETACH DATABASE dump")
+
+
+_index: Optional[LyricsIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> Optional[LyricsIndex]:
+    """LYRICS_INDEX_PATH が空文字なら無効（None）。"""
+    global _index
+    path = os.getenv("LYRICS_INDEX_PATH", DEFAULT_INDEX_PATH)
+    if not path:
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                try:
+                    _index = LyricsIndex(path)
+                except sqlite3.Error:
+                    return None
+    return _index
@@ -2,152 +2,434 @@
 import os
 import re
 import math
+import hashlib
+import time
+import threading
+import logging
 import requests
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
 from typing import Optional, List
 
+from cache_store import LRUCache, TieredCache, MISS, cache_db_path
+from lyrics_index import get_index, normalize_text
+from metrics import track, bind, counting_retry
+from circuit_breaker import get_breaker, CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
 # ---------- LRCLIB ----------
-BASE = "https://lrclib.net/api"
+BASE = os.getenv("LRCLIB_BASE", "https://lrclib.net/api")
+LRCLIB_TIMEOUT = (3.05, float(os.getenv("LRCLIB_READ_TIMEOUT", "8")))
+# /get がこの秒数で返らなければ /search も並行して投げる（ヘッジ）
+LRCLIB_HEDGE_DELAY = float(os.getenv("LRCLIB_HEDGE_DELAY", "0.3"))
+# keep-alive 接続を持っておく数と、問い合わせ用スレッドの数（gunicorn.conf.py がワーカーの同時処理数に合わせて決める）。
+# 1回の検索でヘッジの2本を使うので、足りないと /search がスレッドの空き待ちになる
+LRCLIB_POOL_MAXSIZE = int(os.getenv("LRCLIB_POOL_MAXSIZE", "16"))
+
+class LrclibClient:
+    """接続プール付きの LRCLIB クライアント（429/5xx はバックオフ付きで再試行）。"""
+    def __init__(self, base: str = BASE, timeout=LRCLIB_TIMEOUT):
+        self.base = base
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = counting_retry(
+            "lrclib",
+            total=2, connect=2, read=1,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(["GET"]),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=LRCLIB_POOL_MAXSIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["User-Agent"] = "tune-into-english (https://github.com/kanekosora-114/Tune-into-English)"
+
+    def get(self, path: str, params: dict):
+        r = self.session.get(f"{self.base}{path}", params=params, timeout=self.timeout)
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        return r.json()
+
+LRCLIB = LrclibClient()
+_lrclib_pool = ThreadPoolExecutor(max_workers=LRCLIB_POOL_MAXSIZE, thread_name_prefix="lrclib")
+
+_stage_lock = threading.Lock()
+_stage_stats = {
+    stage: {"calls": 0, "found": 0, "empty": 0, "errors": 0, "wins": 0, "total_ms": 0.0}
+    for stage in ("get", "search")
+}
+_stage_stats["local"] = {"wins": 0}
+
+def _lrclib_failure(e: BaseException) -> bool:
+    """4xx（429以外）はこちらの問い合わせの問題なので、LRCLIB の不調としては数えない。"""
+    resp = getattr(e, "response", None)
+    status = getattr(resp, "status_code", None)
+    return not (status and 400 <= status < 500 and status != 429)
+
+# 失敗が続いたり /get が数秒かかるようになったら、しばらく問い合わせずに即失敗させる
+LRCLIB_BREAKER = get_breaker(
+    "lrclib", slow_seconds=float(os.getenv("LRCLIB_SLOW_SECONDS", "4")), is_failure=_lrclib_failure,
+)
 
 def _get(path: str, params: dict):
-    r = requests.get(f"{BASE}{path}", params=params, timeout=10)
-    if r.status_code == 404:
-        return None
-    r.raise_for_status()
-    return r.json()
+    with LRCLIB_BREAKER.guard(), track("lrclib", path):
+        return LRCLIB.get(path, params)
 
 def _seconds(ms: int | None) -> int | None:
     if not ms:
         return None
     return max(1, math.floor(ms / 1000))
 
+def _score(c: dict, title: str, artist: str, dur_sec: int | None) -> int:
+    s = 0
+    if title and (c.get("trackName") or "").lower() == (title or "").lower():
+        s += 3
+    if artist and (c.get("artistName") or "").lower() == (artist or "").lower():
+        s += 3
+    cdur = c.get("duration")
+    if dur_sec and cdur:
+        diff = abs(cdur - dur_sec)
+        if diff <= 2: s += 2
+        elif diff <= 5: s += 1
+    return s
+
 def _pick_best(candidates: list, title: str, artist: str, dur_sec: int | None):
     if not candidates:
         return None
-    def score(c):
-        s = 0
-        if title and c.get("trackName", "").lower() == (title or "").lower():
-            s += 3
-        if artist and c.get("artistName", "").lower() == (artist or "").lower():
-            s += 3
-        cdur = c.get("duration")
-        if dur_sec and cdur:
-            diff = abs(cdur - dur_sec)
-            if diff <= 2: s += 2
-            elif diff <= 5: s += 1
-        return s
-    return sorted(candidates, key=score, reverse=True)[0]
+    return sorted(candidates, key=lambda c: _score(c, title, artist, dur_sec), reverse=True)[0]
 
-def get_lyrics_by_title_artist(
-    title: str,
-    artist: str,
-    album: str | None = None,
-    duration_ms: int | None = None,
-    isrc: str | None = None
-) -> Optional[str]:
+def _lyrics_of(d: dict | None) -> Optional[str]:
+    if not d:
+        return None
+    if d.get("syncedLyrics"): return d["syncedLyrics"].strip()
+    if d.get("plainLyrics"):  return d["plainLyrics"].strip()
+    return None
+
+def _run_stage(stage: str, fn, report: dict) -> Optional[dict]:
+    """1段階（/get or /search）を実行し、所要時間と結果を記録する。"""
+    t0 = time.perf_counter()
+    outcome = "error"
+    try:
+        cand = fn()
+        outcome = "found" if _lyrics_of(cand) else "empty"
+        return cand
+    except Exception as e:
+        report[f"{stage}_error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        ms = (time.perf_counter() - t0) * 1000
+        report[stage] = f"{outcome}/{ms:.0f}ms"
+        with _stage_lock:
+            st = _stage_stats[stage]
+            st["calls"] += 1
+            st["total_ms"] += ms
+            st["errors" if outcome == "error" else outcome] += 1
+
+def _fetch_remote(params: dict, title: str, artist: str, album: str | None, dur_sec: int | None) -> Optional[dict]:
     """
-    LRCLIBから同期歌詞(LRC)を優先して取得。無ければプレーン歌詞。
-    見つからなければ None。
+    LRCLIBへ問い合わせ。/get を投げ、LRCLIB_HEDGE_DELAY 秒で返らなければ /search も並行で投げ、
+    先に得られた歌詞付きの候補を返す。/get が「無し」で返った場合もすぐ /search へ進む。
+    どちらも見つからなければ None、確定できない（通信エラーを含む）ときは例外を送出する。
     """
-    if not title or not artist:
+    q = " ".join(x for x in [title, artist, album] if x)
+    report: dict = {}
+
+    def do_get():
+        return _get("/get", params)
+
+    def do_search():
+        cands = _get("/search", {"q": q}) or []
+        return _pick_best(cands, title, artist, dur_sec)
+
+    stages = {_lrclib_pool.submit(bind(_run_stage), "get", do_get, report): "get"}
+    pending = set(stages)
+    search_started = False
+    errors = []
+    try:
+        while pending:
+            timeout = None if search_started else LRCLIB_HEDGE_DELAY
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for fut in done:
+                try:
+                    cand = fut.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                if _lyrics_of(cand):
+                    with _stage_lock:
+                        _stage_stats[stages[fut]]["wins"] += 1
+                    report["winner"] = stages[fut]
+                    return cand
+            if not search_started:
+                # ヘッジ発動 or /get が空振り・失敗
+                fut = _lrclib_pool.submit(bind(_run_stage), "search", do_search, report)
+                stages[fut] = "search"
+                pending.add(fut)
+                search_started = True
+        if errors:
+            raise errors[-1]
+        return None
+    finally:
+        logger.info(f"[lrclib] {title} / {artist}: {report}")
+
+# ローカル索引の全文検索で採用する最低スコア（タイトル＋アーティスト一致）
+LOCAL_SEARCH_MIN_SCORE = 6
+
+def _fetch_local(title: str, artist: str, album: str | None, dur_sec: int | None, isrc: str | None) -> Optional[dict]:
+    """ローカル索引（完全一致 → 全文検索）から探す。無ければ None。"""
+    index = get_index()
+    if index is None:
         return None
+    try:
+        cand = index.lookup(title, artist, dur_sec=dur_sec, isrc=isrc)
+        if cand:
+            return cand
+        q = " ".join(x for x in [title, artist] if x)
+        best = _pick_best(index.search(q), title, artist, dur_sec)
+        if best and _score(best, title, artist, dur_sec) >= LOCAL_SEARCH_MIN_SCORE:
+            return best
+    except Exception as e:
+        logger.warning(f"[lyrics_index] lookup failed: {e}")
+    return None
+
+def _fetch_lyrics(params: dict, title: str, artist: str, album: str | None,
+                  dur_sec: int | None, isrc: str | None = None) -> Optional[str]:
+    """ローカル索引を先に引き、無ければ LRCLIB。LRCLIB で見つかった結果は索引に貯める。"""
+    cand = _fetch_local(title, artist, album, dur_sec, isrc)
+    if cand:
+        with _stage_lock:
+            _stage_stats["local"]["wins"] += 1
+        return _lyrics_of(cand)
+
+    cand = _fetch_remote(params, title, artist, album, dur_sec)
+    if cand:
+        index = get_index()
+        if index is not None:
+            try:
+                index.record(cand, isrc=isrc)
+            except Exception as e:
+                logger.warning(f"[lyrics_index] record failed: {e}")
+    return _lyrics_of(cand)
+
+def lrclib_stats() -> dict:
+    with _stage_lock:
+        out = {}
+        for stage, st in _stage_stats.items():
+            st = dict(st)
+            if "total_ms" in st:
+                st["avg_ms"] = round(st.pop("total_ms") / st["calls"], 1) if st["calls"] else 0.0
+            out[stage] = st
+        return out
+
+# ---------- 歌詞キャッシュ（LRU ＋ SQLite） ----------
+LYRICS_CACHE = TieredCache(
+    "lyrics",
+    maxsize=int(os.getenv("LYRICS_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("LYRICS_CACHE_TTL", str(7 * 24 * 3600))),
+    negative_ttl=float(os.getenv("LYRICS_NEGATIVE_TTL", str(6 * 3600))),
+    db_path=cache_db_path(),
+    # 期限切れ後もこの間は残し、取り直しが済むまで（LRCLIB が落ちている間も）古い歌詞を返す
+    stale_ttl=float(os.getenv("LYRICS_STALE_TTL", str(30 * 24 * 3600))),
+)
+
+_upstream_lock = threading.Lock()
+_upstream = {"calls": 0, "errors": 0, "total_ms": 0.0}
+
+def _cache_keys(track_id: str | None, title: str, artist: str, dur_sec: int | None) -> List[str]:
+    """Spotify track id を優先キー、正規化タイトル/アーティスト/秒数を予備キーにする。"""
+    keys = []
+    if track_id:
+        keys.append(f"track:{track_id}")
+    keys.append(f"meta:{normalize_text(title)}|{normalize_text(artist)}|{dur_sec or ''}")
+    return keys
 
+def lyrics_cache_stats() -> dict:
+    """キャッシュのヒット/ミス数と、ヒットで省けた上流待ち時間の推定値。"""
+    s = LYRICS_CACHE.stats()
+    with _upstream_lock:
+        up = dict(_upstream)
+    avg_ms = up["total_ms"] / up["calls"] if up["calls"] else 0.0
+    hits = s["memory_hits"] + s["disk_hits"] + s["negative_hits"]
+    s["upstream_calls"] = up["calls"]
+    s["upstream_errors"] = up["errors"]
+    s["upstream_avg_ms"] = round(avg_ms, 1)
+    s["saved_ms_estimate"] = round(hits * avg_ms)
+    s["stages"] = lrclib_stats()
+    return s
+
+class LyricsUnavailable(Exception):
+    """キャッシュに無く、LRCLIB にも問い合わせられなかった（通信エラー・サーキット開）。"""
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+_refresh_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="lyrics-refresh")
+_refreshing: set = set()
+
+def _lookup_params(title: str, artist: str, album: str | None, duration_ms: int | None, isrc: str | None):
     params = {"track_name": title, "artist_name": artist}
     if album: params["album_name"] = album
     if isrc: params["isrc"] = isrc
     dur_sec = _seconds(duration_ms)
     if dur_sec: params["duration"] = dur_sec
+    return params, dur_sec
 
+def _fetch_and_store(keys: List[str], params: dict, title: str, artist: str, album: str | None,
+                     dur_sec: int | None, isrc: str | None) -> Optional[str]:
+    t0 = time.perf_counter()
     try:
-        data = _get("/get", params)
-        if data:
-            if data.get("syncedLyrics"): return data["syncedLyrics"].strip()
-            if data.get("plainLyrics"):  return data["plainLyrics"].strip()
-
-        # 見つからなければ検索
-        q = " ".join(x for x in [title, artist, album] if x)
-        cands = _get("/search", {"q": q}) or []
-        best = _pick_best(cands, title, artist, dur_sec)
-        if best:
-            if best.get("syncedLyrics"): return best["syncedLyrics"].strip()
-            if best.get("plainLyrics"):  return best["plainLyrics"].strip()
+        lyrics = _fetch_lyrics(params, title, artist, album, dur_sec, isrc)
     except Exception:
-        pass
+        with _upstream_lock:
+            _upstream["errors"] += 1
+        raise
+    finally:
+        with _upstream_lock:
+            _upstream["calls"] += 1
+            _upstream["total_ms"] += (time.perf_counter() - t0) * 1000
+    for k in keys:
+        LYRICS_CACHE.set(k, lyrics)
+    return lyrics
 
-    return None
+def _refresh_in_background(keys: List[str], *args):
+    """古い値を返した後に裏で取り直す（同じ曲は1本だけ。サーキットが開いていれば何もしない）。"""
+    if LRCLIB_BREAKER.rejecting():
+        return
+    with _upstream_lock:
+        if keys[0] in _refreshing:
+            return
+        _refreshing.add(keys[0])
+
+    def run():
+        try:
+            _fetch_and_store(keys, *args)
+        except Exception as e:
+            # 失敗しても古い値はそのまま残る（次のアクセスでまた試す）
+            logger.info(f"[lrclib] background refresh failed: {e}")
+        finally:
+            with _upstream_lock:
+                _refreshing.discard(keys[0])
+
+    _refresh_pool.submit(run)
+
+def get_lyrics_entry(
+    title: str,
+    artist: str,
+    album: str | None = None,
+    duration_ms: int | None = None,
+    isrc: str | None = None,
+    track_id: str | None = None,
+) -> tuple:
+    """
+    (歌詞 or None, stale) を返す。
+    期限切れの値は stale=True でそのまま返し、裏で LRCLIB から取り直す（stale-while-revalidate）。
+    キャッシュに無く LRCLIB にも問い合わせられないときは LyricsUnavailable。
+    """
+    if not title or not artist:
+        return None, False
 
-# ---------- 翻訳（OpenAI Responses API） ----------
-# pip install openai >= 1.0 が必要
-from openai import OpenAI
-_client = None
+    params, dur_sec = _lookup_params(title, artist, album, duration_ms, isrc)
+    keys = _cache_keys(track_id, title, artist, dur_sec)
+    ent = LYRICS_CACHE.get_first_entry(keys)
+    if ent is not None:
+        if ent[1]:
+            _refresh_in_background(keys, params, title, artist, album, dur_sec, isrc)
+        return ent
 
-def _client_once() -> OpenAI:
-    global _client
-    if _client is None:
-        # OPENAI_API_KEY は環境変数に設定しておく
-        _client = OpenAI()  # 自動で os.environ['OPENAI_API_KEY'] を読む
-    return _client
+    try:
+        # 通信エラーはネガティブキャッシュしない（次回また取りに行く）
+        return _fetch_and_store(keys, params, title, artist, album, dur_sec, isrc), False
+    except CircuitOpenError as e:
+        raise LyricsUnavailable(str(e), e.retry_after) from e
+    except Exception as e:
+        logger.warning(f"[lrclib] lookup failed: {title} / {artist}: {e}")
+        raise LyricsUnavailable(f"lrclib lookup failed: {type(e).__name__}") from e
 
+def get_lyrics_by_title_artist(
+    title: str,
+    artist: str,
+    album: str | None = None,
+    duration_ms: int | None = None,
+    isrc: str | None = None,
+    track_id: str | None = None,
+) -> Optional[str]:
+    """
+    LRCLIBから同期歌詞(LRC)を優先して取得。無ければプレーン歌詞。
+    見つからなければ（取得できなかったときも）None。
+    結果（「見つからない」も含む）は track_id / 正規化メタ情報をキーにキャッシュする。
+    """
+    try:
+        return get_lyrics_entry(title, artist, album, duration_ms, isrc, track_id)[0]
+    except LyricsUnavailable:
+        return None
+
+# ---------- タイムライン（LRC解析・擬似同期） ----------
 _TIME_TAG = re.compile(r"^(\s*(?:\[\d{1,2}:\d{2}(?:\.\d{1,3})?\])+)\s*(.*)$")
+_TAG_PARTS = re.compile(r"\[(\d{1,2}):(\d{2})(?:\.(\d{1,3}))?\]")
+
+TIMELINE_CACHE = LRUCache(
+    maxsize=int(os.getenv("TIMELINE_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("LYRICS_CACHE_TTL", str(7 * 24 * 3600))),
+)
 
-def _split_lrc_lines(text: str) -> List[str]:
-    return text.splitlines()
-
-def _needs_timestamp_preserve(text: str) -> bool:
-    # 先頭数行にタイムタグがあればLRCとみなす
-    lines = text.splitlines()
-    for ln in lines[:10]:
-        if _TIME_TAG.match(ln):
-            return True
-    return False
-
-def translate_lyrics(
-    lyrics: str,
-    target_lang: str = "ja",
-    model: str = "gpt-4o-mini",
-) -> str:
+def parse_lrc_timeline(text: str) -> List[list]:
     """
-    歌詞を target_lang に翻訳。
-    - LRC形式なら [mm:ss.xx] のタイムタグは保持して本文のみ翻訳
-    - プレーン歌詞はそのまま行単位で翻訳
+    LRC を [[ms, text], ...]（時刻順）に変換。
+    [00:12.30][00:45.10]歌詞 のような複数タグ行は各時刻に展開する。
     """
-    if not lyrics:
-        return ""
-
-    preserve = _needs_timestamp_preserve(lyrics)
-    system = (
-        "You are a professional lyric translator. "
-        f"Translate the user's lyrics into {target_lang}. "
-        "Preserve line breaks exactly. "
-        "If a line starts with one or more time tags like [mm:ss.xx], "
-        "keep the tags unchanged and translate only the following text. "
-        "Do not add explanations or parentheses. Return only the translated lyrics."
-    )
-    client = _client_once()
-
-    # 長文対策：4,000文字ごとに分割
-    chunks = []
-    buf = []
-    size = 0
-    for line in _split_lrc_lines(lyrics):
-        ln = line + "\n"
-        if size + len(ln) > 4000 and buf:
-            chunks.append("".join(buf))
-            buf, size = [ln], len(ln)
-        else:
-            buf.append(ln)
-            size += len(ln)
-    if buf:
-        chunks.append("".join(buf))
-
-    out_parts = []
-    for chunk in chunks:
-        resp = client.responses.create(
-            model=model,
-            input=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": chunk},
-            ],
-        )
-        out_parts.append(resp.output_text.strip())
+    out = []
+    for ln in (text or "").splitlines():
+        m = _TIME_TAG.match(ln)
+        if not m:
+            continue
+        body = m.group(2).strip()
+        for mm, ss, frac in _TAG_PARTS.findall(m.group(1)):
+            ms = (int(mm) * 60 + int(ss)) * 1000 + int((frac or "0").ljust(3, "0"))
+            out.append([ms, body])
+    out.sort(key=lambda x: x[0])
+    return out
+
+def pseudo_timeline(text: str, duration_ms: int | None) -> List[list]:
+    """プレーン歌詞を曲の長さに合わせて文字数比で割り振る（擬似同期）。"""
+    lines = [ln.strip() for ln in (text or "").splitlines()]
+    while lines and not lines[-1]:
+        lines.pop()
+    if not lines:
+        return []
+    weights = [len(ln) + 8 for ln in lines]  # 空行・短い行にも最低限の長さを与える
+    total = sum(weights)
+    span = duration_ms or 3000 * len(lines)
+    out, acc = [], 0
+    for ln, w in zip(lines, weights):
+        out.append([int(span * acc / total), ln])
+        acc += w
+    return out
 
-    return "\n".join(out_parts).strip()
+def get_timed_lyrics(
+    title: str,
+    artist: str,
+    duration_ms: int | None = None,
+    track_id: str | None = None,
+) -> Optional[dict]:
+    """
+    {"timed": [[ms, text], ...], "synced": bool, "stale": bool} を返す。歌詞が無ければ None。
+    stale は期限切れのキャッシュから返した（裏で取り直し中）こと。
+    取得できなかったときは get_lyrics_entry() と同じく LyricsUnavailable。
+    解析結果は歌詞本文ごとにキャッシュし、同じ曲で何度も解析しない。
+    """
+    lyrics, stale = get_lyrics_entry(title, artist, duration_ms=duration_ms, track_id=track_id)
+    if not lyrics:
+        return None  # 「見つからない」は歌詞キャッシュ側で覚えている
+    key = hashlib.sha1(f"{duration_ms or ''}|{lyrics}".encode("utf-8")).hexdigest()
+    result = TIMELINE_CACHE.get(key)
+    if result is MISS:
+        timed = parse_lrc_timeline(lyrics)
+        result = {"timed": timed, "synced": True} if timed else {
+            "timed": pseudo_timeline(lyrics, duration_ms), "synced": False,
+        }
+        TIMELINE_CACHE.set(key, result)
+    return dict(result, stale=stale)
@@ -0,0 +1,253 @@
+# metrics.py
+# ルート・上流呼び出しの計測（Prometheus テキスト形式で /metrics に出す）
+#
+# 値はプロセスごと。gunicorn で複数ワーカーのときはワーカー単位の値になる。
+import os
+import time
+import bisect
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from urllib3.util.retry import Retry
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# レスポンスに Server-Timing ヘッダ（上流ごとの所要時間内訳）を付けるか
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, v in sorted(self._values.items()):
+                out.append(f"{self.name}{_fmt_labels(self.labelnames, key)} {_fmt_value(v)}")
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[tuple, list] = {}   # key -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            if i < len(self.buckets):
+                s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((k, list(v)) for k, v in self._series.items())
+        for key, s in series:
+            cum = 0
+            for b, n in zip(self.buckets, s):
+                cum += n
+                le = 'le="%s"' % b
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, le)} {cum}")
+            le = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, le)} {s[-1]}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {_fmt_value(s[-2])}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {s[-1]}")
+        return out
+
+
+class Registry:
+    """
+    計測値の登録簿。既存の stats 辞書（キャッシュのヒット数など）は
+    add_collector() で登録した関数が出力時に読み出す。
+    collector は [(name, type, help, [(labels_dict, value), ...]), ...] を返す。
+    """
+    def __init__(self):
+        self._metrics: list = []
+        self._collectors: List[Callable[[], list]] = []
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        m = Counter(name, help, labelnames)
+        self._metrics.append(m)
+        return m
+
+    def histogram(self, name: str, help: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        m = Histogram(name, help, labelnames, buckets)
+        self._metrics.append(m)
+        return m
+
+    def add_collector(self, fn: Callable[[], list]):
+        self._collectors.append(fn)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in self._metrics:
+            lines += m.render()
+        families: Dict[str, list] = {}
+        for fn in self._collectors:
+            try:
+                for name, typ, help, samples in fn():
+                    fam = families.setdefault(name, [typ, help, []])
+                    fam[2] += samples
+            except Exception:
+                continue  # 1つの collector の失敗で /metrics 全体を落とさない
+        for name, (typ, help, samples) in families.items():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {typ}"]
+            for labels, value in samples:
+                names = tuple(labels)
+                lines.append(f"{name}{_fmt_labels(names, tuple(labels[n] for n in names))} {_fmt_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_SECONDS = REGISTRY.histogram(
+    "tune_http_request_duration_seconds", "Flask ルートの処理時間",
+    ("method", "route", "status"),
+)
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    "tune_upstream_request_duration_seconds", "上流（Spotify/LRCLIB/OpenAI）呼び出しの所要時間",
+    ("service", "op", "outcome"),
+)
+UPSTREAM_RETRIES = REGISTRY.counter(
+    "tune_upstream_retries_total", "上流呼び出しの再試行回数", ("service", "reason"),
+)
+OPENAI_TOKENS = REGISTRY.counter(
+    "tune_openai_tokens_total", "OpenAI の消費トークン数", ("kind",),
+)
+
+
+# ==============================
+# リクエスト単位の内訳（Server-Timing 用）
+# ==============================
+_request_timings: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("request_timings", default=None)
+# 呼び出し中（または直近で失敗した）上流。ログに「どの上流のせいか」を付けるため
+_upstream: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("upstream", default=None)
+
+
+def begin_request():
+    """リクエストの開始時に呼ぶ。以降の track() の所要時間をサービスごとに積み上げる。"""
+    _request_timings.set({})
+    _upstream.set(None)
+
+
+def request_timings() -> dict:
+    """このリクエストでここまでに上流ごとにかかった秒数。"""
+    return dict(_request_timings.get() or {})
+
+
+def current_upstream() -> Optional[str]:
+    return _upstream.get()
+
+
+def bind(fn: Callable) -> Callable:
+    """スレッドプールへ渡す関数に今のコンテキストを引き継ぐ（内訳にワーカー側の時間も載せるため）。"""
+    ctx = contextvars.copy_context()
+    return functools.partial(ctx.run, fn)
+
+
+def server_timing_header(total_seconds: float) -> str:
+    """例: 'spotify;dur=82.1, openai;dur=640.0, app;dur=731.4'（並列に走った呼び出しは合算）"""
+    timings = _request_timings.get() or {}
+    parts = [f"{k};dur={v * 1000:.1f}" for k, v in sorted(timings.items())]
+    parts.append(f"app;dur={total_seconds * 1000:.1f}")
+    return ", ".join(parts)
+
+
+# ==============================
+# 上流呼び出しの計測
+# ==============================
+@contextmanager
+def track(service: str, op: str):
+    t0 = time.perf_counter()
+    outcome = "error"
+    prev = _upstream.get()
+    _upstream.set(service)
+    try:
+        yield
+        outcome = "ok"
+        _upstream.set(prev)   # 失敗したときは残す（直後の except 節のログに載せる）
+    finally:
+        dt = time.perf_counter() - t0
+        UPSTREAM_SECONDS.observe(dt, service=service, op=op, outcome=outcome)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[service] = timings.get(service, 0.0) + dt
+
+
+def timed(service: str, op: str):
+    """track() のデコレータ版。"""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with track(service, op):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+def record_openai_usage(usage):
+    """chat.completions のレスポンス（またはストリーム最後のチャンク）の usage を足し込む。"""
+    if usage is None:
+        return
+    OPENAI_TOKENS.inc(getattr(usage, "prompt_tokens", 0) or 0, kind="prompt")
+    OPENAI_TOKENS.inc(getattr(usage, "completion_tokens", 0) or 0, kind="completion")
+
+
+def counting_retry(service: str, **kwargs) -> Retry:
+    """urllib3 の Retry に、再試行のたびに UPSTREAM_RETRIES を数える処理を足したもの。"""
+    class _CountingRetry(Retry):
+        def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+            new = super().increment(method, url, response, error, _pool, _stacktrace)
+            # 上限に達したときは MaxRetryError が出るのでここには来ない＝実際に再試行した回数だけ数える
+            reason = str(response.status) if response is not None else type(error).__name__
+            UPSTREAM_RETRIES.inc(service=service, reason=reason)
+            return new
+    return _CountingRetry(**kwargs)
+
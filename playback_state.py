@@ -0,0 +1,202 @@
+# playback_state.py
+# ユーザーごとの「再生中」スナップショット（短TTL ＋ 同時リクエストの相乗り）
+import os
+import copy
+import time
+import threading
+from typing import Callable, Optional
+
+NOW_PLAYING_TTL = float(os.getenv("NOW_PLAYING_TTL", "3"))
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class NowPlayingCache:
+    """
+    current_user_playing_track() の結果をユーザー単位で ttl 秒だけ共有する。
+    - 同じユーザーの同時リクエストは1回の上流呼び出しに相乗り（single-flight）
+    - 返す progress_ms は取得時刻からの経過分を足して補正する
+    """
+    def __init__(self, ttl: float = NOW_PLAYING_TTL, maxsize: int = 4096):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._snapshots: dict = {}   # user_key -> (data, captured_at)
+        self._flights: dict = {}     # user_key -> _Flight
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "shared": 0, "fetches": 0}
+
+    def get(self, user_key: str, fetch: Callable[[], Optional[dict]]) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            snap = self._snapshots.get(user_key)
+            if snap and now - snap[1] < self.ttl and not _past_end(snap, now):
+                self.stats["hits"] += 1
+                return _extrapolate(snap, now)
+            flight = self._flights.get(user_key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[user_key] = _Flight()
+                self.stats["fetches"] += 1
+            else:
+                self.stats["shared"] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return _extrapolate(flight.result, time.time()) if flight.result else None
+
+        try:
+            data = fetch()
+            snap = (data, time.time())
+            flight.result = snap
+            with self._lock:
+                if len(self._snapshots) >= self.maxsize:
+                    self._snapshots.clear()
+                self._snapshots[user_key] = snap
+            return copy.deepcopy(data)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(user_key, None)
+            flight.done.set()
+
+    def invalidate(self, user_key: str):
+        """再生操作の後などに呼び、次回は必ず取り直す。"""
+        with self._lock:
+            self._snapshots.pop(user_key, None)
+
+
+def _past_end(snap, now: float) -> bool:
+    """補正後の位置が曲の長さを超えた＝曲が変わっている可能性が高い。"""
+    data, captured_at = snap
+    if not data or not data.get("is_playing"):
+        return False
+    duration = (data.get("item") or {}).get("duration_ms") or 0
+    progress = (data.get("progress_ms") or 0) + (now - captured_at) * 1000
+    return bool(duration) and progress >= duration
+
+
+def _extrapolate(snap, now: float) -> Optional[dict]:
+    data, captured_at = snap
+    if not data:
+        return data
+    data = copy.deepcopy(data)
+    if data.get("is_playing") and data.get("progress_ms") is not None:
+        duration = (data.get("item") or {}).get("duration_ms") or 0
+        progress = data["progress_ms"] + int((now - captured_at) * 1000)
+        data["progress_ms"] = min(progress, duration) if duration else progress
+    return data
+
+
+# ==============================
+# 再生状態のプッシュ（SSE）用ヘルパ
+# ==============================
+EVENTS_MIN_SLEEP = float(os.getenv("NOW_PLAYING_MIN_SLEEP", "1"))
+# 他の端末での曲送り・停止は次に見に行くまで分からないので、従来のポーリング間隔（8秒）より長く寝ない
+EVENTS_MAX_SLEEP = float(os.getenv("NOW_PLAYING_MAX_SLEEP", "8"))
+EVENTS_PAUSED_SLEEP = float(os.getenv("NOW_PLAYING_PAUSED_SLEEP", "8"))
+EVENTS_END_LEAD = 1.0      # 曲終わりの少し前に起きる（秒）
+SEEK_TOLERANCE_MS = 3000   # これ以上ずれたらシークとみなす
+
+
+def next_poll_delay(payload: dict) -> float:
+    """曲の残り時間から次に Spotify を見に行くまでの秒数を決める。"""
+    if not payload.get("is_playing"):
+        return EVENTS_PAUSED_SLEEP
+    remaining = ((payload.get("duration_ms") or 0) - (payload.get("progress_ms") or 0)) / 1000
+    if remaining <= 0:
+        return EVENTS_MIN_SLEEP
+    return max(EVENTS_MIN_SLEEP, min(EVENTS_MAX_SLEEP, remaining - EVENTS_END_LEAD))
+
+
+def playback_event(prev: Optional[dict], curr: dict) -> Optional[str]:
+    """前回との差分からイベント名を返す（"track" / "state" / 変化なしは None）。"""
+    if prev is None:
+        return "track"
+    if curr.get("track_id") != prev.get("track_id"):
+        return "track"
+    if bool(curr.get("is_playing")) != bool(prev.get("is_playing")):
+        return "state"
+    if curr.get("is_playing"):
+        elapsed = (curr.get("timestamp_ms") or 0) - (prev.get("timestamp_ms") or 0)
+        expected = (prev.get("progress_ms") or 0) + elapsed
+        if abs((curr.get("progress_ms") or 0) - expected) > SEEK_TOLERANCE_MS:
+            return "state"
+    return None
+
+
+# ==============================
+# 再生デバイス（ユーザーごとの登録簿 ＋ 準備完了の確認）
+# ==============================
+DEVICE_TTL = 60 * 60          # 覚えておくデバイスIDの有効期間（秒）
+DEVICE_READY_TTL = 30         # 「アクティブ確認済み」とみなす期間（秒）
+DEVICE_READY_TIMEOUT = float(os.getenv("DEVICE_READY_TIMEOUT", "2.5"))
+DEVICE_READY_CHECKS = int(os.getenv("DEVICE_READY_CHECKS", "4"))   # その間に current_playback() を呼ぶ上限
+
+
+class DeviceRegistry:
+    """/transfer_playback や Web Playback SDK の device_id をユーザーごとに覚える。"""
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._devices: dict = {}   # user_key -> {"id", "seen_at", "ready_at"}
+        self._lock = threading.Lock()
+
+    def remember(self, user_key: str, device_id: str, ready: bool = False):
+        now = time.time()
+        with self._lock:
+            ent = self._devices.get(user_key)
+            if not ent or ent["id"] != device_id:
+                if len(self._devices) >= self.maxsize:
+                    self._devices.clear()
+                ent = self._devices[user_key] = {"id": device_id, "seen_at": now, "ready_at": 0.0}
+            ent["seen_at"] = now
+            if ready:
+                ent["ready_at"] = now
+
+    def get(self, user_key: str) -> Optional[str]:
+        with self._lock:
+            ent = self._devices.get(user_key)
+            if ent and time.time() - ent["seen_at"] < DEVICE_TTL:
+                return ent["id"]
+        return None
+
+    def is_ready(self, user_key: str, device_id: str) -> bool:
+        with self._lock:
+            ent = self._devices.get(user_key)
+            return bool(ent and ent["id"] == device_id and time.time() - ent["ready_at"] < DEVICE_READY_TTL)
+
+    def forget(self, user_key: str):
+        with self._lock:
+            self._devices.pop(user_key, None)
+
+
+def wait_for_device(sp, device_id: str, timeout: float = DEVICE_READY_TIMEOUT,
+                    checks: int = DEVICE_READY_CHECKS) -> bool:
+    """
+    transfer_playback の後、対象デバイスがアクティブになるまで確認する。
+    転送直後はまだ切り替わっていないので 300ms 待ってから確認し、間隔は倍々。
+    確認は checks 回まで（最後の1回は timeout ちょうど）。確認できなければ False。
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.3
+    for n in range(checks):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(remaining if n == checks - 1 else min(delay, remaining))
+        delay *= 2
+        try:
+            pb = sp.current_playback() or {}
+            if (pb.get("device") or {}).get("id") == device_id:
+                return True
+        except Exception:
+            pass  # 一時的な失敗は次の確認まで待つ
+    return False
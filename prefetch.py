@@ -0,0 +1,113 @@
+# prefetch.py
+# 再生キューの先読み（次の数曲の歌詞・訳をバックグラウンドで温めておく）
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from cache_store import LRUCache, MISS
+from lyrics_service import get_timed_lyrics
+from translation_service import translate_lines
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_DEPTH = int(os.getenv("PREFETCH_DEPTH", "3"))             # 何曲先まで温めるか
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "2"))
+PREFETCH_MAX_PENDING = int(os.getenv("PREFETCH_MAX_PENDING", "20"))  # これ以上は積まない
+PREFETCH_RECENT_TTL = 30 * 60                                      # 同じ曲を温め直さない期間（秒）
+PREFETCH_MAX_USERS = int(os.getenv("PREFETCH_MAX_USERS", "10000"))  # 直近の再生曲を覚えておくユーザー数
+
+
+class QueuePrefetcher:
+    def __init__(self, depth: int = PREFETCH_DEPTH, workers: int = PREFETCH_WORKERS,
+                 max_pending: int = PREFETCH_MAX_PENDING):
+        self.depth = depth
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        self._pending = 0
+        # user_key -> 直近に先読みを始めた再生中 track_id（古いユーザーから捨てる）
+        self._last_trigger = LRUCache(maxsize=PREFETCH_MAX_USERS, ttl=24 * 3600)
+        # 温め終わった track_id（失敗した曲は入れない＝次の機会にまた試す）
+        self._recent = LRUCache(maxsize=10000, ttl=PREFETCH_RECENT_TTL)
+        self._warming: set = set()      # 温めている最中の track_id
+        self.stats = {"triggers": 0, "tracks": 0, "skipped": 0, "errors": 0}
+
+    def on_track(self, user_key: str, track_id: Optional[str], sp_factory: Callable,
+                 openai_factory: Optional[Callable] = None):
+        """
+        再生中の曲が変わったときに呼ぶ。同じ曲での重複呼び出しは無視。
+        sp_factory() / openai_factory() は各クライアントを返す関数（生成はワーカー側で行う）。
+        """
+        if not track_id or self.depth <= 0:
+            return
+        with self._lock:
+            if self._last_trigger.get(user_key) == track_id:
+                return
+            self._last_trigger.set(user_key, track_id)
+            if self._pending >= self.max_pending:
+                self.stats["skipped"] += 1
+                return
+            self._pending += 1
+            self.stats["triggers"] += 1
+        self._executor.submit(self._run_queue, sp_factory, openai_factory)
+
+    def _run_queue(self, sp_factory: Callable, openai_factory: Optional[Callable]):
+        try:
+            q = sp_factory().queue() or {}
+        except Exception as e:
+            logger.warning(f"prefetch: queue fetch failed: {e}")
+            with self._lock:
+                self._pending -= 1
+                self.stats["errors"] += 1
+            return
+
+        targets = []
+        with self._lock:
+            self._pending -= 1
+            for item in q.get("queue") or []:
+                if len(targets) >= self.depth:
+                    break
+                tid = (item or {}).get("id")
+                if not tid or item.get("type", "track") != "track":
+                    continue
+                if tid in self._warming or self._recent.get(tid) is not MISS:
+                    continue
+                if self._pending >= self.max_pending:
+                    self.stats["skipped"] += 1
+                    break
+                self._warming.add(tid)
+                self._pending += 1
+                targets.append(item)
+
+        for item in targets:
+            self._executor.submit(self._warm_track, item, openai_factory)
+
+    def _warm_track(self, item: dict, openai_factory: Optional[Callable]):
+        try:
+            artists = item.get("artists") or []
+            res = get_timed_lyrics(
+                item.get("name") or "",
+                artists[0]["name"] if artists else "",
+                duration_ms=item.get("duration_ms"),
+                track_id=item.get("id"),
+            )
+            openai_client = openai_factory() if openai_factory else None
+            report = {"unavailable": 0}
+            if res and res["timed"] and openai_client is not None:
+                # プレイヤーが送ってくる行と同じ並びで訳しておく（メモに載る）
+                translate_lines(openai_client, [text for _, text in res["timed"]], report=report)
+            if report["unavailable"]:
+                raise RuntimeError(f"{report['unavailable']} lines not translated (openai unavailable)")
+            with self._lock:
+                self.stats["tracks"] += 1
+            self._recent.set(item.get("id"), True)
+        except Exception as e:
+            logger.warning(f"prefetch: warm {item.get('id')} failed: {e}")
+            with self._lock:
+                self.stats["errors"] += 1
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self._warming.discard(item.get("id"))
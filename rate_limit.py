@@ -0,0 +1,130 @@
+# rate_limit.py
+# 上流APIのレート制限に合わせて呼び出しを待たせるトークンバケット（プロセス内 / Redis 共有）
+import time
+import threading
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    rate（1秒あたり）で補充され、capacity まで貯まるバケット。
+    acquire() は足りなければ補充されるまで待つ（エラーにはしない）。
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited_seconds = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, n: float = 1, timeout: Optional[float] = None, floor: float = 0.0) -> bool:
+        """
+        n 個取れたら True。timeout 秒待っても取れなければ False。
+        floor: 取った後にこれだけは残す（優先度の高い呼び出しのための取り置き）。
+        """
+        # capacity を超える要求は capacity 分だけ取る（大きなバッチが永遠に待たないように）
+        n = min(n, self.capacity - floor)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens - n >= floor:
+                    self._tokens -= n
+                    return True
+                wait = (n + floor - self._tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+            with self._lock:
+                self.waited_seconds += wait
+
+    @classmethod
+    def per_minute(cls, limit: float, burst_seconds: float = 10) -> "TokenBucket":
+        """「1分あたり limit」の制限を、burst_seconds 秒分までの一時的な集中を許して守る。"""
+        rate = limit / 60
+        return cls(rate, max(1.0, rate * burst_seconds))
+
+
+# Redis 上で残量と更新時刻を持つ（複数ワーカー・複数インスタンスで1つのバケットを共有）
+_REDIS_TAKE = """
+local cap = tonumber(ARGV[2])
+local v = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(v[1]) or cap
+local ts = tonumber(v[2]) or tonumber(ARGV[3])
+tokens = math.min(cap, tokens + math.max(0, tonumber(ARGV[3]) - ts) * tonumber(ARGV[1]))
+local n = tonumber(ARGV[4])
+local wait = 0
+if tokens - n >= tonumber(ARGV[5]) then
+    tokens = tokens - n
+else
+    wait = (n + tonumber(ARGV[5]) - tokens) / tonumber(ARGV[1])
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', ARGV[3])
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(wait)
+"""
+
+
+class RedisTokenBucket(TokenBucket):
+    """TokenBucket と同じ使い方で、残量を Redis に置く。"""
+    def __init__(self, redis_client, key: str, rate: float, capacity: float):
+        super().__init__(rate, capacity)
+        self._r = redis_client
+        self.key = key
+        self._take = redis_client.register_script(_REDIS_TAKE)
+
+    def acquire(self, n: float = 1, timeout: Optional[float] = None, floor: float = 0.0) -> bool:
+        n = min(n, self.capacity - floor)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = float(self._take(keys=[self.key], args=[self.rate, self.capacity, time.time(), n, floor]))
+            if wait <= 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+            with self._lock:
+                self.waited_seconds += wait
+
+
+class Cooldown:
+    """「この時刻までは呼ばない」を共有する（429 の Retry-After 用）。"""
+    def __init__(self):
+        self._until = 0.0
+        self._lock = threading.Lock()
+
+    def set(self, seconds: float):
+        with self._lock:
+            self._until = max(self._until, time.time() + seconds)
+
+    def remaining(self) -> float:
+        return max(0.0, self._until - time.time())
+
+
+class RedisCooldown(Cooldown):
+    def __init__(self, redis_client, key: str):
+        super().__init__()
+        self._r = redis_client
+        self.key = key
+
+    def set(self, seconds: float):
+        ms = max(1, int(seconds * 1000))
+        # 既により長い待ちが入っていれば縮めない
+        if (self._r.pttl(self.key) or 0) < ms:
+            self._r.set(self.key, "1", px=ms)
+
+    def remaining(self) -> float:
+        ms = self._r.pttl(self.key)
+        return ms / 1000 if ms and ms > 0 else 0.0
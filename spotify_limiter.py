@@ -0,0 +1,220 @@
+# spotify_limiter.py
+# Spotify Web API 呼び出しの交通整理（全体のペース配分・Retry-After の共有・優先度・安全な再試行）
+import os
+import math
+import time
+import random
+import logging
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+import requests
+from requests.exceptions import ConnectTimeout
+from spotipy import SpotifyException
+from urllib3.exceptions import NewConnectionError, ConnectTimeoutError
+
+from metrics import REGISTRY, UPSTREAM_RETRIES
+from circuit_breaker import get_breaker, CircuitOpenError
+from rate_limit import TokenBucket, Cooldown, RedisTokenBucket, RedisCooldown
+
+logger = logging.getLogger(__name__)
+
+# アプリ全体（全ワーカー合計）で 1秒あたりに投げてよい回数と、一時的な集中の上限
+SPOTIFY_RATE = float(os.getenv("SPOTIFY_RATE", "10"))
+SPOTIFY_BURST = float(os.getenv("SPOTIFY_BURST", "30"))
+SPOTIFY_MAX_RETRIES = int(os.getenv("SPOTIFY_MAX_RETRIES", "3"))
+SPOTIFY_DEFAULT_RETRY_AFTER = 2.0   # 429 に Retry-After が無いとき（秒）
+
+# 優先度: 再生・キュー追加などユーザー操作 > 再生状態のポーリング > 先読み
+INTERACTIVE, POLL, BACKGROUND = "interactive", "poll", "background"
+# バケットに残しておく割合（低い優先度ほど多く残して上位に譲る）と、待ってよい最大秒数
+_FLOOR = {INTERACTIVE: 0.0, POLL: 0.2, BACKGROUND: 0.5}
+_MAX_WAIT = {INTERACTIVE: 5.0, POLL: 3.0, BACKGROUND: 30.0}
+
+# 同じ要求を2回送っても結果が変わらないメソッド。これ以外は「届いていない」と分かるときだけ再試行する
+_IDEMPOTENT = frozenset(["GET", "HEAD", "OPTIONS"])
+_RETRY_STATUS = frozenset([500, 502, 503, 504])
+
+# 5xx・通信エラーが続いたら、しばらく Spotify を呼ばずに即失敗させる（429 はペース配分側で扱う）
+SPOTIFY_BREAKER = get_breaker(
+    "spotify", slow_seconds=float(os.getenv("SPOTIFY_SLOW_SECONDS", "5")),
+    is_failure=lambda e: isinstance(e, (requests.ConnectionError, requests.Timeout)),
+)
+
+_priority: contextvars.ContextVar[str] = contextvars.ContextVar("spotify_priority", default=INTERACTIVE)
+
+THROTTLE_SECONDS = REGISTRY.counter(
+    "tune_spotify_throttle_seconds_total", "Spotify 呼び出しの送信待ち（ペース配分・Retry-After）", ("priority",),
+)
+THROTTLED = REGISTRY.counter(
+    "tune_spotify_throttled_total", "待ち時間の上限を超えたため送らなかった Spotify 呼び出し", ("priority",),
+)
+RATE_LIMITED = REGISTRY.counter(
+    "tune_spotify_rate_limited_total", "Spotify から 429 が返った回数", ("method",),
+)
+
+
+@contextmanager
+def spotify_priority(priority: str):
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def _not_sent(e: requests.RequestException) -> bool:
+    """接続できずに失敗した＝要求は Spotify に届いていない。"""
+    if isinstance(e, ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def _retry_after(resp: requests.Response) -> float:
+    try:
+        return max(0.0, float(resp.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return SPOTIFY_DEFAULT_RETRY_AFTER
+
+
+class SpotifyLimiter:
+    """
+    - 全体のペースはトークンバケットで配分（REDIS_URL があれば全ワーカー・全インスタンスで共有、
+      無ければワーカー数で割ったぶんをプロセスごとに持つ）
+    - 429 の Retry-After は全体で共有し、その間は誰も送らない
+    - 低い優先度はバケットの残りが少ないと待つ（ユーザー操作の分を残す）
+    - 再試行: GET 等は 429/5xx/通信失敗で、POST/PUT 等は 429 と「届いていない」通信失敗のときだけ
+    """
+    def __init__(self, rate: float = SPOTIFY_RATE, burst: float = SPOTIFY_BURST,
+                 max_retries: int = SPOTIFY_MAX_RETRIES, redis_url: Optional[str] = None):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.shared = False
+        if redis_url:
+            try:
+                import redis  # 使うときだけ読み込む
+                r = redis.Redis.from_url(redis_url)
+                r.ping()
+                self.bucket = RedisTokenBucket(r, "tie:spotify:bucket", rate, burst)
+                self.cooldown = RedisCooldown(r, "tie:spotify:cooldown")
+                self.shared = True
+            except Exception as e:
+                logger.warning(f"spotify limiter: redis unavailable, using per-process bucket: {e}")
+        if not self.shared:
+            self._use_local()
+
+    def _use_local(self):
+        workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+        self.bucket = TokenBucket(self.rate / workers, max(1.0, self.burst / workers))
+        self.cooldown = Cooldown()
+        self.shared = False
+
+    def _redis_failed(self, e: Exception):
+        # Redis が落ちても Spotify 呼び出しは止めない（以降はプロセス内で配分）
+        logger.warning(f"spotify limiter: redis error, falling back to per-process bucket: {e}")
+        self._use_local()
+
+    def _throttled(self, priority: str, wait: float) -> SpotifyException:
+        THROTTLED.inc(priority=priority)
+        return SpotifyException(
+            429, -1, f"rate limited locally ({priority}), retry in {wait:.1f}s",
+            headers={"Retry-After": str(max(1, math.ceil(wait)))},
+        )
+
+    def _wait_turn(self, priority: str):
+        """送ってよくなるまで待つ。上限を超えるなら送らずに 429 相当の例外。"""
+        try:
+            self._wait_turn_once(priority)
+        except SpotifyException:
+            raise
+        except Exception as e:
+            if not self.shared:
+                raise
+            self._redis_failed(e)
+            self._wait_turn_once(priority)
+
+    def _set_cooldown(self, seconds: float):
+        try:
+            self.cooldown.set(seconds)
+        except Exception as e:
+            if not self.shared:
+                raise
+            self._redis_failed(e)
+            self.cooldown.set(seconds)
+
+    def _wait_turn_once(self, priority: str):
+        started = time.monotonic()
+        deadline = started + _MAX_WAIT.get(priority, _MAX_WAIT[INTERACTIVE])
+        try:
+            while True:
+                cd = self.cooldown.remaining()
+                if cd <= 0:
+                    break
+                if time.monotonic() + cd > deadline:
+                    raise self._throttled(priority, cd)
+                time.sleep(cd)
+            floor = _FLOOR.get(priority, 0.0) * self.bucket.capacity
+            if not self.bucket.acquire(1, timeout=max(0.0, deadline - time.monotonic()), floor=floor):
+                raise self._throttled(priority, 1.0 / self.bucket.rate)
+        finally:
+            THROTTLE_SECONDS.inc(time.monotonic() - started, priority=priority)
+
+    def call(self, method: str, send: Callable[[], requests.Response]) -> requests.Response:
+        priority = _priority.get()
+        idempotent = method.upper() in _IDEMPOTENT
+        for attempt in range(self.max_retries + 1):
+            last = attempt >= self.max_retries
+            self._wait_turn(priority)
+            try:
+                with SPOTIFY_BREAKER.guard() as outcome:
+                    resp = send()
+                    outcome.failed = resp.status_code >= 500
+            except CircuitOpenError as e:
+                raise SpotifyException(
+                    503, -1, str(e), headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))},
+                ) from e
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if last or not (idempotent or _not_sent(e)):
+                    raise
+                UPSTREAM_RETRIES.inc(service="spotify", reason=type(e).__name__)
+                time.sleep(0.3 * (2 ** attempt) * random.uniform(0.5, 1.5))
+                continue
+
+            if resp.status_code == 429:
+                # 429 は処理されていないので、どのメソッドでも Retry-After 後に送り直してよい
+                wait = _retry_after(resp)
+                RATE_LIMITED.inc(method=method.upper())
+                self._set_cooldown(wait)
+                if last or wait > _MAX_WAIT.get(priority, 0):
+                    return resp
+                UPSTREAM_RETRIES.inc(service="spotify", reason="429")
+                continue
+            if resp.status_code in _RETRY_STATUS and idempotent and not last:
+                UPSTREAM_RETRIES.inc(service="spotify", reason=str(resp.status_code))
+                resp.close()
+                time.sleep(0.3 * (2 ** attempt) * random.uniform(0.5, 1.5))
+                continue
+            return resp
+        return resp
+
+    def snapshot(self) -> dict:
+        return {
+            "shared": self.shared,
+            "rate": self.bucket.rate,
+            "burst": self.bucket.capacity,
+            "waited_seconds": round(self.bucket.waited_seconds, 3),
+        }
+
+
+class RateLimitedSession(requests.Session):
+    """すべての request() を SpotifyLimiter 経由にする Session。"""
+    def __init__(self, limiter: SpotifyLimiter):
+        super().__init__()
+        self.limiter = limiter
+
+    def request(self, method, url, *args, **kwargs):
+        send = lambda: super(RateLimitedSession, self).request(method, url, *args, **kwargs)
+        return self.limiter.call(method, send)
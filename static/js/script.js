@@ -73,7 +73,8 @@ function getDeviceIdHint() {
 
 async function safeFetchJson(url, init) {
   try {
-    const res = await fetch(url, { cache: "no-store", ...(init || {}) });
+    // no-cache: ブラウザのキャッシュを使う前に ETag で再検証（変わっていなければ 304 で本文を省く）
+    const res = await fetch(url, { cache: "no-cache", ...(init || {}) });
     const ct = (res.headers.get("content-type") || "").toLowerCase();
     if (!ct.includes("application/json")) return null;
     return await res.json();
@@ -92,8 +93,9 @@ async function getAccessToken() {
 
 /* ===================== モデル→UI描画 ===================== */
 function setPlayIcons(isPlaying) {
-  const playPNG  = "/static/images/play.png";
-  const pausePNG = "/static/images/pause.png"; // pause.png が必須
+  const icons = window.STATIC_ICONS || {};
+  const playPNG  = icons.play  || "/static/images/play.png";
+  const pausePNG = icons.pause || "/static/images/pause.png"; // pause.png が必須
 
   const icon = isPlaying ? pausePNG : playPNG;
   const alt  = isPlaying ? "一時停止" : "再生";
@@ -108,8 +110,15 @@ function setPlayIcons(isPlaying) {
   }
 }
 
-function renderProgressFromModel() {
+function currentProgressMs() {
   const { durationMs, baseProgressMs, baseTimestampMs, isPlaying } = nowPlaying;
+  if (!isPlaying) return baseProgressMs;
+  const dt = Date.now() - baseTimestampMs;
+  return Math.min(durationMs, Math.max(0, baseProgressMs + dt));
+}
+
+function renderProgressFromModel() {
+  const { durationMs } = nowPlaying;
 
   if (!durationMs) {
     if (seekBar) seekBar.value = 0;
@@ -118,11 +127,7 @@ function renderProgressFromModel() {
     return;
   }
 
-  let prog = baseProgressMs;
-  if (isPlaying) {
-    const dt = Date.now() - baseTimestampMs;
-    prog = Math.min(durationMs, Math.max(0, baseProgressMs + dt));
-  }
+  const prog = currentProgressMs();
 
   if (seekBar) {
     const pct = Math.min(100, Math.max(0, (prog / durationMs) * 100));
@@ -184,6 +189,7 @@ async function reconcileFromApi() {
 let parsedLyrics = [];   // [{ t:秒, text:行 }]
 let currentLyricIndex = -1;
 let lastTrackId = null;
+let lyricsRetryTimer = null;
 
 function parseLRC(lrcText) {
   const out = [];
@@ -228,6 +234,15 @@ function renderLyrics(lines) {
   currentLyricIndex = -1;
 }
 
+function lyricIndexAt(sec) {
+  let idx = 0;
+  for (let i = 0; i < parsedLyrics.length; i++) {
+    if (sec >= parsedLyrics[i].t) idx = i;
+    else break;
+  }
+  return idx;
+}
+
 function highlightByTime(currentSec) {
   if (!parsedLyrics.length || !$content) return;
   let idx = currentLyricIndex;
@@ -266,9 +281,58 @@ async function fetchPlainLyrics() {
   return j || { ok: false };
 }
 
+function setTransLine(rows, i, text) {
+  if (i < 0 || i >= rows.length) return;
+  const transEl = rows[i].querySelector(".lyric-trans");
+  if (transEl && !transEl.textContent) transEl.textContent = text || "";
+}
+
+// NDJSON で1行ずつ受け取り、届いた行から埋める（再生位置付近を先に訳してもらう）
+async function translateParsedLyricsStream(lines) {
+  const res = await fetch("/api/translate_lines/stream", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ lines, start_index: lyricIndexAt(currentProgressMs() / 1000) })
+  });
+  if (!res.ok || !res.body) return false;
+
+  const rows = $content.getElementsByClassName("lyric-line");
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buf = "";
+  let done = false;
+  while (!done) {
+    const { value, done: eof } = await reader.read();
+    if (eof) break;
+    buf += decoder.decode(value, { stream: true });
+    let nl;
+    while ((nl = buf.indexOf("\n")) >= 0) {
+      const line = buf.slice(0, nl).trim();
+      buf = buf.slice(nl + 1);
+      if (!line) continue;
+      let ev;
+      try { ev = JSON.parse(line); } catch { continue; }
+      if (ev.done) { done = true; noteTranslationGaps(ev); break; }
+      setTransLine(rows, ev.i, ev.jp);
+    }
+  }
+  return done;
+}
+
+// 翻訳サービスが止まっていて訳せなかった行があるときはステータスに添える
+function noteTranslationGaps(info) {
+  if (info && info.unavailable > 0 && $status && !$status.textContent.includes('翻訳')) {
+    $status.textContent += '（一部の翻訳は現在利用できません）';
+  }
+}
+
 async function translateParsedLyrics() {
   if (!parsedLyrics.length || !translateEnabled) return;
   const lines = parsedLyrics.map(l => l.text || "");
+  try {
+    if (await translateParsedLyricsStream(lines)) return;
+  } catch {}
+  // ストリーミング非対応環境などは一括版へフォールバック
   try {
     const res = await fetch("/api/translate_lines", {
       method: "POST",
@@ -277,12 +341,10 @@ async function translateParsedLyrics() {
     });
     const data = await res.json();
     if (!data.ok || !Array.isArray(data.jp)) return;
+    noteTranslationGaps(data);
     const jp = data.jp;
     const rows = $content.getElementsByClassName("lyric-line");
-    for (let i = 0; i < Math.min(rows.length, jp.length); i++) {
-      const transEl = rows[i].querySelector(".lyric-trans");
-      if (transEl && !transEl.textContent) transEl.textContent = jp[i] || "";
-    }
+    for (let i = 0; i < Math.min(rows.length, jp.length); i++) setTransLine(rows, i, jp[i]);
   } catch {}
 }
 
@@ -294,6 +356,13 @@ async function loadLyricsOnce() {
     setLyricsPlain('');
 
     const meta = await fetchCurrentTrack();
+    if (meta.note === 'spotify unavailable') {
+      // Spotify 側が不調（サーキットが開いている等）。少し後に読み直す
+      setStatus('Spotifyに接続できません。しばらくすると自動で再読み込みします。');
+      clearTimeout(lyricsRetryTimer);
+      lyricsRetryTimer = setTimeout(loadLyricsOnce, (meta.retry_after || 5) * 1000);
+      return;
+    }
     if (!meta.ok || !meta.track_id) {
       setStatus('再生中の曲が見つかりません。Spotifyで再生してから更新してください。');
       return;
@@ -307,7 +376,17 @@ async function loadLyricsOnce() {
       renderLyrics(parsedLyrics);
       if (translateEnabled) translateParsedLyrics();
       if (currentPlaybackState) highlightByTime((currentPlaybackState.position || 0) / 1000);
-      setStatus(`${timedData.title} — ${timedData.artist}${timedData.synced ? '' : '（擬似同期）'}`);
+      setStatus(`${timedData.title} — ${timedData.artist}${timedData.synced ? '' : '（擬似同期）'}${timedData.stale ? '（保存済みの歌詞）' : ''}`);
+      return;
+    }
+    if (timedData && timedData.note === 'lyrics unavailable') {
+      // 歌詞サーバーが不調。タイムアウトを待たせず、少し後に読み直す
+      setStatus(`${meta.title} — ${meta.artist}`);
+      setLyricsPlain('歌詞サーバーに接続できません。しばらくすると自動で再読み込みします。');
+      clearTimeout(lyricsRetryTimer);
+      lyricsRetryTimer = setTimeout(() => {
+        if (lastTrackId === meta.track_id) loadLyricsOnce();
+      }, (timedData.retry_after || 5) * 1000);
       return;
     }
 
@@ -444,8 +523,43 @@ async function initPlayer() {
   }
 
   bindControls();
-  setInterval(reconcileFromApi, 8000);
-  setInterval(pollTrackChange, 8000);
+  startNowPlayingEvents();
+}
+
+/* ===================== 再生状態のプッシュ（SSE）／ポーリング ===================== */
+let pollTimers = null;
+
+function startPolling() {
+  if (pollTimers) return;
+  pollTimers = [
+    setInterval(reconcileFromApi, 8000),
+    setInterval(pollTrackChange, 8000),
+  ];
+}
+
+function applyNowPlayingEvent(e) {
+  let d;
+  try { d = JSON.parse(e.data); } catch { return; }
+  if (d.is_playing) {
+    setModelFromApi(d);
+  } else {
+    nowPlaying.isPlaying = false;
+    nowPlaying.baseTimestampMs = Date.now();
+    applyMetaToUI();
+  }
+  if (d.track_id && d.track_id !== lastTrackId) loadLyricsOnce();
+}
+
+// サーバからのイベントで更新。使えない環境（204/接続不可/認証切れ）は8秒ポーリングに戻す
+function startNowPlayingEvents() {
+  if (!window.EventSource) { startPolling(); return; }
+  const es = new EventSource('/api/now_playing/events');
+  es.addEventListener('track', applyNowPlayingEvent);
+  es.addEventListener('state', applyNowPlayingEvent);
+  es.addEventListener('auth', () => { es.close(); startPolling(); });
+  es.addEventListener('error', () => {
+    if (es.readyState === EventSource.CLOSED) startPolling();
+  });
 }
 
 /* ===================== rAF ティッカー ===================== */
@@ -0,0 +1,108 @@
+# static_assets.py
+# 静的ファイルの内容ハッシュ（URL の ?v=）と事前圧縮（.gz / .br）
+#
+# 事前圧縮はビルド時に1回だけ実行する:  python static_assets.py [static_dir]
+import os
+import sys
+import gzip
+import hashlib
+import threading
+from typing import Optional, Tuple
+
+try:
+    import brotli  # 任意（無ければ .gz だけ作る）
+except ImportError:
+    brotli = None
+
+# 圧縮して得のある種類だけ（PNG などは既に圧縮済み）
+COMPRESSIBLE = (".js", ".css", ".svg", ".html", ".json", ".txt", ".map")
+# Accept-Encoding が両方許すなら br を優先
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+_versions: dict = {}   # path -> (mtime, hash)
+_lock = threading.Lock()
+
+
+def _safe_path(static_folder: str, filename: str) -> Optional[str]:
+    root = os.path.realpath(static_folder)
+    path = os.path.realpath(os.path.join(root, filename))
+    if not path.startswith(root + os.sep) or not os.path.isfile(path):
+        return None
+    return path
+
+
+def asset_version(static_folder: str, filename: str) -> Optional[str]:
+    """ファイル内容のハッシュ（先頭12文字）。更新されたら変わる。無ければ None。"""
+    path = _safe_path(static_folder, filename)
+    if path is None:
+        return None
+    mtime = os.stat(path).st_mtime
+    with _lock:
+        ent = _versions.get(path)
+        if ent and ent[0] == mtime:
+            return ent[1]
+    with open(path, "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:12]
+    with _lock:
+        _versions[path] = (mtime, digest)
+    return digest
+
+
+def _accepts(accept_encoding: str, encoding: str) -> bool:
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip().lower() in (encoding, "*"):
+            return params.replace(" ", "") not in ("q=0", "q=0.0")
+    return False
+
+
+def pick_variant(static_folder: str, filename: str, accept_encoding: str) -> Optional[Tuple[str, str]]:
+    """
+    クライアントが受け取れる事前圧縮版があれば (static からの相対パス, Content-Encoding) を返す。
+    元ファイルより古い圧縮版（圧縮し忘れ）は使わない。
+    """
+    if not filename.endswith(COMPRESSIBLE) or not accept_encoding:
+        return None
+    path = _safe_path(static_folder, filename)
+    if path is None:
+        return None
+    mtime = os.stat(path).st_mtime
+    for encoding, ext in ENCODINGS:
+        if not _accepts(accept_encoding, encoding):
+            continue
+        try:
+            if os.stat(path + ext).st_mtime >= mtime:
+                return filename + ext, encoding
+        except OSError:
+            continue
+    return None
+
+
+def compress_static(static_folder: str) -> list:
+    """COMPRESSIBLE のファイルごとに .gz（と brotli があれば .br）を書く。書いたパスを返す。"""
+    written = []
+    for root, _, files in os.walk(static_folder):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE):
+                continue
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                data = f.read()
+            outputs = [(".gz", gzip.compress(data, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                outputs.append((".br", brotli.compress(data, quality=11)))
+            for ext, blob in outputs:
+                if len(blob) >= len(data):
+                    continue   # 小さくならないものは置かない
+                with open(path + ext, "wb") as f:
+                    f.write(blob)
+                written.append(path + ext)
+    return written
+
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), "static")
+    for p in compress_static(folder):
+        print(f"  {os.path.relpath(p, folder)} ({os.path.getsize(p)} bytes)")
+    if brotli is None:
+        print("brotli not installed: wrote .gz only")
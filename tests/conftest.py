@@ -0,0 +1,40 @@
+# tests/conftest.py
+# 共通の準備（リポジトリ直下を import パスに入れ、ディスクキャッシュ等はテスト中に作らない）
+import os
+import sys
+
+os.environ["CACHE_DB_PATH"] = ""
+os.environ["LYRICS_INDEX_PATH"] = ""
+os.environ.setdefault("TOKEN_STORE", "memory")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+class FakeClock:
+    """time モジュールの代わり。sleep() は待たずに時計を進める。"""
+    def __init__(self, start: float = 1_000_000.0):
+        self.now = start
+        self.slept: list = []
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def perf_counter(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.slept.append(seconds)
+        self.now += max(0.0, seconds)
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
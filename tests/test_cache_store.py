@@ -0,0 +1,106 @@
+import cache_store
+from cache_store import TieredCache, MISS
+
+
+def _cache(monkeypatch, clock, **kw):
+    monkeypatch.setattr(cache_store, "time", clock)
+    return TieredCache("test", ttl=100, negative_ttl=10, **kw)
+
+
+def test_negative_result_expires_after_negative_ttl(monkeypatch, clock):
+    c = _cache(monkeypatch, clock)
+    c.set("k", None)
+    assert c.get("k") is None          # 「見つからなかった」もヒット
+    assert c.stats()["negative_hits"] == 1
+    clock.advance(11)
+    assert c.get("k") is MISS
+    assert c.stats()["misses"] == 1
+
+
+def test_positive_result_uses_normal_ttl(monkeypatch, clock):
+    c = _cache(monkeypatch, clock)
+    c.set("k", "v")
+    clock.advance(99)
+    assert c.get("k") == "v"
+    clock.advance(2)
+    assert c.get("k") is MISS
+
+
+def test_disk_layer_survives_restart_and_expires(monkeypatch, clock, tmp_path):
+    path = str(tmp_path / "cache.db")
+    c = _cache(monkeypatch, clock, db_path=path)
+    c.set("k", {"a": 1})
+    c.set("none", None)
+    # 別プロセス相当（メモリ層は空）でもディスク層から読める
+    other = TieredCache("test", ttl=100, negative_ttl=10, db_path=path)
+    assert other.get("k") == {"a": 1}
+    assert other.get("none") is None
+    assert (other.stats()["disk_hits"], other.stats()["negative_hits"]) == (1, 1)
+    clock.advance(11)
+    other = TieredCache("test", ttl=100, negative_ttl=10, db_path=path)
+    assert other.get("none") is MISS
+    assert other.get("k") == {"a": 1}
+
+
+def test_stale_value_is_kept_for_stale_ttl(monkeypatch, clock):
+    c = _cache(monkeypatch, clock, stale_ttl=50)
+    c.set("k", "v")
+    assert c.get_entry("k") == ("v", False)
+    clock.advance(101)
+    assert c.get("k") is MISS                  # get() は新鮮な値だけ
+    assert c.get_entry("k") == ("v", True)     # get_entry() は古い値も返す
+    assert c.stats()["stale_hits"] == 1
+    clock.advance(50)
+    assert c.get_entry("k") is None
+
+
+def test_negative_result_goes_stale_after_negative_ttl(monkeypatch, clock):
+    c = _cache(monkeypatch, clock, stale_ttl=50)
+    c.set("k", None)
+    clock.advance(11)
+    assert c.get_entry("k") == (None, True)
+
+
+def test_get_first_entry_prefers_fresh_over_stale(monkeypatch, clock):
+    c = _cache(monkeypatch, clock, stale_ttl=50)
+    c.set("old", "stale")
+    clock.advance(101)
+    c.set("new", "fresh")
+    assert c.get_first_entry(["old", "new"]) == ("fresh", False)
+    assert c.get_first_entry(["old", "missing"]) == ("stale", True)
+    assert c.get_first(["old", "missing"]) is MISS
+
+
+def test_disk_layer_keeps_stored_time_for_staleness(monkeypatch, clock, tmp_path):
+    path = str(tmp_path / "cache.db")
+    c = _cache(monkeypatch, clock, db_path=path, stale_ttl=50)
+    c.set("k", {"a": 1})
+    clock.advance(101)
+    other = TieredCache("test", ttl=100, negative_ttl=10, db_path=path, stale_ttl=50)
+    assert other.get_entry("k") == ({"a": 1}, True)
+    assert other.stats()["stale_hits"] == 1
+
+
+def _disk_rows(path):
+    import sqlite3
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT COUNT(*) FROM kv").fetchone()[0]
+
+
+def test_expired_rows_are_purged_without_being_read(monkeypatch, clock, tmp_path):
+    path = str(tmp_path / "cache.db")
+    c = _cache(monkeypatch, clock, db_path=path)
+    c.disk.purge_interval = 60
+    c.disk._next_purge = clock.now
+    c.set("gone", None)
+    c.set("kept", "v")
+    assert _disk_rows(path) == 2
+    clock.advance(30)
+    c.set("other", "v")            # 掃除の間隔前なので残る
+    assert _disk_rows(path) == 3
+    clock.advance(31)
+    c.set("other", "v")
+    assert _disk_rows(path) == 2
+    clock.advance(200)
+    TieredCache("test", ttl=100, negative_ttl=10, db_path=path)   # 開いたときにも掃除する
+    assert _disk_rows(path) == 0
@@ -0,0 +1,107 @@
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CircuitBreaker, CircuitOpenError, CLOSED, OPEN, HALF_OPEN
+
+
+@pytest.fixture
+def breaker(monkeypatch, clock):
+    monkeypatch.setattr(circuit_breaker, "time", clock)
+    return CircuitBreaker("test", slow_seconds=2, window=30, min_calls=4,
+                          failure_ratio=0.5, open_seconds=10, half_open_probes=1,
+                          is_failure=lambda e: not isinstance(e, KeyError))
+
+
+def _ok(b):
+    with b.guard():
+        pass
+
+
+def _fail(b):
+    with pytest.raises(RuntimeError):
+        with b.guard():
+            raise RuntimeError("boom")
+
+
+def _open(b):
+    for _ in range(2):
+        _ok(b)
+    for _ in range(2):
+        _fail(b)
+    assert b.state == OPEN
+
+
+def test_stays_closed_below_min_calls(breaker):
+    for _ in range(3):
+        _fail(breaker)
+    assert breaker.state == CLOSED
+    _fail(breaker)
+    assert breaker.state == OPEN
+
+
+def test_open_rejects_without_calling(breaker, clock):
+    _open(breaker)
+    clock.advance(4)
+    called = []
+    with pytest.raises(CircuitOpenError) as exc:
+        with breaker.guard():
+            called.append(1)
+    assert not called
+    assert exc.value.retry_after == pytest.approx(6)
+    assert breaker.rejecting()
+
+
+def test_half_open_probe_success_closes(breaker, clock):
+    _open(breaker)
+    clock.advance(10)
+    assert not breaker.rejecting()
+    with breaker.guard():
+        assert breaker.state == HALF_OPEN
+        # 試し呼び出しの最中は2本目を通さない
+        assert breaker.rejecting()
+        with pytest.raises(CircuitOpenError):
+            with breaker.guard():
+                pass
+    assert breaker.state == CLOSED
+    assert breaker.snapshot()["recent_calls"] == 0
+
+
+def test_half_open_probe_failure_reopens(breaker, clock):
+    _open(breaker)
+    clock.advance(10)
+    _fail(breaker)
+    assert breaker.state == OPEN
+    assert breaker.retry_after() == pytest.approx(10)
+    clock.advance(10)
+    _ok(breaker)
+    assert breaker.state == CLOSED
+
+
+def test_slow_call_counts_as_failure(breaker, clock):
+    for _ in range(2):
+        _ok(breaker)
+    for _ in range(2):
+        with breaker.guard():
+            clock.advance(3)
+    assert breaker.state == OPEN
+
+
+def test_marked_failure_and_excluded_exceptions(breaker):
+    for _ in range(4):
+        with pytest.raises(KeyError):
+            with breaker.guard():
+                raise KeyError("not an upstream fault")
+    assert breaker.state == CLOSED
+    for _ in range(4):
+        with breaker.guard() as call:
+            call.failed = True
+    assert breaker.state == OPEN
+
+
+def test_old_calls_leave_the_window(breaker, clock):
+    for _ in range(3):
+        _fail(breaker)
+    clock.advance(31)
+    _ok(breaker)
+    assert breaker.state == CLOSED
+    assert breaker.snapshot()["recent_calls"] == 1
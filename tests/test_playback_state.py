@@ -0,0 +1,49 @@
+import pytest
+
+import playback_state
+from playback_state import wait_for_device
+
+
+class FakeSpotify:
+    def __init__(self, clock, active_at=None, device_id="dev"):
+        self.clock = clock
+        self.active_at = active_at
+        self.device_id = device_id
+        self.checked_at = []
+
+    def current_playback(self):
+        self.checked_at.append(self.clock.now)
+        if self.active_at is not None and self.clock.now >= self.active_at:
+            return {"device": {"id": self.device_id}}
+        return {"device": {"id": "other"}}
+
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(playback_state, "time", clock)
+
+
+def test_wait_for_device_checks_at_most_n_times(clock):
+    sp = FakeSpotify(clock)
+    start = clock.now
+    assert wait_for_device(sp, "dev", timeout=2.5, checks=4) is False
+    assert [round(t - start, 2) for t in sp.checked_at] == [0.3, 0.9, 2.1, 2.5]
+
+
+def test_wait_for_device_returns_once_active(clock):
+    sp = FakeSpotify(clock, active_at=clock.now + 0.5)
+    assert wait_for_device(sp, "dev", timeout=2.5, checks=4) is True
+    assert len(sp.checked_at) == 2
+
+
+def test_wait_for_device_ignores_transient_errors(clock):
+    class Flaky(FakeSpotify):
+        def current_playback(self):
+            if not self.checked_at:
+                self.checked_at.append(self.clock.now)
+                raise ConnectionError("reset")
+            return super().current_playback()
+
+    sp = Flaky(clock, active_at=clock.now)
+    assert wait_for_device(sp, "dev", timeout=2.5, checks=4) is True
+    assert len(sp.checked_at) == 2
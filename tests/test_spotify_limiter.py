@@ -0,0 +1,180 @@
+import io
+
+import pytest
+import requests
+from spotipy import SpotifyException
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ConnectTimeoutError
+
+import circuit_breaker
+import rate_limit
+import spotify_limiter
+from spotify_limiter import SpotifyLimiter, SPOTIFY_BREAKER, _not_sent, spotify_priority, BACKGROUND
+
+
+@pytest.fixture
+def limiter(monkeypatch, clock):
+    for mod in (spotify_limiter, rate_limit, circuit_breaker):
+        monkeypatch.setattr(mod, "time", clock)
+    monkeypatch.setattr(SPOTIFY_BREAKER, "state", circuit_breaker.CLOSED)
+    monkeypatch.setattr(SPOTIFY_BREAKER, "_calls", type(SPOTIFY_BREAKER._calls)())
+    monkeypatch.setenv("WEB_CONCURRENCY", "1")
+    return SpotifyLimiter(rate=100, burst=100, max_retries=3)
+
+
+def _resp(status: int, **headers) -> requests.Response:
+    r = requests.Response()
+    r.status_code = status
+    r.headers.update(headers)
+    r.raw = io.BytesIO(b"")
+    return r
+
+
+def _sender(*outcomes):
+    """outcomes を順に返す（例外なら投げる）send。呼ばれた回数は .calls。"""
+    outcomes = list(outcomes)
+
+    def send():
+        send.calls += 1
+        out = outcomes.pop(0)
+        if isinstance(out, BaseException):
+            raise out
+        return out
+    send.calls = 0
+    return send
+
+
+def _refused():
+    return requests.ConnectionError(MaxRetryError(None, "/v1/me", NewConnectionError(None, "refused")))
+
+
+# ==============================
+# 429 / Retry-After
+# ==============================
+@pytest.mark.parametrize("method", ["GET", "POST"])
+def test_429_waits_retry_after_then_resends(limiter, clock, method):
+    send = _sender(_resp(429, **{"Retry-After": "3"}), _resp(200))
+    start = clock.now
+    assert limiter.call(method, send).status_code == 200
+    assert send.calls == 2
+    assert clock.now - start == pytest.approx(3)
+
+
+def test_429_without_retry_after_uses_default(limiter, clock):
+    send = _sender(_resp(429), _resp(200))
+    start = clock.now
+    assert limiter.call("GET", send).status_code == 200
+    assert clock.now - start == pytest.approx(spotify_limiter.SPOTIFY_DEFAULT_RETRY_AFTER)
+
+
+def test_long_retry_after_is_returned_and_shared(limiter, clock):
+    send = _sender(_resp(429, **{"Retry-After": "60"}))
+    assert limiter.call("GET", send).status_code == 429
+    assert send.calls == 1
+    # 待ちが上限（ユーザー操作は5秒）を超える間は、送らずに手元で 429
+    other = _sender(_resp(200))
+    with pytest.raises(SpotifyException) as exc:
+        limiter.call("GET", other)
+    assert exc.value.http_status == 429
+    assert other.calls == 0
+    assert int(exc.value.headers["Retry-After"]) == 60
+
+
+def test_background_waits_out_shared_cooldown(limiter, clock):
+    limiter.call("GET", _sender(_resp(429, **{"Retry-After": "20"})))
+    send = _sender(_resp(200))
+    start = clock.now
+    with spotify_priority(BACKGROUND):
+        assert limiter.call("GET", send).status_code == 200
+    assert clock.now - start == pytest.approx(20)
+
+
+def test_429_on_last_attempt_is_returned(limiter):
+    send = _sender(*[_resp(429, **{"Retry-After": "1"}) for _ in range(4)])
+    assert limiter.call("PUT", send).status_code == 429
+    assert send.calls == 4
+
+
+# ==============================
+# 5xx・通信エラーの再試行
+# ==============================
+def test_5xx_retried_only_for_idempotent(limiter):
+    get = _sender(_resp(502), _resp(200))
+    assert limiter.call("GET", get).status_code == 200
+    assert get.calls == 2
+    post = _sender(_resp(502), _resp(200))
+    assert limiter.call("POST", post).status_code == 502
+    assert post.calls == 1
+
+
+def test_connect_timeout_retried_for_post(limiter):
+    send = _sender(requests.ConnectTimeout("connect"), _resp(204))
+    assert limiter.call("POST", send).status_code == 204
+    assert send.calls == 2
+
+
+def test_refused_connection_retried_for_put(limiter):
+    send = _sender(_refused(), _resp(204))
+    assert limiter.call("PUT", send).status_code == 204
+    assert send.calls == 2
+
+
+@pytest.mark.parametrize("error", [
+    requests.ReadTimeout("read"),
+    requests.ConnectionError("connection reset by peer"),
+])
+def test_possibly_sent_post_is_not_retried(limiter, error):
+    send = _sender(error, _resp(204))
+    with pytest.raises(type(error)):
+        limiter.call("POST", send)
+    assert send.calls == 1
+
+
+def test_connection_error_retried_for_get(limiter):
+    send = _sender(requests.ReadTimeout("read"), requests.ConnectionError("reset"), _resp(200))
+    assert limiter.call("GET", send).status_code == 200
+    assert send.calls == 3
+
+
+def test_retries_are_bounded(limiter):
+    send = _sender(*[requests.ConnectTimeout("connect") for _ in range(4)])
+    with pytest.raises(requests.ConnectTimeout):
+        limiter.call("GET", send)
+    assert send.calls == 4
+
+
+@pytest.mark.parametrize("error, expected", [
+    (requests.ConnectTimeout("connect"), True),
+    (requests.ConnectionError(MaxRetryError(None, "/", NewConnectionError(None, "refused"))), True),
+    (requests.ConnectionError(MaxRetryError(None, "/", ConnectTimeoutError("timed out"))), True),
+    (requests.ConnectionError(MaxRetryError(None, "/", OSError("reset"))), False),
+    (requests.ConnectionError("reset"), False),
+    (requests.ConnectionError(), False),
+    (requests.ReadTimeout("read"), False),
+])
+def test_not_sent(error, expected):
+    assert _not_sent(error) is expected
+
+
+# ==============================
+# サーキットブレーカー
+# ==============================
+def test_open_breaker_surfaces_as_503_with_retry_after(limiter, monkeypatch):
+    monkeypatch.setattr(SPOTIFY_BREAKER, "min_calls", 2)
+    for _ in range(2):
+        with pytest.raises(requests.ReadTimeout):
+            limiter.call("POST", _sender(requests.ReadTimeout("read")))
+    assert SPOTIFY_BREAKER.state == circuit_breaker.OPEN
+    send = _sender(_resp(200))
+    with pytest.raises(SpotifyException) as exc:
+        limiter.call("GET", send)
+    assert exc.value.http_status == 503
+    assert int(exc.value.headers["Retry-After"]) >= 1
+    assert send.calls == 0
+
+
+def test_429_does_not_trip_the_breaker(limiter, monkeypatch):
+    monkeypatch.setattr(SPOTIFY_BREAKER, "min_calls", 2)
+    for _ in range(3):
+        limiter.call("GET", _sender(_resp(429, **{"Retry-After": "60"})))
+        limiter.cooldown._until = 0
+    assert SPOTIFY_BREAKER.state == circuit_breaker.CLOSED
@@ -0,0 +1,50 @@
+import sqlite3
+
+import pytest
+
+import token_store
+from token_store import MemoryTokenStore, SqliteTokenStore, TOKEN_TTL, PRUNE_INTERVAL
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, monkeypatch, clock, tmp_path):
+    monkeypatch.setattr(token_store, "time", clock)
+    if request.param == "memory":
+        return MemoryTokenStore()
+    return SqliteTokenStore(str(tmp_path / "tokens.db"))
+
+
+def _count(store):
+    if isinstance(store, MemoryTokenStore):
+        return len(store._data)
+    with sqlite3.connect(store.path) as conn:
+        return conn.execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+
+
+def test_expired_entries_are_pruned_on_write(store, clock):
+    store.set("old", {"access_token": "a"})
+    clock.advance(TOKEN_TTL + 1)
+    assert store.get("old") is None
+    store.set("new", {"access_token": "b"})
+    assert _count(store) == 1
+    assert store.get("new") == {"access_token": "b"}
+
+
+def test_prune_runs_at_most_once_per_interval(store, clock):
+    store.set("a", {"access_token": "a"})
+    clock.advance(TOKEN_TTL - PRUNE_INTERVAL / 2)
+    store.set("b", {"access_token": "b"})      # ここで掃除（a はまだ有効）
+    clock.advance(PRUNE_INTERVAL / 2 + 1)      # a が切れたが、掃除の間隔前
+    store.set("c", {"access_token": "c"})
+    assert _count(store) == 3
+    clock.advance(PRUNE_INTERVAL)
+    store.set("d", {"access_token": "d"})
+    assert _count(store) == 3
+
+
+def test_sqlite_prunes_on_open(monkeypatch, clock, tmp_path):
+    monkeypatch.setattr(token_store, "time", clock)
+    path = str(tmp_path / "tokens.db")
+    SqliteTokenStore(path).set("old", {"access_token": "a"})
+    clock.advance(TOKEN_TTL + 1)
+    assert _count(SqliteTokenStore(path)) == 0
@@ -0,0 +1,175 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import circuit_breaker
+import translation_service
+from translation_service import (
+    TranslationScheduler, _Item, _estimate_tokens, _parse_numbered,
+    _stream_chunk, _translate_chunk_with_retry, OPENAI_BREAKER,
+)
+
+
+class FakeClient:
+    """
+    chat.completions.create の代わり。送られた「番号<TAB>歌詞」を「番号<TAB>訳:歌詞」で返す。
+    drop に入っている歌詞は、その回数だけ返さない（行のずれ）。
+    """
+    def __init__(self, drop=None, stream_error_after=None):
+        self.drop = dict(drop or {})
+        self.stream_error_after = stream_error_after
+        self.calls = []   # (stream, 送った歌詞の一覧)
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, temperature, stream=False, stream_options=None):
+        numbered = messages[-1]["content"].split("\n\n", 1)[1].splitlines()
+        lines = [row.split("\t", 1)[1] for row in numbered]
+        out = []
+        with self._lock:
+            self.calls.append((stream, lines))
+            for n, line in enumerate(lines, start=1):
+                if self.drop.get(line, 0) > 0:
+                    self.drop[line] -= 1
+                    continue
+                out.append(f"{n}\t訳:{line}")
+        text = "\n".join(out)
+        if not stream:
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=None)
+        return self._events(text)
+
+    def _events(self, text):
+        # 行の途中で切れたチャンクで流す
+        for i in range(0, len(text), 5):
+            if self.stream_error_after is not None and i >= self.stream_error_after:
+                raise ConnectionError("stream reset")
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text[i:i + 5]))], usage=None)
+        yield SimpleNamespace(choices=[], usage=None)
+
+
+@pytest.fixture(autouse=True)
+def closed_breaker(monkeypatch):
+    monkeypatch.setattr(OPENAI_BREAKER, "state", circuit_breaker.CLOSED)
+    monkeypatch.setattr(OPENAI_BREAKER, "_calls", type(OPENAI_BREAKER._calls)())
+    monkeypatch.setattr(translation_service, "RETRY_BACKOFF", 0)
+
+
+# ==============================
+# 番号での突き合わせ
+# ==============================
+@pytest.mark.parametrize("raw, expected", [
+    ("1\thello", (0, "hello")),
+    ("2. world", (1, "world")),
+    ("3）さよなら", (2, "さよなら")),
+    ("4\tout of range", None),
+    ("0\tzero", None),
+    ("no number", None),
+])
+def test_parse_numbered(raw, expected):
+    assert _parse_numbered(raw, 3) == expected
+
+
+def test_retry_resends_only_missing_lines():
+    client = FakeClient(drop={"b": 1})
+    assert _translate_chunk_with_retry(client, ["a", "b", "c"], "m") == ["訳:a", "訳:b", "訳:c"]
+    assert [lines for _, lines in client.calls] == [["a", "b", "c"], ["b"]]
+
+
+def test_retry_gives_up_with_empty_line():
+    client = FakeClient(drop={"b": 99})
+    assert _translate_chunk_with_retry(client, ["a", "b"], "m") == ["訳:a", ""]
+    assert len(client.calls) == translation_service.CHUNK_RETRIES + 1
+
+
+def test_stream_falls_back_for_misaligned_lines():
+    client = FakeClient(drop={"y": 1})
+    got = {}
+    _stream_chunk(client, ["x", "y", "z"], "m", lambda j, jp: got.__setitem__(j, jp))
+    assert got == {0: "訳:x", 1: "訳:y", 2: "訳:z"}
+    assert client.calls == [(True, ["x", "y", "z"]), (False, ["y"])]
+
+
+def test_stream_failure_resends_the_rest():
+    client = FakeClient(stream_error_after=10)   # "1\t訳:p\n2\t" まで届いて切れる
+    got = {}
+    _stream_chunk(client, ["p", "q", "r"], "m", lambda j, jp: got.__setitem__(j, jp))
+    assert got == {0: "訳:p", 1: "訳:q", 2: "訳:r"}
+    assert client.calls[1] == (False, ["q", "r"])
+
+
+# ==============================
+# まとめ送り
+# ==============================
+def _queue(sched, client, texts, model="m"):
+    for n, text in enumerate(texts):
+        sched._queue.append(_Item(f"k{id(client)}-{n}-{text}", text, client, model))
+
+
+def test_take_batch_stops_at_token_budget():
+    sched = TranslationScheduler(batch_tokens=10, min_tokens=10, max_lines=40, concurrency=1)
+    a = FakeClient()
+    texts = ["x" * 12, "y" * 12, "z" * 12]   # 1行 5 トークン
+    assert _estimate_tokens(texts[0]) == 5
+    _queue(sched, a, texts)
+    assert [it.text for it in sched._take_batch()] == texts[:2]
+    assert [it.text for it in sched._queue] == texts[2:]
+
+
+def test_take_batch_always_takes_one_oversized_line():
+    sched = TranslationScheduler(batch_tokens=10, min_tokens=10, concurrency=1)
+    _queue(sched, FakeClient(), ["x" * 300, "y"])
+    assert [it.text for it in sched._take_batch()] == ["x" * 300]
+
+
+def test_take_batch_respects_max_lines():
+    sched = TranslationScheduler(batch_tokens=800, max_lines=3, concurrency=1)
+    _queue(sched, FakeClient(), list("abcde"))
+    assert [it.text for it in sched._take_batch()] == list("abc")
+
+
+def test_take_batch_groups_by_client_and_model_keeping_order():
+    sched = TranslationScheduler(batch_tokens=800, concurrency=1)
+    a, b = FakeClient(), FakeClient()
+    _queue(sched, a, ["a1"])
+    _queue(sched, b, ["b1"])
+    _queue(sched, a, ["a2"])
+    _queue(sched, a, ["a3"], model="other")
+    assert [it.text for it in sched._take_batch()] == ["a1", "a2"]
+    assert [it.text for it in sched._queue] == ["b1", "a3"]
+
+
+def test_batch_budget_splits_queue_across_idle_slots():
+    sched = TranslationScheduler(batch_tokens=800, min_tokens=10, concurrency=4)
+    _queue(sched, FakeClient(), ["x" * 57] * 8)   # 1行 20 トークン、計 160
+    assert sched._batch_budget() == 40
+    sched._active = 3   # 空きは今の1本だけ
+    assert sched._batch_budget() == 160
+
+
+def test_concurrent_submits_share_one_call():
+    sched = TranslationScheduler(window=0.2, batch_tokens=800, concurrency=1)
+    client = FakeClient()
+    first = sched.submit(client, ["sched-one", "sched-two"], ["sk1", "sk2"], model="m")
+    second = sched.submit(client, ["sched-two", "sched-three"], ["sk2", "sk3"], model="m")
+    assert [f.result(timeout=5) for f in first + second] == [
+        "訳:sched-one", "訳:sched-two", "訳:sched-two", "訳:sched-three",
+    ]
+    assert client.calls == [(True, ["sched-one", "sched-two", "sched-three"])]
+    snap = sched.snapshot()
+    assert (snap["batches"], snap["lines_queued"], snap["lines_shared"]) == (1, 3, 1)
+    assert snap["inflight"] == 0
+    assert translation_service.TRANSLATION_MEMO.get("sk3") == "訳:sched-three"
+
+
+def test_failed_batch_fails_every_future():
+    class Broken(FakeClient):
+        def create(self, *a, **kw):
+            raise RuntimeError("boom")
+
+    sched = TranslationScheduler(window=0.05, concurrency=1)
+    futures = sched.submit(Broken(), ["broken-a", "broken-b"], ["bk1", "bk2"], model="m")
+    for f in futures:
+        with pytest.raises(RuntimeError):
+            f.result(timeout=5)
+    assert sched.snapshot()["errors"] == 1
@@ -0,0 +1,187 @@
+# token_store.py
+# Spotify の token_info をサーバ側に保存する（Cookie には不透明なセッションIDだけを載せる）
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+TOKEN_TTL = 60 * 60 * 24 * 30   # refresh_token を保持する期間（秒）
+LOCK_TIMEOUT = 15               # リフレッシュ待ちの上限（秒）
+PRUNE_INTERVAL = 60 * 60        # 期限切れの削除（set() のついでに）の間隔（秒）
+
+
+class _StripedLocks:
+    """セッションIDごとのロック（ハッシュで固定本数に割り当て、メモリを増やさない）。"""
+    def __init__(self, n: int = 64):
+        self._locks = [threading.Lock() for _ in range(n)]
+
+    def get(self, sid: str) -> threading.Lock:
+        h = int(hashlib.sha1(sid.encode()).hexdigest()[:8], 16)
+        return self._locks[h % len(self._locks)]
+
+
+class TokenStore:
+    name = "base"
+
+    def get(self, sid: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def set(self, sid: str, token_info: dict):
+        raise NotImplementedError
+
+    def delete(self, sid: str):
+        raise NotImplementedError
+
+    @contextmanager
+    def lock(self, sid: str, blocking: bool = True):
+        """同じセッションのリフレッシュを1本にまとめるためのロック。取れなければ False を渡す。"""
+        lk = self._locks.get(sid)
+        ok = lk.acquire(timeout=LOCK_TIMEOUT) if blocking else lk.acquire(blocking=False)
+        try:
+            yield ok
+        finally:
+            if ok:
+                lk.release()
+
+
+class MemoryTokenStore(TokenStore):
+    """単一プロセス用（開発・ワーカー1つ向け）。"""
+    name = "memory"
+
+    def __init__(self):
+        self._data: dict = {}
+        self._locks = _StripedLocks()
+        self._mu = threading.Lock()
+        self._next_prune = 0.0
+
+    def get(self, sid):
+        with self._mu:
+            ent = self._data.get(sid)
+        if not ent or ent[1] <= time.time():
+            return None
+        return dict(ent[0])
+
+    def set(self, sid, token_info):
+        now = time.time()
+        with self._mu:
+            self._data[sid] = (dict(token_info), now + TOKEN_TTL)
+            if now >= self._next_prune:
+                self._next_prune = now + PRUNE_INTERVAL
+                for k in [k for k, ent in self._data.items() if ent[1] <= now]:
+                    del self._data[k]
+
+    def delete(self, sid):
+        with self._mu:
+            self._data.pop(sid, None)
+
+
+class SqliteTokenStore(TokenStore):
+    """同じホストの複数ワーカーで共有できる。"""
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._locks = _StripedLocks()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS tokens ("
+            " sid TEXT PRIMARY KEY, token_info TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.commit()
+        self._next_prune = 0.0
+        self._prune()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():   # preload 後の fork では開き直す
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, sid):
+        row = self._conn().execute(
+            "SELECT token_info, expires_at FROM tokens WHERE sid=?", (sid,)
+        ).fetchone()
+        if not row or row[1] <= time.time():
+            return None
+        return json.loads(row[0])
+
+    def set(self, sid, token_info):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO tokens (sid, token_info, expires_at) VALUES (?, ?, ?)",
+            (sid, json.dumps(token_info), time.time() + TOKEN_TTL),
+        )
+        conn.commit()
+        if time.time() >= self._next_prune:
+            self._prune()
+
+    def delete(self, sid):
+        conn = self._conn()
+        conn.execute("DELETE FROM tokens WHERE sid=?", (sid,))
+        conn.commit()
+
+    def _prune(self):
+        """期限切れの行を消す（開いたときと、set() のついでに PRUNE_INTERVAL ごと）。"""
+        now = time.time()
+        self._next_prune = now + PRUNE_INTERVAL
+        conn = self._conn()
+        conn.execute("DELETE FROM tokens WHERE expires_at<=?", (now,))
+        conn.commit()
+
+
+class RedisTokenStore(TokenStore):
+    """複数インスタンスで共有。リフレッシュのロックも Redis 上で取る。"""
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str = "tie:token:"):
+        import redis  # 使うときだけ読み込む
+        self._r = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, sid):
+        raw = self._r.get(self.prefix + sid)
+        return json.loads(raw) if raw else None
+
+    def set(self, sid, token_info):
+        self._r.set(self.prefix + sid, json.dumps(token_info), ex=TOKEN_TTL)
+
+    def delete(self, sid):
+        self._r.delete(self.prefix + sid)
+
+    @contextmanager
+    def lock(self, sid: str, blocking: bool = True):
+        lk = self._r.lock(self.prefix + "lock:" + sid, timeout=LOCK_TIMEOUT,
+                          blocking=blocking, blocking_timeout=LOCK_TIMEOUT)
+        ok = lk.acquire()
+        try:
+            yield ok
+        finally:
+            if ok:
+                try:
+                    lk.release()
+                except Exception:
+                    pass  # 期限切れで既に解放済み
+
+
+def make_token_store() -> TokenStore:
+    """
+    TOKEN_STORE=memory / sqlite / redis で選択。
+    未指定なら REDIS_URL があれば redis、無ければ sqlite（TOKEN_STORE_PATH）。
+    """
+    kind = os.getenv("TOKEN_STORE") or ("redis" if os.getenv("REDIS_URL") else "sqlite")
+    if kind == "redis":
+        return RedisTokenStore(os.environ["REDIS_URL"])
+    if kind == "sqlite":
+        path = os.getenv("TOKEN_STORE_PATH", os.path.join(os.path.dirname(__file__), "tokens.db"))
+        return SqliteTokenStore(path)
+    if kind == "memory":
+        return MemoryTokenStore()
+    raise RuntimeError(f"unknown TOKEN_STORE: {kind}")
@@ -0,0 +1,528 @@
+# translation_service.py
+# 歌詞の行ごと翻訳（行単位メモ ＋ サビ等の重複排除）
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from typing import Iterator, List, Optional, Tuple
+
+from cache_store import TieredCache, cache_db_path
+from metrics import track, record_openai_usage, UPSTREAM_RETRIES
+from circuit_breaker import get_breaker, CircuitOpenError
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+MODEL = "gpt-4o-mini"
+TARGET_LANG = "ja"
+PROMPT_VERSION = "v2"   # プロンプトを変えたら上げる（古い訳を使わないため）
+
+# 同時に走らせる呼び出し数（プロセス全体で共有＝OpenAIのレート制限内に収める）
+MAX_CONCURRENCY = int(os.getenv("TRANSLATE_MAX_CONCURRENCY", "4"))
+CHUNK_RETRIES = int(os.getenv("TRANSLATE_CHUNK_RETRIES", "2"))
+RETRY_BACKOFF = float(os.getenv("TRANSLATE_RETRY_BACKOFF", "0.5"))
+
+# 複数ユーザーの行をまとめて1回の呼び出しにする（TranslationScheduler）
+BATCH_WINDOW = float(os.getenv("TRANSLATE_BATCH_WINDOW_MS", "15")) / 1000   # 他の行を待つ時間
+BATCH_TOKENS = int(os.getenv("TRANSLATE_BATCH_TOKENS", "800"))              # 1回に送る原文の推定トークン数
+BATCH_MIN_TOKENS = int(os.getenv("TRANSLATE_BATCH_MIN_TOKENS", "120"))      # 空きがあるときに分ける最小単位
+BATCH_MAX_LINES = int(os.getenv("TRANSLATE_BATCH_MAX_LINES", "40"))
+# OpenAI のレート制限（プロセスごと。ワーカーが複数なら割って設定する）
+OPENAI_RPM = float(os.getenv("TRANSLATE_RPM", "500"))
+OPENAI_TPM = float(os.getenv("TRANSLATE_TPM", "200000"))
+
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix="translate")
+
+TRANSLATION_MEMO = TieredCache(
+    "translations",
+    maxsize=int(os.getenv("TRANSLATION_MEMO_SIZE", "20000")),
+    ttl=float(os.getenv("TRANSLATION_MEMO_TTL", str(30 * 24 * 3600))),
+    db_path=cache_db_path(),
+    # 期限切れの訳もこの間は返し、裏で訳し直す（OpenAI が落ちている間も）
+    stale_ttl=float(os.getenv("TRANSLATION_STALE_TTL", str(30 * 24 * 3600))),
+)
+
+
+def _openai_failure(e: BaseException) -> bool:
+    """400 系（429以外）はこちらの入力の問題なので、OpenAI の不調としては数えない。"""
+    status = getattr(e, "status_code", None)
+    return not (status and 400 <= status < 500 and status != 429)
+
+
+# 1回の呼び出しは最大 BATCH_TOKENS 程度の原文なので、通常は数秒で終わる
+OPENAI_BREAKER = get_breaker(
+    "openai", slow_seconds=float(os.getenv("OPENAI_SLOW_SECONDS", "30")), is_failure=_openai_failure,
+)
+
+
+# ---------- OpenAI クライアント（プロセスで1つ。初めて使うときに作る） ----------
+_openai_client = None
+_openai_lock = threading.Lock()
+
+
+def openai_configured() -> bool:
+    return bool(os.getenv("OPENAI_API_KEY"))
+
+
+def get_openai_client():
+    """
+    共有の OpenAI クライアントを返す（キーが無ければ None）。
+    openai パッケージの import は重い（1秒近い）ので、起動時ではなく最初の呼び出しで行う。
+    """
+    global _openai_client
+    if _openai_client is None and openai_configured():
+        with _openai_lock:
+            if _openai_client is None:
+                from openai import OpenAI
+                _openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _openai_client
+
+
+def preload_openai():
+    """
+    openai パッケージの import だけを今済ませる（gunicorn の preload で親プロセスから呼ぶ）。
+    fork したワーカーは import 済みのモジュールを引き継ぎ、クライアントの生成（軽い）だけを各自で行う。
+    client.chat は初回アクセス時に import されるので、それも一緒に読み込んでおく。
+    """
+    if openai_configured():
+        import openai.resources.chat  # noqa: F401
+
+
+def warm_up_openai_client(delay: float = float(os.getenv("OPENAI_WARMUP_DELAY", "1"))):
+    """
+    delay 秒後に裏で import・生成だけ済ませておく（最初の翻訳リクエストで待たせない）。
+    起動直後のページ表示・ログインと CPU を取り合わないよう少し遅らせる。
+    """
+    if openai_configured():
+        t = threading.Timer(delay, get_openai_client)
+        t.name = "openai-warmup"
+        t.daemon = True
+        t.start()
+
+
+def _normalize_line(s: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", s).split())
+
+
+def _memo_key(line: str, target_lang: str, model: str) -> str:
+    raw = f"{PROMPT_VERSION}\x1f{model}\x1f{target_lang}\x1f{_normalize_line(line)}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+# ---------- 送る前の前処理（タイムタグ・空行・記号だけの行はローカルで処理） ----------
+_LRC_TAGS = re.compile(r"^\s*((?:\[\d{1,2}:\d{2}(?:\.\d{1,3})?\]\s*)+)")
+_LRC_META = re.compile(r"^\s*\[[a-z]+:[^\]]*\]\s*$", re.I)   # [ar:...] [ti:...] など
+
+
+def split_tags(line: str) -> Tuple[str, str]:
+    """'[00:12.34] text' -> ('[00:12.34]', 'text')。タグが無ければ ('', line)。"""
+    m = _LRC_TAGS.match(line)
+    if not m:
+        return "", line.strip()
+    return m.group(1).strip(), line[m.end():].strip()
+
+
+def _local_translation(text: str):
+    """モデルに送らずに済む行ならその訳（空行・記号だけ・メタタグ）を、送るべき行なら None を返す。"""
+    if not text or _LRC_META.match(text):
+        return ""
+    if not any(ch.isalpha() for ch in text):
+        return text   # ♪ や … はそのまま
+    return None
+
+
+# ---------- モデル呼び出し（番号付きで送り、番号で突き合わせる） ----------
+_NUMBERED = re.compile(r"^\s*(\d+)\s*(?:\t|[.:：)）]\s*|\s+)(.*)$")
+
+
+def _messages(chunk: List[str]) -> list:
+    prompt = (
+        "歌詞を自然な日本語に訳してください。入力は「番号<TAB>歌詞」です。\n"
+        "全行を「番号<TAB>訳」で1行ずつ出力し、行をまとめず、解説は付けないこと。\n\n"
+        + "\n".join(f"{n}\t{line}" for n, line in enumerate(chunk, start=1))
+    )
+    return [
+        {"role": "system", "content": "You are a professional translator."},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def _parse_numbered(raw: str, size: int):
+    """出力1行を (0始まりの行番号, 訳) に。番号が無い・範囲外なら None。"""
+    m = _NUMBERED.match(raw)
+    if not m:
+        return None
+    j = int(m.group(1)) - 1
+    if not 0 <= j < size:
+        return None
+    return j, m.group(2).strip()
+
+
+def _translate_chunk(client, chunk: List[str], model: str) -> List[Optional[str]]:
+    """1回の呼び出しで訳す。番号が返ってこなかった（ずれた）行は None。"""
+    with OPENAI_BREAKER.guard(), track("openai", "chat.completions.create"):
+        resp = client.chat.completions.create(
+            model=model,
+            messages=_messages(chunk),
+            temperature=0.2,
+        )
+    record_openai_usage(getattr(resp, "usage", None))
+    out: List[Optional[str]] = [None] * len(chunk)
+    for raw in (resp.choices[0].message.content or "").splitlines():
+        parsed = _parse_numbered(raw, len(chunk))
+        if parsed and out[parsed[0]] is None:
+            out[parsed[0]] = parsed[1]
+    return out
+
+
+def _translate_chunk_with_retry(client, chunk: List[str], model: str) -> List[str]:
+    """
+    チャンク単位で再試行する。
+    - 呼び出し自体の失敗はバックオフして同じ行をやり直す
+    - 一部の行の番号が欠けた（行がずれた）ときは、その行だけ送り直す
+    再試行しても訳せなかった行は空文字。
+    """
+    out: List[Optional[str]] = [None] * len(chunk)
+    missing = list(range(len(chunk)))
+    for attempt in range(CHUNK_RETRIES + 1):
+        try:
+            got = _translate_chunk(client, [chunk[j] for j in missing], model)
+        except Exception as e:
+            if isinstance(e, CircuitOpenError) or attempt >= CHUNK_RETRIES:
+                if len(missing) == len(chunk):
+                    raise
+                break   # 一部は訳せているので、残りを空にして返す
+            UPSTREAM_RETRIES.inc(service="openai", reason="chunk")
+            time.sleep(RETRY_BACKOFF * (2 ** attempt))
+            continue
+        for j, jp in zip(missing, got):
+            if jp is not None:
+                out[j] = jp
+        missing = [j for j in missing if out[j] is None]
+        if not missing:
+            break
+        if attempt < CHUNK_RETRIES:
+            UPSTREAM_RETRIES.inc(service="openai", reason="misaligned")
+    return [jp or "" for jp in out]
+
+
+def _stream_chunk(client, chunk: List[str], model: str, emit) -> None:
+    """
+    ストリーミングAPIで1チャンクを訳し、1行できるたびに emit(j, 訳) を呼ぶ。
+    番号が欠けた行や途中で失敗したときの残りは、その行だけ通常APIで訳し直す。
+    """
+    done = [False] * len(chunk)
+
+    def take(raw: str):
+        parsed = _parse_numbered(raw, len(chunk))
+        if parsed and not done[parsed[0]]:
+            done[parsed[0]] = True
+            emit(*parsed)
+
+    try:
+        # 計測は最後のトークンを受け取るまで（最後のチャンクに usage が付く）
+        with OPENAI_BREAKER.guard(), track("openai", "chat.completions.create(stream)"):
+            stream = client.chat.completions.create(
+                model=model,
+                messages=_messages(chunk),
+                temperature=0.2,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            buf = ""
+            for ev in stream:
+                record_openai_usage(getattr(ev, "usage", None))
+                if not ev.choices:
+                    continue
+                buf += ev.choices[0].delta.content or ""
+                while "\n" in buf:
+                    line, buf = buf.split("\n", 1)
+                    take(line)
+        if buf:
+            take(buf)
+        reason = "misaligned"
+    except CircuitOpenError:
+        raise
+    except Exception:
+        reason = "stream"
+
+    missing = [j for j in range(len(chunk)) if not done[j]]
+    if not missing:
+        return
+    UPSTREAM_RETRIES.inc(service="openai", reason=reason)
+    rest = _translate_chunk_with_retry(client, [chunk[j] for j in missing], model)
+    for j, jp in zip(missing, rest):
+        emit(j, jp)
+
+
+# ==============================
+# プロセス全体の翻訳スケジューラ（ユーザーをまたいだ重複排除＋まとめ送り）
+# ==============================
+PROMPT_OVERHEAD_TOKENS = 60   # システム/指示文のぶん
+
+
+def _estimate_tokens(text: str) -> int:
+    """ざっくりした推定（英語は約4文字、日本語は約1文字で1トークン）。"""
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+class _Item:
+    __slots__ = ("key", "text", "client", "model", "future")
+
+    def __init__(self, key, text, client, model):
+        self.key = key
+        self.text = text
+        self.client = client
+        self.model = model
+        self.future: Future = Future()
+
+
+class TranslationScheduler:
+    """
+    未翻訳の行をプロセス全体で1本のキューに集め、数ミリ秒待ってから
+    推定トークン数の上限まで詰めて1回のストリーミング呼び出しで訳す。
+    - 同じ行（メモキー）が翻訳中なら新たに送らず、その結果を待つ
+    - 同時に走る呼び出しは MAX_CONCURRENCY 本まで。空いていれば待ち行を空き本数に分けて並列に送り
+      （1曲だけでも待たせない）、埋まっていれば空きを待つ間に来た行が次の呼び出しに相乗りする
+    - RPM/TPM のトークンバケットで待たせる（バースト時もエラーにせず順番待ち）
+    """
+    def __init__(self, window: float = BATCH_WINDOW, batch_tokens: int = BATCH_TOKENS,
+                 max_lines: int = BATCH_MAX_LINES, concurrency: int = MAX_CONCURRENCY,
+                 rpm: float = OPENAI_RPM, tpm: float = OPENAI_TPM, min_tokens: int = BATCH_MIN_TOKENS):
+        self.window = window
+        self.batch_tokens = batch_tokens
+        self.min_tokens = min_tokens
+        self.max_lines = max_lines
+        self.concurrency = concurrency
+        self._active = 0   # 実行中＋送信準備中の呼び出し数
+        self._queue: deque = deque()
+        self._inflight: dict = {}   # memo key -> _Item
+        self._cond = threading.Condition()
+        self._slots = threading.Semaphore(concurrency)
+        self._requests = TokenBucket.per_minute(rpm)
+        self._tokens = TokenBucket.per_minute(tpm)
+        self._thread = None
+        self.stats = {"lines_queued": 0, "lines_shared": 0, "batches": 0, "batch_lines": 0, "errors": 0}
+
+    def submit(self, client, texts: List[str], keys: List[str], model: str = MODEL) -> List[Future]:
+        """texts を訳す Future を同じ順で返す。結果はメモにも書かれる。"""
+        futures = []
+        with self._cond:
+            for text, key in zip(texts, keys):
+                item = self._inflight.get(key)
+                if item is None:
+                    item = self._inflight[key] = _Item(key, text, client, model)
+                    self._queue.append(item)
+                    self.stats["lines_queued"] += 1
+                else:
+                    self.stats["lines_shared"] += 1
+                futures.append(item.future)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch_loop, name="translate-dispatch", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return futures
+
+    def _batch_budget(self) -> int:
+        """待ち行を空いている本数で割った量（min_tokens〜batch_tokens に収める）。"""
+        idle = max(1, self.concurrency - self._active)   # _active はいま確保した枠をまだ含まない
+        share = -(-self._queued_tokens() // idle)
+        return max(self.min_tokens, min(self.batch_tokens, share))
+
+    def _take_batch(self) -> List[_Item]:
+        """先頭と同じ client/model の行を、トークン上限・行数上限まで取り出す。"""
+        first = self._queue[0]
+        batch, budget, rest = [], self._batch_budget(), deque()
+        while self._queue and len(batch) < self.max_lines:
+            item = self._queue.popleft()
+            if item.client is not first.client or item.model != first.model:
+                rest.append(item)
+                continue
+            cost = _estimate_tokens(item.text)
+            if batch and cost > budget:
+                self._queue.appendleft(item)
+                break
+            batch.append(item)
+            budget -= cost
+        self._queue.extendleft(reversed(rest))
+        return batch
+
+    def _queued_tokens(self) -> int:
+        return sum(_estimate_tokens(it.text) for it in self._queue)
+
+    def _dispatch_loop(self):
+        while True:
+            self._slots.acquire()
+            batch: List[_Item] = []
+            try:
+                with self._cond:
+                    while not self._queue:
+                        self._cond.wait()
+                    full = len(self._queue) >= self.max_lines or self._queued_tokens() >= self.batch_tokens
+                if not full:
+                    time.sleep(self.window)   # 同時に来ている他のリクエストの行を待つ
+                with self._cond:
+                    batch = self._take_batch()
+                    self._active += 1
+                src_tokens = sum(_estimate_tokens(it.text) for it in batch)
+                self._requests.acquire(1)
+                # 訳文は原文と同程度〜2倍程度になる
+                self._tokens.acquire(PROMPT_OVERHEAD_TOKENS + src_tokens * 3)
+                _executor.submit(self._run_batch, batch)
+            except Exception as e:
+                logger.exception("translation dispatch failed")
+                for item in batch:
+                    self._resolve(item, error=e)
+                self._release_slot(counted=bool(batch))
+
+    def _run_batch(self, batch: List[_Item]):
+        def emit(j, jp):
+            item = batch[j]
+            if jp:  # 行数不足の穴埋め（空文字）は覚えない
+                TRANSLATION_MEMO.set(item.key, jp)
+            self._resolve(item, result=jp)
+
+        try:
+            with self._cond:
+                self.stats["batches"] += 1
+                self.stats["batch_lines"] += len(batch)
+            _stream_chunk(batch[0].client, [it.text for it in batch], batch[0].model, emit)
+        except Exception as e:
+            with self._cond:
+                self.stats["errors"] += 1
+            for item in batch:
+                self._resolve(item, error=e)
+        finally:
+            self._release_slot(counted=True)
+
+    def _release_slot(self, counted: bool):
+        if counted:
+            with self._cond:
+                self._active -= 1
+        self._slots.release()
+
+    def _resolve(self, item: _Item, result=None, error=None):
+        with self._cond:
+            if self._inflight.get(item.key) is item:
+                del self._inflight[item.key]
+        if item.future.done():
+            return
+        if error is not None:
+            item.future.set_exception(error)
+        else:
+            item.future.set_result(result)
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            s = dict(self.stats)
+            s["queued"] = len(self._queue)
+            s["inflight"] = len(self._inflight)
+        s["avg_batch_lines"] = round(s["batch_lines"] / s["batches"], 1) if s["batches"] else 0.0
+        s["rate_limited_seconds"] = round(self._requests.waited_seconds + self._tokens.waited_seconds, 2)
+        return s
+
+
+SCHEDULER = TranslationScheduler()
+
+
+def _plan(lines: List[str], target_lang: str, model: str):
+    """
+    行の並びを「ローカルで決まる行」と「訳が必要なユニーク本文」に分ける。
+    戻り値: (local {行番号: 訳}, positions {メモキー: [行番号...]}, texts {メモキー: 本文})
+    positions / texts は初出順。
+    """
+    local: dict = {}
+    positions: dict = {}
+    texts: dict = {}
+    for i, line in enumerate(lines):
+        _, text = split_tags(str(line or ""))
+        fixed = _local_translation(text)
+        if fixed is not None:
+            local[i] = fixed
+            continue
+        k = _memo_key(text, target_lang, model)
+        positions.setdefault(k, []).append(i)
+        texts.setdefault(k, text)
+    return local, positions, texts
+
+
+def iter_translate_lines(
+    client,
+    lines: List[str],
+    start_index: int = 0,
+    model: str = MODEL,
+    target_lang: str = TARGET_LANG,
+    report: Optional[dict] = None,
+) -> Iterator[Tuple[int, str]]:
+    """
+    translate_lines のストリーミング版。訳せた行から (行番号, 訳) を順不同で返す。
+    - 空行などローカルで決まる行とメモ済みの行は即座に返す（期限切れの訳も返し、裏で訳し直す）
+    - 未翻訳の行は start_index（再生位置）に近いものから先にスケジューラへ積む
+    - OpenAI のサーキットが開いていれば未翻訳の行は送らず、返さない
+    report を渡すと {"stale": 古い訳を返した行数, "unavailable": 訳せなかった行数} を書き込む。
+    """
+    report = report if report is not None else {}
+    report.update(stale=0, unavailable=0)
+    local, positions, texts = _plan(lines, target_lang, model)
+    yield from local.items()
+
+    pending_keys: List[str] = []
+    refresh_keys: List[str] = []
+    for k, idxs in positions.items():
+        ent = TRANSLATION_MEMO.get_entry(k)
+        if ent is None:
+            pending_keys.append(k)
+            continue
+        if ent[1]:
+            refresh_keys.append(k)
+            report["stale"] += len(idxs)
+        for i in idxs:
+            yield i, ent[0]
+    if refresh_keys and not OPENAI_BREAKER.rejecting():
+        SCHEDULER.submit(client, [texts[k] for k in refresh_keys], refresh_keys, model)   # 結果はメモへ
+    if not pending_keys:
+        return
+    if OPENAI_BREAKER.rejecting():
+        report["unavailable"] += sum(len(positions[k]) for k in pending_keys)
+        return
+
+    # 再生位置に近い行から積む（スケジューラは積んだ順に送る）
+    pending_keys.sort(key=lambda k: min(abs(i - start_index) for i in positions[k]))
+    futures = SCHEDULER.submit(client, [texts[k] for k in pending_keys], pending_keys, model)
+    key_of = dict(zip(futures, pending_keys))
+    for fut in as_completed(futures):
+        try:
+            jp = fut.result()   # 失敗した行の例外は呼び出し側へ
+        except CircuitOpenError:
+            report["unavailable"] += len(positions[key_of[fut]])
+            continue
+        for i in positions[key_of[fut]]:
+            yield i, jp
+
+
+def translate_lines(client, lines: List[str], model: str = MODEL, target_lang: str = TARGET_LANG,
+                    report: Optional[dict] = None) -> List[str]:
+    """
+    歌詞行を翻訳して同じ順序・同じ行数で返す。
+    - タイムタグは外し、空行・記号だけの行はモデルに送らない
+    - 同じ行（サビなど）は1回だけ訳し、過去に訳した行はメモから返す
+    - 残りはスケジューラ経由でモデルへ（他のユーザーが同時に訳している行はその結果を待つ）
+    訳せなかった行は空文字（report は iter_translate_lines と同じ）。
+    """
+    out = [""] * len(lines)
+    for i, jp in iter_translate_lines(client, lines, model=model, target_lang=target_lang, report=report):
+        out[i] = jp
+    return out
+
+
+def translation_memo_stats() -> dict:
+    return TRANSLATION_MEMO.stats()
+
+
+def translation_scheduler_stats() -> dict:
+    return SCHEDULER.snapshot()
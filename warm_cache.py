@@ -0,0 +1,243 @@
+# warm_cache.py
+# 歌詞・訳のキャッシュを事前に温める（flask --app app warm-cache から使う）
+#
+# プレイリストや曲IDの一覧を受け取り、曲ごとに LRCLIB から歌詞を取って訳し、
+# それぞれ LYRICS_CACHE / TRANSLATION_MEMO（SQLite 層）に書き込む。その曲を最初に聴く人も待たない。
+#
+# - Spotify の呼び出しはまとめて（プレイリストは100曲、曲IDは50曲ずつ）、レート制御では BACKGROUND 扱い
+# - 歌詞と訳は --concurrency 曲ずつ並行。OpenAI 側はスケジューラの RPM/TPM 制限、LRCLIB 側は --lrclib-rate で絞る
+# - 上流のサーキットが開いている間は新しい曲を始めずに待つ
+# - 済んだ曲は進捗ファイルに書くので、中断しても続きから再開できる（失敗した曲は次回もう一度試す）
+import os
+import re
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Iterable, Iterator, List, Optional
+
+import spotipy
+
+from rate_limit import TokenBucket
+from lyrics_service import get_timed_lyrics, LyricsUnavailable, LRCLIB_BREAKER
+from translation_service import translate_lines, OPENAI_BREAKER
+
+logger = logging.getLogger(__name__)
+
+WARM_PROGRESS_PATH = os.getenv("WARM_PROGRESS_PATH", "warm_cache_progress.json")
+WARM_CONCURRENCY = int(os.getenv("WARM_CONCURRENCY", "4"))
+WARM_LRCLIB_RATE = float(os.getenv("WARM_LRCLIB_RATE", "5"))   # LRCLIB へ1秒あたり何曲まで
+TRACKS_PER_CALL = 50                                           # GET /tracks の上限
+SPOTIFY_RETRIES = 3
+
+# 進捗ファイルに「済」として残す結果（これ以外は次回また試す）
+DONE = ("ok", "no_lyrics", "lyrics_only")
+# 訳も温めるときに「済」とみなす結果（--no-translate で歌詞だけ取った曲はもう一度やる）
+DONE_WITH_TRANSLATION = ("ok", "no_lyrics")
+
+_ID = re.compile(r"^[0-9A-Za-z]{22}$")
+
+
+def spotify_id(value: str, kind: str) -> Optional[str]:
+    """ID そのもの / spotify:<kind>:ID / https://open.spotify.com/<kind>/ID のどれからでも ID を取り出す。"""
+    value = (value or "").strip()
+    if value.startswith(f"spotify:{kind}:"):
+        value = value.rsplit(":", 1)[1]
+    elif "open.spotify.com/" in value:
+        parts = value.split("?", 1)[0].rstrip("/").split("/")
+        if len(parts) < 2 or parts[-2] != kind:
+            return None
+        value = parts[-1]
+    return value if _ID.match(value) else None
+
+
+def read_track_ids(path: str) -> List[str]:
+    """1行に1曲（ID・URI・URL）。空行と # で始まる行は無視。読めない行は警告して飛ばす。"""
+    ids = []
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            tid = spotify_id(line, "track")
+            if tid:
+                ids.append(tid)
+            else:
+                logger.warning(f"warm-cache: {path}:{n}: not a track id: {line}")
+    return ids
+
+
+# ==============================
+# Spotify（メタ情報をまとめて取る）
+# ==============================
+def _spotify(fn: Callable, *args, **kwargs):
+    """429 / 503（レート制御の待ち切れ・サーキット開）は Retry-After だけ待って数回やり直す。"""
+    for attempt in range(SPOTIFY_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except spotipy.SpotifyException as e:
+            if e.http_status not in (429, 503) or attempt == SPOTIFY_RETRIES:
+                raise
+            retry_after = (e.headers or {}).get("Retry-After")
+            delay = float(retry_after) if retry_after else 5.0 * (attempt + 1)
+            logger.info(f"warm-cache: spotify {e.http_status}, retrying in {delay:.0f}s")
+            time.sleep(delay)
+
+
+def playlist_tracks(sp: spotipy.Spotify, playlist_id: str) -> Iterator[dict]:
+    """プレイリストの曲（ローカルファイル・エピソードは除く）。1回の呼び出しで100曲ずつ。"""
+    page = _spotify(
+        sp.playlist_items, playlist_id, additional_types=("track",), limit=100,
+        fields="items(track(id,type,is_local,name,duration_ms,artists(name))),next",
+    )
+    while page:
+        for it in page.get("items") or []:
+            t = (it or {}).get("track") or {}
+            if t.get("id") and t.get("type", "track") == "track" and not t.get("is_local"):
+                yield t
+        page = _spotify(sp.next, page) if page.get("next") else None
+
+
+def fetch_tracks(sp: spotipy.Spotify, track_ids: List[str]) -> Iterator[dict]:
+    for i in range(0, len(track_ids), TRACKS_PER_CALL):
+        res = _spotify(sp.tracks, track_ids[i:i + TRACKS_PER_CALL])
+        for t in (res or {}).get("tracks") or []:
+            if t and t.get("id"):
+                yield t
+
+
+# ==============================
+# 進捗ファイル
+# ==============================
+class Progress:
+    """
+    {"done": {track_id: 結果}} を JSON で持つ。書き込みは一時ファイル経由で置き換え（途中で切れても壊れない）。
+    translate=True のときは "lyrics_only"（前回 --no-translate で取った曲）を済とみなさない。
+    """
+    def __init__(self, path: Optional[str], restart: bool = False, translate: bool = True):
+        self.path = path
+        self.done_results = DONE_WITH_TRANSLATION if translate else DONE
+        self.done: dict = {}
+        self._lock = threading.Lock()
+        self._dirty = 0
+        if path and not restart and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.done = json.load(f).get("done") or {}
+
+    def is_done(self, track_id: str) -> bool:
+        return self.done.get(track_id) in self.done_results
+
+    def record(self, track_id: str, result: str):
+        if result not in DONE:
+            return
+        with self._lock:
+            self.done[track_id] = result
+            self._dirty += 1
+            if self._dirty >= 20:
+                self._save_locked()
+
+    def save(self):
+        with self._lock:
+            self._save_locked()
+
+    def _save_locked(self):
+        if not self.path or not self._dirty:
+            return
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"done": self.done, "updated_at": int(time.time())}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+        self._dirty = 0
+
+
+# ==============================
+# 温める
+# ==============================
+def warm_track(track: dict, openai_client=None) -> str:
+    """
+    1曲分。結果は "ok" / "no_lyrics" / "lyrics_only"（訳さなかった）/ "unavailable"（上流に届かなかった）。
+    訳す行はプレイヤーが送ってくる並び（タイムライン上の行）と同じにする（同じメモキーになる）。
+    """
+    artists = track.get("artists") or []
+    try:
+        res = get_timed_lyrics(
+            track.get("name") or "",
+            artists[0]["name"] if artists else "",
+            duration_ms=track.get("duration_ms"),
+            track_id=track.get("id"),
+        )
+    except LyricsUnavailable:
+        return "unavailable"
+    if not res or not res["timed"]:
+        return "no_lyrics"
+    if res["stale"]:
+        return "unavailable"   # 古い歌詞しか無い（取り直しは裏で走っている）。次回もう一度
+    if openai_client is None:
+        return "lyrics_only"
+    report: dict = {}
+    translate_lines(openai_client, [text for _, text in res["timed"]], report=report)
+    return "unavailable" if report["unavailable"] else "ok"
+
+
+def _wait_for_upstreams(translate: bool):
+    """LRCLIB（訳すなら OpenAI も）のサーキットが開いている間は待つ。"""
+    for breaker in (LRCLIB_BREAKER, OPENAI_BREAKER) if translate else (LRCLIB_BREAKER,):
+        while breaker.rejecting():
+            delay = max(1.0, breaker.retry_after())
+            logger.info(f"warm-cache: {breaker.service} circuit open, waiting {delay:.0f}s")
+            time.sleep(delay)
+
+
+def warm_tracks(tracks: Iterable[dict], progress: Progress, openai_client=None,
+                concurrency: int = WARM_CONCURRENCY, lrclib_rate: float = WARM_LRCLIB_RATE,
+                on_result: Optional[Callable[[dict, str], None]] = None) -> dict:
+    """
+    tracks を concurrency 曲ずつ並行して温める。済みの曲と重複は飛ばす。
+    戻り値は結果ごとの曲数（"skipped" は進捗ファイルで済になっていた曲、"error" は想定外の例外）。
+    """
+    counts = {"skipped": 0, "ok": 0, "no_lyrics": 0, "lyrics_only": 0, "unavailable": 0, "error": 0}
+    bucket = TokenBucket(lrclib_rate, max(1.0, lrclib_rate)) if lrclib_rate > 0 else None
+    seen: set = set()
+
+    def run(track: dict) -> str:
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            return warm_track(track, openai_client)
+        except Exception as e:
+            logger.warning(f"warm-cache: {track.get('id')} failed: {e}")
+            return "error"
+
+    in_flight: dict = {}
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="warm-cache") as pool:
+        try:
+            for track in tracks:
+                tid = track["id"]
+                if tid in seen:
+                    continue
+                seen.add(tid)
+                if progress.is_done(tid):
+                    counts["skipped"] += 1
+                    continue
+                # 投入するのは並列数ぶんだけ（中断したとき・サーキットが開いたときにすぐ止まれるように）
+                while len(in_flight) >= concurrency:
+                    _collect(wait(in_flight, return_when=FIRST_COMPLETED).done, in_flight, progress, counts, on_result)
+                _wait_for_upstreams(openai_client is not None)
+                in_flight[pool.submit(run, track)] = track
+            _collect(wait(in_flight).done, in_flight, progress, counts, on_result)
+        finally:
+            for fut in in_flight:
+                fut.cancel()
+            progress.save()
+    return counts
+
+
+def _collect(done, in_flight: dict, progress: Progress, counts: dict, on_result):
+    for fut in done:
+        track = in_flight.pop(fut)
+        result = fut.result()
+        counts[result] += 1
+        progress.record(track["id"], result)
+        if on_result is not None:
+            on_result(track, result)